@@ -23,6 +23,9 @@
  */
 
 #include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
 
 #include <math.h>
 
@@ -73,6 +76,14 @@ int read_ned_data(char *inFName, int stepSize, struct data_info_t *di) {
     double minEle = GDALGetRasterMinimum( hBand, &bGotMin );
     double maxEle = GDALGetRasterMaximum( hBand, &bGotMax );
 
+    // The file doesn't know its range, so compute the exact one
+    if (!bGotMin || !bGotMax) {
+        double adfMinMax[2];
+        GDALComputeRasterMinMax( hBand, FALSE, adfMinMax );
+        minEle = adfMinMax[0];
+        maxEle = adfMinMax[1];
+    }
+
     int   nXSize = GDALGetRasterBandXSize( hBand );
     int   nYSize = GDALGetRasterBandYSize( hBand );
 
@@ -108,9 +119,83 @@ int read_ned_data(char *inFName, int stepSize, struct data_info_t *di) {
     return 1;
 }
 
+// A triangle mesh written by terrainmesh.py
+// Vertices are column, row, elevation
+struct mesh_info_t {
+    int width;
+    int height;
+
+    double minEle;
+    double maxEle;
+
+    uint32_t numVerts;
+    uint32_t numTris;
+
+    float *verts;
+    uint32_t *tris;
+};
+
+// The .tmesh header, see terrainmesh.py
+struct tmesh_header_t {
+    char magic[4];
+    uint32_t version;
+    uint32_t width;
+    uint32_t height;
+    uint32_t numVerts;
+    uint32_t numTris;
+    double minEle;
+    double maxEle;
+    double geoTransform[6];
+} __attribute__((packed));
+
+// Whether str ends with suffix
+int ends_with(const char *str, const char *suffix) {
+    size_t len = strlen(str);
+    size_t sufLen = strlen(suffix);
+    return len >= sufLen && 0 == strcmp(str + len - sufLen, suffix);
+}
+
+// Read a mesh made by terrainmesh.py
+// Assumes a little endian machine, like the file
+int read_mesh(char *inFName, struct mesh_info_t *mi) {
+    FILE *inf = fopen(inFName, "rb");
+    if (inf == NULL) {
+        printf("Could not open %s!\n", inFName);
+        return 0;
+    }
+    struct tmesh_header_t header;
+    if (1 != fread(&header, sizeof(header), 1, inf) ||
+        0 != memcmp(header.magic, "TMSH", 4) || header.version != 1) {
+        printf("%s is not a terrain mesh!\n", inFName);
+        fclose(inf);
+        return 0;
+    }
+    mi->width = header.width;
+    mi->height = header.height;
+    mi->minEle = header.minEle;
+    mi->maxEle = header.maxEle;
+    mi->numVerts = header.numVerts;
+    mi->numTris = header.numTris;
+
+    mi->verts = malloc(sizeof(float) * 3 * mi->numVerts);
+    mi->tris = malloc(sizeof(uint32_t) * 3 * mi->numTris);
+    if (mi->numVerts != fread(mi->verts, sizeof(float)*3, mi->numVerts, inf) ||
+        mi->numTris != fread(mi->tris, sizeof(uint32_t)*3, mi->numTris, inf)) {
+        printf("%s is truncated!\n", inFName);
+        free(mi->verts);
+        free(mi->tris);
+        fclose(inf);
+        return 0;
+    }
+    fclose(inf);
+    return 1;
+}
+
 int main(int argc, char *argv[]) {
-    if (argc <2) {
-        printf("Must specify a filename prefix.\n");
+    if (argc <3) {
+        printf("Must specify a filename prefix and a NED file.\n");
+        printf("\t%s <prefix> <arcgrid_file> [min_elevation max_elevation]\n", argv[0]);
+        printf("\t%s <prefix> <mesh.tmesh> [min_elevation max_elevation]\n", argv[0]);
         return 1;
     }
 
@@ -122,6 +207,8 @@ int main(int argc, char *argv[]) {
 
     // NED files are 10812x10812
     // That uses a bunch of memory, so only use every 8th data point
+    // (terrainmesh.py makes a mesh with full resolution detail where
+    // it's needed, and that can be rendered instead)
     const int stepSize = 8;
 
     // The elevation data originally ranges from di.minEle to di.maxEle
@@ -129,79 +216,138 @@ int main(int argc, char *argv[]) {
     // For rendering it's scaled by scale
     const double scale = 25;
 
-    // Read the data and exit on failure
-    if (0 == read_ned_data(inFName, stepSize, &di)) {
-        printf("Error reading \"%s\"\n", inFName);
-        return 1;
-    }
-
-    char outputFileName[32] = "";
-
     // Scale the data into a 200x200 square
     double xMin = -100.0;
     double yMin = -100.0;
     double xMax = 100.0;
     double yMax = 100.0;
 
+    // The number of polygons passed to RiPointsPolygon
+    int numPolys;
 
-    // The x and y increments between each elevation sample
-    double xDiff = (xMax - xMin) / di.width;
-    double yDiff = (yMax - yMin) / di.height;
-    
-    RtColor terrainColor = {0.8,1.0,0.8};
+    // The number of vertices in each polygon.
+    int *numVerts;
 
+    // The indices into verts for each polygon
+    int *vertIdx;
 
-    const int numFrames = 36;
-    double perFrameRotation = 360.0/numFrames;
+    // The actual vertex data
+    RtPoint *verts;
 
-    // The number of polygons passed to RiPointsPolygon
-    int numPolys = di.width*di.height;
+    if (ends_with(inFName, ".tmesh")) {
+        struct mesh_info_t mi = {0};
+        if (0 == read_mesh(inFName, &mi)) {
+            printf("Error reading \"%s\"\n", inFName);
+            return 1;
+        }
+        if (argc>=5) {
+            mi.minEle = atof(argv[3]);
+            mi.maxEle = atof(argv[4]);
+        }
 
-    // The number of vertices in each polygon.
-    // Every polygon will be a quad, so this is always 4
-    int *numVerts = malloc(sizeof(int)*numPolys);
-    for (int i=0;i<numPolys; ++i) {
-        numVerts[i] = 4;
-    }
+        // Every polygon is a triangle
+        numPolys = mi.numTris;
+        numVerts = malloc(sizeof(int)*numPolys);
+        vertIdx = malloc(sizeof(int)*numPolys*3);
+        for (int i=0;i<numPolys; ++i) {
+            numVerts[i] = 3;
+        }
+        for (int i=0;i<numPolys*3; ++i) {
+            vertIdx[i] = mi.tris[i];
+        }
 
-    // The indices into verts for each polygon
-    int *vertIdx = malloc(sizeof(int)*numPolys*4);
-
-    int cur = 0;
-    for (int i=0;i<di.height-1; ++i) {
-        for (int j=0;j<di.width-1; ++j) {
-            vertIdx[cur++] = i*di.width+j;
-            vertIdx[cur++] = (i+1)*di.width+j;
-            vertIdx[cur++] = (i+1)*di.width+j+1;
-            vertIdx[cur++] = i*di.width+j+1;
+        // Same coordinates as the grid below
+        double xScale = (xMax - xMin) / mi.width;
+        double yScale = (yMax - yMin) / mi.height;
+        // A flat mesh is at height 0
+        double realScale = 0.0;
+        if (mi.maxEle > mi.minEle) {
+            realScale = scale /(mi.maxEle - mi.minEle);
+        }
+        verts = malloc(sizeof(RtPoint) * mi.numVerts);
+        for (uint32_t i=0; i<mi.numVerts; ++i) {
+            verts[i][0] = xMin + mi.verts[3*i] * xScale;
+            verts[i][1] = (mi.verts[3*i+2] - mi.minEle) * realScale;
+            verts[i][2] = yMin + mi.verts[3*i+1] * yScale;
+        }
+        free(mi.verts);
+        free(mi.tris);
+    } else {
+        // Read the data and exit on failure
+        if (0 == read_ned_data(inFName, stepSize, &di)) {
+            printf("Error reading \"%s\"\n", inFName);
+            return 1;
         }
-    }
 
-    // The actual vertex data
-    RtPoint *verts = malloc(sizeof(RtPoint) * numPolys);
-
-    int curVert = 0;
-    double x,y,z;
-    y = yMin;
-    double realScale = scale /(di.maxEle - di.minEle);
-    for (int yb=0; yb<di.height; ++yb) {
-
-        x = xMin;
-        for (int xb=0; xb<di.width; ++xb) {
-            z = eleAt(&di, xb, yb);
-
-            z = (z-di.minEle) * realScale;
-            
-            verts[curVert][0] = x;
-            verts[curVert][1] = z;
-            verts[curVert][2] = y;
-            ++curVert;
-            x += xDiff;
+        // A range given on the command line wins, so several datasets can
+        // be rendered with the same scale (see map_download/rasterstats.py)
+        if (argc>=5) {
+            di.minEle = atof(argv[3]);
+            di.maxEle = atof(argv[4]);
+        }
+
+        // The x and y increments between each elevation sample
+        double xDiff = (xMax - xMin) / di.width;
+        double yDiff = (yMax - yMin) / di.height;
+
+        // One quad between each 2x2 group of samples
+        numPolys = (di.width-1)*(di.height-1);
+
+        // Every polygon will be a quad, so this is always 4
+        numVerts = malloc(sizeof(int)*numPolys);
+        for (int i=0;i<numPolys; ++i) {
+            numVerts[i] = 4;
         }
-        y += yDiff;
+
+        vertIdx = malloc(sizeof(int)*numPolys*4);
+
+        int cur = 0;
+        for (int i=0;i<di.height-1; ++i) {
+            for (int j=0;j<di.width-1; ++j) {
+                vertIdx[cur++] = i*di.width+j;
+                vertIdx[cur++] = (i+1)*di.width+j;
+                vertIdx[cur++] = (i+1)*di.width+j+1;
+                vertIdx[cur++] = i*di.width+j+1;
+            }
+        }
+
+        verts = malloc(sizeof(RtPoint) * di.width * di.height);
+
+        int curVert = 0;
+        double x,y,z;
+        y = yMin;
+        // A flat grid is at height 0
+        double realScale = 0.0;
+        if (di.maxEle > di.minEle) {
+            realScale = scale /(di.maxEle - di.minEle);
+        }
+        for (int yb=0; yb<di.height; ++yb) {
+
+            x = xMin;
+            for (int xb=0; xb<di.width; ++xb) {
+                z = eleAt(&di, xb, yb);
+
+                z = (z-di.minEle) * realScale;
+
+                verts[curVert][0] = x;
+                verts[curVert][1] = z;
+                verts[curVert][2] = y;
+                ++curVert;
+                x += xDiff;
+            }
+            y += yDiff;
+        }
+        // Free up memory for use while rendering
+        free(di.eleData);
     }
-    // Free up memory for use while rendering
-    free(di.eleData);
+
+    char outputFileName[32] = "";
+
+    RtColor terrainColor = {0.8,1.0,0.8};
+
+
+    const int numFrames = 36;
+    double perFrameRotation = 360.0/numFrames;
 
     RiBegin(RI_NULL); {
 
@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+
+# terrainmesh.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Make an adaptive terrain mesh from NED data
+
+# hmrender keeps every 8th sample in each direction and makes a quad
+# for each, so a flat valley gets as many polygons as a ridge, and the
+# detail in between the samples is lost.  This makes a mesh where the
+# polygons go where the terrain needs them:
+#   - the grid is read a block of BLOCK_SIZE x BLOCK_SIZE cells at a time
+#     (plus the row and column shared with the next block), so only one
+#     block is in memory, along with the mesh
+#   - each block is the root of a quadtree, and every node's error is
+#     how far its samples are from the two triangles between its four
+#     corners, computed for a whole level of nodes at once with NumPy.
+#     A node's error includes its children's, so the errors only get
+#     smaller going down the tree.
+#   - nodes are split until their error is under a tolerance in meters,
+#     or, given a budget of triangles, the tolerance is picked from a
+#     histogram of every node's error, which takes a first pass over the
+#     grid.  Leaves next to smaller ones make more than two triangles, so
+#     if the mesh comes out over budget the tolerance is raised until it
+#     fits.
+#   - nodes with nodata in them are split until the nodata cells can be
+#     left out
+#   - each leaf becomes a fan of triangles, using every vertex on its
+#     edges from smaller neighbors, so there are no cracks, even between
+#     blocks
+# Vertices are full resolution samples, so flat areas are a few big
+# triangles and the ridges keep every sample they need.
+# The tolerance is only approximate: a leaf's fan isn't the pair of
+# triangles its error was measured against, and can be a bit further
+# from the samples.  The reported error is measured on the finished
+# mesh, a block at a time.
+
+# The mesh can be written as:
+#   .tmesh  a small binary file hmrender can render instead of the grid:
+#           a header (see TMESH_HEADER), then float32 x, y, elevation for
+#           every vertex and uint32 vertex numbers for every triangle,
+#           all little endian.  x and y are the column and row in the
+#           grid.
+#   .rib    a RenderMan PointsPolygons archive, for ReadArchive
+#   .obj    Wavefront OBJ
+# The .rib and .obj use hmrender's coordinates: the grid fills a
+# 200 x 200 square in x and z, and elevations go from 0 to 25 in y.
+
+# Usage:
+#     ./terrainmesh.py [--error=meters | --budget=triangles] [--block=512]
+#                      [--min=elevation] [--max=elevation]
+#                      <arcgrid_or_geotiff> <output.tmesh|.rib|.obj>
+
+import sys
+import math
+import time
+import struct
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+# Cells on a side of each block, a power of 2
+BLOCK_SIZE = 512
+
+# Default tolerance, in meters
+MAX_ERROR = 1.0
+
+# The .tmesh header: magic, version, grid width and height in samples,
+# vertex count, triangle count, min and max elevation, geotransform
+TMESH_MAGIC = b'TMSH'
+TMESH_VERSION = 1
+TMESH_HEADER = struct.Struct('<4sIIIII2d6d')
+
+# hmrender's scene
+SCENE_SIZE = 200.0
+SCENE_HEIGHT = 25.0
+
+# Histogram of node errors for picking a tolerance for a budget
+HIST_MIN = 1e-3
+HIST_MAX = 1e4
+HIST_BINS = 2048
+
+# A mesh, with vertices as (column, row, elevation) and triangles as
+# three vertex numbers each
+class Mesh(object):
+    def __init__(self, verts, tris, width, height, minEle, maxEle,
+                 geotransform=None, maxError=None):
+        self.verts = verts
+        self.tris = tris
+        self.width = width
+        self.height = height
+        self.minEle = minEle
+        self.maxEle = maxEle
+        self.geotransform = geotransform or (0, 1, 0, 0, 0, 1)
+        self.maxError = maxError
+
+# Read block (bx, by), which is (blockSize+1) x (blockSize+1) samples
+# Samples off the edge of the grid, and nodata, are NaN
+def read_block(band, width, height, bx, by, blockSize, nodata):
+    x0 = bx * blockSize
+    y0 = by * blockSize
+    cols = min(blockSize + 1, width - x0)
+    rows = min(blockSize + 1, height - y0)
+    data = np.full((blockSize + 1, blockSize + 1), np.nan, dtype=np.float32)
+    data[:rows, :cols] = band.ReadAsArray(x0, y0, cols, rows)
+    if nodata is not None:
+        data[data == nodata] = np.nan
+    return data
+
+# Every (size+1) x (size+1) window of data, size apart, as an array of
+# shape (n, n, size+1, size+1) without copying
+def windows(data, size):
+    n = (data.shape[0] - 1) // size
+    rs, cs = data.strides
+    return as_strided(data, shape=(n, n, size + 1, size + 1),
+                      strides=(size * rs, size * cs, rs, cs), writeable=False)
+
+# The error of every node of a block's quadtree
+# Returns {size: array of errors of the nodes of that size}
+# An error is -1 if the node is all nodata, inf if it's partly nodata,
+# and otherwise the largest vertical distance between a sample and the
+# two triangles through the node's corners (split along either
+# diagonal), or any of its children's errors
+def node_errors(data):
+    n = data.shape[0] - 1
+    valid = np.isfinite(data)
+    corners = (valid[:-1, :-1].astype(np.int8) + valid[1:, :-1] +
+               valid[:-1, 1:] + valid[1:, 1:])
+    errors = {1: np.where(corners == 4, 0.0,
+                          np.where(corners == 0, -1.0, np.inf)).astype(np.float32)}
+    size = 2
+    while size <= n:
+        win = windows(data, size)
+        count = windows(valid, size).sum(axis=(2, 3))
+        c00 = data[0:n:size, 0:n:size][..., None, None]
+        c01 = data[0:n:size, size::size][..., None, None]
+        c10 = data[size::size, 0:n:size][..., None, None]
+        c11 = data[size::size, size::size][..., None, None]
+        u = np.linspace(0.0, 1.0, size + 1, dtype=np.float32)
+        v = u[:, None]
+        # A leaf can be split along either diagonal, so check both
+        diag1 = np.where(u >= v, c00 + u * (c01 - c00) + v * (c11 - c01),
+                         c00 + v * (c10 - c00) + u * (c11 - c10))
+        diag2 = np.where(u + v <= 1, c00 + u * (c01 - c00) + v * (c10 - c00),
+                         c11 + (1 - u) * (c10 - c11) + (1 - v) * (c01 - c11))
+        with np.errstate(invalid='ignore'):
+            own = np.maximum(np.abs(win - diag1).max(axis=(2, 3)),
+                             np.abs(win - diag2).max(axis=(2, 3)))
+        own = np.where(count == (size + 1)**2, own,
+                       np.where(count == 0, -1.0, np.inf)).astype(np.float32)
+        m = n // size
+        children = errors[size // 2].reshape(m, 2, m, 2).max(axis=(1, 3))
+        errors[size] = np.maximum(own, children)
+        size *= 2
+    return errors
+
+# The leaves of a block's quadtree for a tolerance, as arrays of the x
+# and y of their top left corners and their sizes, in cells
+# All nodata leaves are left out
+def select_leaves(errors, tolerance):
+    size = max(errors)
+    reached = np.ones((1, 1), dtype=bool)
+    xs = list()
+    ys = list()
+    sizes = list()
+    while True:
+        err = errors[size]
+        if size == 1:
+            leaf = reached & (err == 0)
+        else:
+            leaf = reached & (err >= 0) & (err <= tolerance)
+        y, x = np.nonzero(leaf)
+        xs.append(x * size)
+        ys.append(y * size)
+        sizes.append(np.full(len(x), size, dtype=np.int64))
+        if size == 1:
+            break
+        split = reached & (err > tolerance)
+        reached = split.repeat(2, axis=0).repeat(2, axis=1)
+        size //= 2
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(sizes)
+
+# Concatenation of starts[i] + step * arange(lengths[i])
+def ragged_range(starts, lengths, step=1):
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return (np.repeat(starts, lengths) +
+            step * (np.arange(lengths.sum()) - offsets))
+
+# Pick the tolerance that makes about budget triangles, but at least
+# more than least
+# Every node with an error over the tolerance is split into four, so
+# the number of leaves is the number of blocks plus three for each node
+# over it, and each leaf is at least two triangles
+def budget_tolerance(hist, numInf, numBlocks, budget, least=0.0):
+    edges = np.geomspace(HIST_MIN, HIST_MAX, HIST_BINS + 1)
+    # Nodes over each edge
+    over = numInf + hist[::-1].cumsum()[::-1]
+    over = np.append(over, numInf)
+    leaves = numBlocks + 3 * over
+    ok = np.nonzero((2 * leaves <= budget) & (edges > least))[0]
+    if len(ok) == 0:
+        return float(HIST_MAX)
+    return float(edges[ok[0]])
+
+# The largest vertical distance between the triangles t, as an (n, 3, 3)
+# array of (column, row, elevation) corners, and the samples of data
+# under them, with data's top left sample at (x0, y0)
+# The triangles are scanned a row of samples at a time
+def triangle_error(t, data, x0, y0):
+    x = t[:, :, 0] - x0
+    y = t[:, :, 1] - y0
+    z = t[:, :, 2]
+    # Each triangle's plane, as z = z0 + a * (x - x0) + b * (y - y0)
+    ux, uy, uz = x[:, 1] - x[:, 0], y[:, 1] - y[:, 0], z[:, 1] - z[:, 0]
+    vx, vy, vz = x[:, 2] - x[:, 0], y[:, 2] - y[:, 0], z[:, 2] - z[:, 0]
+    nz = ux * vy - uy * vx
+    keep = nz != 0
+    x, y, z = x[keep], y[keep], z[keep]
+    a = (uz * vy - uy * vz)[keep] / nz[keep]
+    b = (ux * vz - uz * vx)[keep] / nz[keep]
+
+    # Every row each triangle crosses, and the columns it covers there
+    top = np.ceil(y.min(axis=1)).astype(np.int64)
+    rows = np.floor(y.max(axis=1)).astype(np.int64) - top + 1
+    tri = np.repeat(np.arange(len(x)), rows)
+    ry = ragged_range(top, rows)
+    left = np.full(len(ry), np.inf)
+    right = np.full(len(ry), -np.inf)
+    for i, j in ((0, 1), (1, 2), (2, 0)):
+        xa, ya, xb, yb = x[tri, i], y[tri, i], x[tri, j], y[tri, j]
+        crosses = (ry >= np.minimum(ya, yb)) & (ry <= np.maximum(ya, yb))
+        flat = ya == yb
+        xc = np.where(flat, xa, xa + (ry - ya) * (xb - xa) /
+                      np.where(flat, 1, yb - ya))
+        left = np.where(crosses, np.minimum(left, np.where(flat, np.minimum(xa, xb), xc)), left)
+        right = np.where(crosses, np.maximum(right, np.where(flat, np.maximum(xa, xb), xc)), right)
+    first = np.ceil(left - 1e-6).astype(np.int64)
+    cols = np.maximum(np.floor(right + 1e-6).astype(np.int64) - first + 1, 0)
+
+    tri = np.repeat(tri, cols)
+    py = np.repeat(ry, cols)
+    px = ragged_range(first, cols)
+    if len(px) == 0:
+        return 0.0
+    err = np.abs(z[tri, 0] + a[tri] * (px - x[tri, 0]) +
+                 b[tri] * (py - y[tri, 0]) - data[py, px])
+    return float(np.nanmax(err)) if np.isfinite(err).any() else 0.0
+
+# The largest vertical distance between a mesh's triangles and the
+# samples under them
+# Every triangle is inside a leaf, so inside one block, and they're
+# checked a block at a time
+def mesh_error(band, width, height, blockSize, nodata, verts, tris):
+    bw = int(math.ceil((width - 1) / float(blockSize)))
+    bh = int(math.ceil((height - 1) / float(blockSize)))
+    corners = verts[tris].astype(np.float64)
+    cx = np.minimum(corners[:, :, 0].mean(axis=1) // blockSize, bw - 1)
+    cy = np.minimum(corners[:, :, 1].mean(axis=1) // blockSize, bh - 1)
+    block = (cy * bw + cx).astype(np.int64)
+    order = np.argsort(block, kind='stable')
+    bounds = np.searchsorted(block[order], np.arange(bw * bh + 1))
+    worst = 0.0
+    for by in range(bh):
+        for bx in range(bw):
+            n = by * bw + bx
+            if bounds[n] == bounds[n + 1]:
+                continue
+            data = read_block(band, width, height, bx, by, blockSize, nodata)
+            worst = max(worst, triangle_error(
+                corners[order[bounds[n]:bounds[n + 1]]], data,
+                bx * blockSize, by * blockSize))
+    return worst
+
+# Make the mesh of band 1 of a dataset
+# Give either tolerance (meters), or budget (triangles)
+def build_mesh(dataset, tolerance=MAX_ERROR, budget=None,
+               blockSize=BLOCK_SIZE, minEle=None, maxEle=None):
+    band = dataset.GetRasterBand(1)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    nodata = band.GetNoDataValue()
+    bw = int(math.ceil((width - 1) / float(blockSize)))
+    bh = int(math.ceil((height - 1) / float(blockSize)))
+    blocks = [(bx, by) for by in range(bh) for bx in range(bw)]
+
+    if budget is not None:
+        hist = np.zeros(HIST_BINS, dtype=np.int64)
+        numInf = 0
+        for bx, by in blocks:
+            errors = node_errors(read_block(band, width, height, bx, by,
+                                            blockSize, nodata))
+            for size, err in errors.items():
+                if size == 1:
+                    continue
+                numInf += int(np.isinf(err).sum())
+                err = err[np.isfinite(err) & (err > HIST_MIN)]
+                hist += np.histogram(err, bins=np.geomspace(
+                    HIST_MIN, HIST_MAX, HIST_BINS + 1))[0]
+        target = budget
+        tolerance = budget_tolerance(hist, numInf, len(blocks), target)
+
+    while True:
+        verts, tris, lo, hi = mesh_blocks(band, width, height, blocks,
+                                          blockSize, nodata, tolerance)
+        # Fans next to smaller leaves are more than two triangles, so
+        # aim lower until the mesh fits
+        if budget is None or len(tris) <= budget or tolerance >= HIST_MAX:
+            break
+        target = target * budget // len(tris)
+        tolerance = budget_tolerance(hist, numInf, len(blocks), target,
+                                     tolerance)
+
+    if minEle is None:
+        minEle = lo
+    if maxEle is None:
+        maxEle = hi
+    maxError = mesh_error(band, width, height, blockSize, nodata, verts, tris)
+    return Mesh(verts, tris, width, height, minEle, maxEle,
+                tuple(dataset.GetGeoTransform()), maxError)
+
+# Make the triangles of the leaves of every block for a tolerance
+# Returns the vertices, triangles, and lowest and highest elevation
+def mesh_blocks(band, width, height, blocks, blockSize, nodata, tolerance):
+    # The corners of every leaf, and the leaves and the elevations at
+    # their centers, in grid coordinates
+    vx = list()
+    vy = list()
+    vz = list()
+    lx = list()
+    ly = list()
+    ls = list()
+    lz = list()
+    lo = math.inf
+    hi = -math.inf
+    for bx, by in blocks:
+        data = read_block(band, width, height, bx, by, blockSize, nodata)
+        if np.isfinite(data).any():
+            lo = min(lo, float(np.nanmin(data)))
+            hi = max(hi, float(np.nanmax(data)))
+        x, y, s = select_leaves(node_errors(data), tolerance)
+        for cx, cy in ((x, y), (x + s, y), (x, y + s), (x + s, y + s)):
+            vx.append(cx + bx * blockSize)
+            vy.append(cy + by * blockSize)
+            vz.append(data[cy, cx])
+        lx.append(x + bx * blockSize)
+        ly.append(y + by * blockSize)
+        ls.append(s)
+        lz.append(data[y + s // 2, x + s // 2])
+    data = None
+
+    verts, tris = triangulate(np.concatenate(vx), np.concatenate(vy),
+                              np.concatenate(vz), np.concatenate(lx),
+                              np.concatenate(ly), np.concatenate(ls),
+                              np.concatenate(lz), width, height)
+    return verts, tris, lo, hi
+
+# Turn quadtree leaves into triangles without T-junctions
+# vx, vy, vz are the leaves' corners (with repeats), and lx, ly, ls, lz
+# the leaves and the elevations at their centers
+# Each leaf is a square with its corners and any other vertices on its
+# edges from smaller neighbors, going clockwise from the top left.  If
+# it has a corner with no extra vertices on either side, it's a fan of
+# triangles from that corner, otherwise a fan from its center.
+def triangulate(vx, vy, vz, lx, ly, ls, lz, width, height):
+    rowStride = width + 1
+    colStride = height + 1
+    keys, first = np.unique(vy * rowStride + vx, return_index=True)
+    numGrid = len(keys)
+    # Vertex numbers in column order
+    colKeys = (keys % rowStride) * colStride + keys // rowStride
+    colOrder = np.argsort(colKeys)
+    colKeys = colKeys[colOrder]
+
+    def span(sortedKeys, startKeys, endKeys):
+        return (np.searchsorted(sortedKeys, startKeys),
+                np.searchsorted(sortedKeys, endKeys))
+
+    # Each edge is from its first corner up to, not including, the next
+    topLo, topHi = span(keys, ly * rowStride + lx, ly * rowStride + lx + ls)
+    rightLo, rightHi = span(colKeys, (lx + ls) * colStride + ly,
+                            (lx + ls) * colStride + ly + ls)
+    bottomLo, bottomHi = span(keys, (ly + ls) * rowStride + lx,
+                              (ly + ls) * rowStride + lx + ls)
+    leftLo, leftHi = span(colKeys, lx * colStride + ly,
+                          lx * colStride + ly + ls)
+    lengths = np.stack([topHi - topLo, rightHi - rightLo,
+                        bottomHi - bottomLo, leftHi - leftLo], axis=1)
+    segStarts = (np.cumsum(lengths.ravel()) - lengths.ravel()).reshape(-1, 4)
+    polys = np.empty(lengths.sum(), dtype=np.int64)
+    polys[ragged_range(segStarts[:, 0], lengths[:, 0])] = ragged_range(
+        topLo, lengths[:, 0])
+    polys[ragged_range(segStarts[:, 1], lengths[:, 1])] = colOrder[ragged_range(
+        rightLo, lengths[:, 1])]
+    polys[ragged_range(segStarts[:, 2], lengths[:, 2])] = ragged_range(
+        bottomHi, lengths[:, 2], -1)
+    polys[ragged_range(segStarts[:, 3], lengths[:, 3])] = colOrder[ragged_range(
+        leftHi, lengths[:, 3], -1)]
+    polyStart = segStarts[:, 0]
+    numPoly = lengths.sum(axis=1)
+
+    # Where the fan starts in each polygon, or -1 for a center fan
+    clean = lengths == 1
+    top, right, bottom, left = clean.T
+    corner = np.where(top & left, 0,
+                      np.where(top & right, lengths[:, 0],
+                               np.where(right & bottom,
+                                        lengths[:, 0] + lengths[:, 1],
+                                        np.where(bottom & left,
+                                                 numPoly - lengths[:, 3], -1))))
+
+    # Corner fans: (vp, vp+i, vp+i+1) for i from 1 to k-2
+    fan = np.nonzero(corner >= 0)[0]
+    count = numPoly[fan] - 2
+    i = ragged_range(np.ones(len(fan), dtype=np.int64), count)
+    p = np.repeat(corner[fan], count)
+    k = np.repeat(numPoly[fan], count)
+    start = np.repeat(polyStart[fan], count)
+    cornerTris = np.stack([polys[start + p], polys[start + (p + i) % k],
+                           polys[start + (p + i + 1) % k]], axis=1)
+
+    # Center fans: (c, vi, vi+1) for every edge of the polygon
+    fan = np.nonzero(corner < 0)[0]
+    count = numPoly[fan]
+    i = ragged_range(np.zeros(len(fan), dtype=np.int64), count)
+    k = np.repeat(numPoly[fan], count)
+    start = np.repeat(polyStart[fan], count)
+    centerTris = np.stack([np.repeat(numGrid + np.arange(len(fan)), count),
+                           polys[start + i], polys[start + (i + 1) % k]],
+                          axis=1)
+
+    verts = np.empty((numGrid + len(fan), 3), dtype=np.float32)
+    verts[:numGrid, 0] = keys % rowStride
+    verts[:numGrid, 1] = keys // rowStride
+    verts[:numGrid, 2] = vz[first]
+    verts[numGrid:, 0] = lx[fan] + ls[fan] // 2
+    verts[numGrid:, 1] = ly[fan] + ls[fan] // 2
+    verts[numGrid:, 2] = lz[fan]
+    return verts, np.concatenate([cornerTris, centerTris]).astype(np.uint32)
+
+# The vertices in hmrender's scene coordinates
+# A flat mesh is at height 0
+def scene_coordinates(mesh):
+    scale = 0.0
+    if mesh.maxEle > mesh.minEle:
+        scale = SCENE_HEIGHT / (mesh.maxEle - mesh.minEle)
+    verts = np.empty(mesh.verts.shape, dtype=np.float64)
+    verts[:, 0] = mesh.verts[:, 0] * (SCENE_SIZE / mesh.width) - SCENE_SIZE / 2
+    verts[:, 2] = mesh.verts[:, 1] * (SCENE_SIZE / mesh.height) - SCENE_SIZE / 2
+    verts[:, 1] = (mesh.verts[:, 2] - mesh.minEle) * scale
+    return verts
+
+def write_tmesh(fname, mesh):
+    with open(fname, 'wb') as outf:
+        outf.write(TMESH_HEADER.pack(TMESH_MAGIC, TMESH_VERSION, mesh.width,
+                                     mesh.height, len(mesh.verts),
+                                     len(mesh.tris), mesh.minEle, mesh.maxEle,
+                                     *mesh.geotransform))
+        outf.write(mesh.verts.astype('<f4').tobytes())
+        outf.write(mesh.tris.astype('<u4').tobytes())
+
+def read_tmesh(fname):
+    with open(fname, 'rb') as inf:
+        header = TMESH_HEADER.unpack(inf.read(TMESH_HEADER.size))
+        if header[0] != TMESH_MAGIC or header[1] != TMESH_VERSION:
+            raise ValueError('{} is not a terrain mesh'.format(fname))
+        width, height, numVerts, numTris, minEle, maxEle = header[2:8]
+        verts = np.fromfile(inf, dtype='<f4', count=numVerts * 3)
+        tris = np.fromfile(inf, dtype='<u4', count=numTris * 3)
+    return Mesh(verts.reshape(-1, 3), tris.reshape(-1, 3), width, height,
+                minEle, maxEle, header[8:])
+
+def write_obj(fname, mesh):
+    with open(fname, 'w') as outf:
+        outf.write('# {} vertices, {} triangles\n'.format(len(mesh.verts),
+                                                          len(mesh.tris)))
+        np.savetxt(outf, scene_coordinates(mesh), fmt='v %.4f %.4f %.4f')
+        np.savetxt(outf, mesh.tris.astype(np.int64) + 1, fmt='f %d %d %d')
+
+def write_rib(fname, mesh):
+    with open(fname, 'w') as outf:
+        outf.write('# {} vertices, {} triangles\n'.format(len(mesh.verts),
+                                                          len(mesh.tris)))
+        outf.write('PointsPolygons [\n')
+        outf.write('3 ' * len(mesh.tris))
+        outf.write('\n] [\n')
+        np.savetxt(outf, mesh.tris, fmt='%d %d %d')
+        outf.write('] "P" [\n')
+        np.savetxt(outf, scene_coordinates(mesh), fmt='%.4f %.4f %.4f')
+        outf.write(']\n')
+
+WRITERS = {'.tmesh': write_tmesh,
+           '.rib': write_rib,
+           '.obj': write_obj}
+
+def main(args):
+    tolerance = MAX_ERROR
+    budget = None
+    blockSize = BLOCK_SIZE
+    minEle = None
+    maxEle = None
+    rest = list()
+    for arg in args:
+        if arg.startswith('--error='):
+            tolerance = float(arg[len('--error='):])
+        elif arg.startswith('--budget='):
+            budget = int(arg[len('--budget='):])
+        elif arg.startswith('--block='):
+            blockSize = int(arg[len('--block='):])
+        elif arg.startswith('--min='):
+            minEle = float(arg[len('--min='):])
+        elif arg.startswith('--max='):
+            maxEle = float(arg[len('--max='):])
+        else:
+            rest.append(arg)
+    ext = rest[-1][rest[-1].rfind('.'):].lower() if rest else ''
+    if (len(rest) != 2 or ext not in WRITERS or blockSize < 2
+            or blockSize & (blockSize - 1)):
+        print('Syntax is:')
+        print('\t./terrainmesh.py [--error=meters | --budget=triangles] [--block=512]')
+        print('\t                 [--min=elevation] [--max=elevation]')
+        print('\t                 <arcgrid_or_geotiff> <output.tmesh|.rib|.obj>')
+        sys.exit(1)
+
+    gdal.UseExceptions()
+    start = time.time()
+    dataset = gdal.Open(rest[0])
+    mesh = build_mesh(dataset, tolerance, budget, blockSize, minEle, maxEle)
+    WRITERS[ext](rest[1], mesh)
+    full = 2 * (mesh.width - 1) * (mesh.height - 1)
+    print('{} vertices, {} triangles ({:.2f}% of the full grid), max error {:.3f} m, {:.1f} seconds'.format(
+        len(mesh.verts), len(mesh.tris), 100.0 * len(mesh.tris) / full,
+        mesh.maxError, time.time() - start))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# bench_catalog.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Benchmark the catalog's R*Tree queries against a plain table scan
+
+# Fills a scratch catalog with a synthetic set of 7.5 minute quads
+# (about as many as the USGS has for the whole country), then times
+# bounding box and point queries both ways.
+
+# Usage:
+#     ./bench_catalog.py [number_of_quads] [number_of_queries]
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import catalog
+
+# The same query as catalog.maps_in_bbox, without the R*Tree
+SCAN_QUERY = '''\
+select {cols} from maps
+    where se_longitude >= :minLon and se_longitude - {size} <= :maxLon
+      and se_latitude <= :maxLat and se_latitude + {size} >= :minLat
+'''.format(cols=', '.join(catalog.MAP_COLUMN_NAMES), size=catalog.QUAD_SIZE)
+
+# Make numQuads rows on a 7.5' grid over the lower 48
+def make_rows(numQuads):
+    cells = [(lon, lat) for lon in range(0, 464) for lat in range(0, 200)]
+    random.shuffle(cells)
+    rows = list()
+    for i, (lon, lat) in enumerate(cells[:numQuads]):
+        rows.append((i+1, 'Quad {}'.format(i+1), 'XX', 'DRG',
+                     24.0 + lat * catalog.QUAD_SIZE,
+                     -125.0 + (lon+1) * catalog.QUAD_SIZE,
+                     '', '', 'http://localhost/quad{}.tif'.format(i+1)))
+    return rows
+
+# Run queryFunc over every query and return the average time in ms
+def time_queries(queryFunc, queries):
+    start = time.perf_counter()
+    found = 0
+    for q in queries:
+        found += len(queryFunc(*q))
+    elapsed = time.perf_counter() - start
+    return 1000.0 * elapsed / len(queries), found
+
+def main(args):
+    numQuads = 57000
+    numQueries = 1000
+    if len(args)>0:
+        numQuads = int(args[0])
+    if len(args)>1:
+        numQueries = int(args[1])
+
+    tmpDir = tempfile.mkdtemp()
+    dbFileName = os.path.join(tmpDir, 'bench.db')
+    dbc = catalog.connect(dbFileName)
+
+    rows = make_rows(numQuads)
+    start = time.perf_counter()
+    with dbc:
+        catalog.sync_maps(dbc, rows)
+    print('Loaded {} quads in {:.2f}s'.format(len(rows),
+                                              time.perf_counter() - start))
+
+    # Bounding boxes about the size of a day's hike, and random points
+    boxes = list()
+    points = list()
+    for i in range(numQueries):
+        lon = random.uniform(-125.0, -67.0)
+        lat = random.uniform(24.0, 49.0)
+        boxes.append((lon, lat, lon + random.uniform(0.05, 0.5),
+                      lat + random.uniform(0.05, 0.5)))
+        points.append((lon, lat))
+
+    def scan_bbox(minLon, minLat, maxLon, maxLat):
+        return dbc.execute(SCAN_QUERY, dict(minLon=minLon, minLat=minLat,
+                                            maxLon=maxLon,
+                                            maxLat=maxLat)).fetchall()
+    def scan_point(lon, lat):
+        return scan_bbox(lon, lat, lon, lat)
+
+    def rtree_bbox(*bbox):
+        return catalog.maps_in_bbox(dbc, *bbox)
+    def rtree_point(*pt):
+        return catalog.maps_at_point(dbc, *pt)
+
+    for name, queries, scanFunc, rtreeFunc in (
+            ('bbox', boxes, scan_bbox, rtree_bbox),
+            ('point', points, scan_point, rtree_point)):
+        scanMs, scanFound = time_queries(scanFunc, queries)
+        rtreeMs, rtreeFound = time_queries(rtreeFunc, queries)
+        if scanFound != rtreeFound:
+            print('Mismatch! scan found {}, rtree found {}'.format(scanFound,
+                                                                   rtreeFound))
+        print('{:5s}  scan {:8.3f} ms  rtree {:8.3f} ms  speedup {:6.1f}x'.format(
+            name, scanMs, rtreeMs, scanMs / rtreeMs))
+
+    dbc.close()
+    for fn in os.listdir(tmpDir):
+        os.remove(os.path.join(tmpDir, fn))
+    os.rmdir(tmpDir)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
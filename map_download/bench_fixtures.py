@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# bench_fixtures.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Make synthetic elevation rasters for the benchmarks (see bench_suite.py)
+
+# Each fixture is a made up DEM, a few octaves of smoothed noise scaled
+# to Colorado-ish elevations with a ragged nodata margin along its west
+# edge like the collar of a real NED cell, so the nodata handling gets
+# exercised too.  Fixture i is put on the i-th 1x1 degree NED cell
+# counting east and then south from n41w109, and is written as:
+#   - a GeoTIFF, <name>.tif, in UTM zone 13 (NAD83) with 10 meter
+#     pixels, the way a DRG or a reprojected DEM would come in
+#   - an ArcGrid, <name>/grd<name>_13/hdr.adf, in NAD83 longitude and
+#     latitude with 1/3 arc second cells, laid out like the grids in
+#     the USGS NED archives
+# GDAL's ArcGrid driver can't write, so the .adf files are written
+# here directly: uncompressed 32 bit float blocks, which GDAL (and
+# ESRI) read like any other grid.  Only the GeoTIFFs need GDAL.
+
+# Usage:
+#     ./bench_fixtures.py [--count=N] [--size=WIDTHxHEIGHT]
+#                         [--formats=gtiff,arcgrid] [--seed=N]
+#                         <output_directory>
+
+import os
+import sys
+import math
+import struct
+import os.path
+import zipfile
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+    from osgeo import osr
+except ImportError:
+    try:
+        import gdal
+        import osr
+    except ImportError:
+        gdal = None
+
+import utm
+
+FORMATS = ('gtiff', 'arcgrid')
+
+# Elevation range of the fixtures, in meters
+MIN_ELEVATION = 1500.0
+MAX_ELEVATION = 4300.0
+
+# Average width of the nodata margin, as a fraction of the width
+NODATA_FRACTION = 0.02
+
+# Nodata value of the GeoTIFFs
+NODATA = -9999.0
+
+# And of float ArcGrids, which is always -FLT_MAX
+ARCGRID_NODATA = float(np.finfo(np.float32).min)
+
+# NED 1/3 arc second cells, in degrees
+NED_CELL_SIZE = 1.0 / 10800
+
+# Pixel size of the GeoTIFFs, in meters
+UTM_CELL_SIZE = 10.0
+UTM_ZONE = 13
+UTM_EPSG = 26913
+
+# The north west corner of the first fixture, and how many fixtures go
+# across before starting the next row of cells
+FIRST_CELL = (-109, 41)
+CELLS_PER_ROW = 7
+
+# ArcGrid blocks are 256x4 cells, 4096 bytes of floats, which keeps
+# them under the 64K shorts a block's size field can hold
+BLOCK_WIDTH = 256
+BLOCK_HEIGHT = 4
+
+# Magic number at the start of w001001.adf and w001001x.adf
+ADF_MAGIC = b'\x00\x00\x27\x0a\xff\xff\xfc\x14'
+ADF_HEADER_SIZE = 100
+
+# Projection of 1/3 arc second NED grids, in prj.adf
+NED_PRJ = '''\
+Projection    GEOGRAPHIC
+Datum         NAD83
+Zunits        METERS
+Units         DD
+Spheroid      GRS1980
+Xshift        0.0000000000
+Yshift        0.0000000000
+Parameters
+'''
+
+# Bilinearly stretch a small grid over width x height samples
+def upsample(grid, width, height):
+    xs = np.linspace(0, grid.shape[1]-1, width, dtype=np.float32)
+    ys = np.linspace(0, grid.shape[0]-1, height, dtype=np.float32)
+    x0 = np.minimum(xs.astype(np.int64), grid.shape[1]-2)
+    y0 = np.minimum(ys.astype(np.int64), grid.shape[0]-2)
+    fx = xs - x0
+    fy = (ys - y0)[:, np.newaxis]
+    rows = grid[:, x0] * (1 - fx) + grid[:, x0+1] * fx
+    return rows[y0] * (1 - fy) + rows[y0+1] * fy
+
+# A width x height array of made up elevations, NaN where there's no data
+# Each octave of noise has twice the frequency and half the amplitude of
+# the one before, down to features a few pixels across
+def terrain(width, height, seed=0, nodata=NODATA_FRACTION):
+    rng = np.random.RandomState(seed)
+    data = np.zeros((height, width), dtype=np.float32)
+    cells = 4
+    amplitude = 1.0
+    while cells <= max(4, min(width, height) // 4) and cells <= 1024:
+        grid = rng.rand(cells+1, cells+1).astype(np.float32)
+        data += amplitude * upsample(grid, width, height)
+        cells *= 2
+        amplitude *= 0.5
+    lo = data.min()
+    hi = data.max()
+    data -= lo
+    data *= (MAX_ELEVATION - MIN_ELEVATION) / max(hi - lo, 1e-6)
+    data += MIN_ELEVATION
+
+    if nodata > 0:
+        rows = np.arange(height) / float(height) * 6 * math.pi
+        edge = (nodata * width * (1 + 0.5*np.sin(rows))).astype(np.int64)
+        data[np.arange(width)[np.newaxis, :] < edge[:, np.newaxis]] = np.nan
+    return data
+
+# The NED name of the cell with its north west corner at lon, lat,
+# like n41w109
+def cell_name(lon, lat):
+    return '{}{:02d}{}{:03d}'.format('n' if lat >= 0 else 's', abs(lat),
+                                     'w' if lon < 0 else 'e', abs(lon))
+
+# The north west corner of fixture i
+def fixture_cell(i):
+    return FIRST_CELL[0] + i % CELLS_PER_ROW, FIRST_CELL[1] - i // CELLS_PER_ROW
+
+# Write data as a float GeoTIFF in UTM with its north west corner at
+# lon, lat
+def write_geotiff(fname, data, lon, lat, options=('TILED=YES',)):
+    zones, easting, northing = utm.to_utm(lon, lat, UTM_ZONE)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(UTM_EPSG)
+    height, width = data.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(fname, width, height, 1, gdal.GDT_Float32,
+                            list(options))
+    dataset.SetGeoTransform((float(easting), UTM_CELL_SIZE, 0.0,
+                             float(northing), 0.0, -UTM_CELL_SIZE))
+    dataset.SetProjection(srs.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(np.where(np.isnan(data), NODATA, data), 0, 0)
+    band = None
+    dataset = None
+
+# The 100 byte header of w001001.adf and w001001x.adf, for a file of
+# size bytes
+def adf_header(size):
+    header = bytearray(ADF_HEADER_SIZE)
+    header[:len(ADF_MAGIC)] = ADF_MAGIC
+    struct.pack_into('>i', header, 24, size // 2)
+    return bytes(header)
+
+# Write data as an uncompressed float ArcGrid in gridDir, with its
+# north west corner at west, north and cellSize degree cells
+def write_arcgrid(gridDir, data, west, north, cellSize=NED_CELL_SIZE):
+    if not os.path.exists(gridDir):
+        os.makedirs(gridDir)
+    height, width = data.shape
+    perRow = int(math.ceil(width / float(BLOCK_WIDTH)))
+    perColumn = int(math.ceil(height / float(BLOCK_HEIGHT)))
+
+    # Pad out to whole blocks and split into blocks, row by row
+    cells = np.full((perColumn * BLOCK_HEIGHT, perRow * BLOCK_WIDTH),
+                    ARCGRID_NODATA, dtype=np.float32)
+    cells[:height, :width] = np.where(np.isnan(data), ARCGRID_NODATA, data)
+    cells = cells.reshape(perColumn, BLOCK_HEIGHT, perRow, BLOCK_WIDTH)
+    cells = cells.transpose(0, 2, 1, 3).reshape(-1, BLOCK_HEIGHT, BLOCK_WIDTH)
+
+    # Each block is its size in shorts followed by big endian floats
+    blockBytes = BLOCK_WIDTH * BLOCK_HEIGHT * 4
+    blocks = np.empty(len(cells), dtype=[('size', '>u2'),
+                                         ('data', '>f4',
+                                          (BLOCK_HEIGHT, BLOCK_WIDTH))])
+    blocks['size'] = blockBytes // 2
+    blocks['data'] = cells
+    dataSize = ADF_HEADER_SIZE + blocks.nbytes
+    with open(os.path.join(gridDir, 'w001001.adf'), 'wb') as outf:
+        outf.write(adf_header(dataSize))
+        outf.write(blocks.tobytes())
+
+    # The index has the offset and size of every block, in shorts
+    index = np.empty((len(cells), 2), dtype='>i4')
+    index[:, 0] = (ADF_HEADER_SIZE + np.arange(len(cells)) * (blockBytes+2)) // 2
+    index[:, 1] = blockBytes // 2
+    with open(os.path.join(gridDir, 'w001001x.adf'), 'wb') as outf:
+        outf.write(adf_header(ADF_HEADER_SIZE + index.nbytes))
+        outf.write(index.tobytes())
+
+    # Cell type 2 is float
+    header = bytearray(308)
+    header[:8] = b'GRID1.2\x00'
+    struct.pack_into('>ii', header, 16, 2, 0)
+    struct.pack_into('>4d', header, 256, cellSize, cellSize, west, north)
+    struct.pack_into('>5i', header, 288, perRow, perColumn, BLOCK_WIDTH, 1,
+                     BLOCK_HEIGHT)
+    with open(os.path.join(gridDir, 'hdr.adf'), 'wb') as outf:
+        outf.write(bytes(header))
+
+    with open(os.path.join(gridDir, 'dblbnd.adf'), 'wb') as outf:
+        outf.write(struct.pack('>4d', west, north - height * cellSize,
+                               west + width * cellSize, north))
+
+    valid = data[~np.isnan(data)]
+    if len(valid) == 0:
+        valid = np.zeros(1)
+    with open(os.path.join(gridDir, 'sta.adf'), 'wb') as outf:
+        outf.write(struct.pack('>4d', float(valid.min()), float(valid.max()),
+                               float(valid.mean()), float(valid.std())))
+
+    with open(os.path.join(gridDir, 'prj.adf'), 'w') as outf:
+        outf.write(NED_PRJ)
+    return os.path.join(gridDir, 'hdr.adf')
+
+# Zip up the ArcGrid with hdr.adf at gridPath the way the USGS packages
+# NED cells, with the grid's directory at the top of the archive
+def zip_arcgrid(gridPath, zipPath):
+    gridDir = os.path.dirname(gridPath)
+    top = os.path.dirname(gridDir)
+    with zipfile.ZipFile(zipPath + '.tmp', 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(os.listdir(gridDir)):
+            path = os.path.join(gridDir, name)
+            zf.write(path, os.path.relpath(path, top))
+    os.replace(zipPath + '.tmp', zipPath)
+    return zipPath
+
+# Make count width x height fixtures in outDir
+# Returns a dictionary of format name to the list of files written
+# GeoTIFFs are left out if GDAL isn't installed
+def make_fixtures(outDir, count=4, width=2048, height=2048, formats=FORMATS,
+                  seed=0):
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    made = dict((fmt, list()) for fmt in formats)
+    for i in range(count):
+        lon, lat = fixture_cell(i)
+        name = cell_name(lon, lat)
+        data = terrain(width, height, seed + i)
+        if 'gtiff' in formats and gdal is not None:
+            fname = os.path.join(outDir, name + '.tif')
+            write_geotiff(fname, data, lon, lat)
+            made['gtiff'].append(fname)
+        if 'arcgrid' in formats:
+            gridDir = os.path.join(outDir, name, 'grd{}_13'.format(name))
+            made['arcgrid'].append(write_arcgrid(gridDir, data, lon, lat))
+    return made
+
+def main(args):
+    count = 4
+    width = height = 2048
+    formats = FORMATS
+    seed = 0
+    rest = list()
+    for arg in args:
+        if arg.startswith('--count='):
+            count = int(arg[len('--count='):])
+        elif arg.startswith('--size='):
+            size = arg[len('--size='):].lower().split('x')
+            width = int(size[0])
+            height = int(size[-1])
+        elif arg.startswith('--formats='):
+            formats = arg[len('--formats='):].split(',')
+        elif arg.startswith('--seed='):
+            seed = int(arg[len('--seed='):])
+        else:
+            rest.append(arg)
+    if len(rest)!=1 or any(fmt not in FORMATS for fmt in formats):
+        print('Syntax is:')
+        print('\t./bench_fixtures.py [--count=N] [--size=WIDTHxHEIGHT]')
+        print('\t                    [--formats=gtiff,arcgrid] [--seed=N]')
+        print('\t                    <output_directory>')
+        sys.exit(1)
+    if 'gtiff' in formats and gdal is None:
+        print('GDAL is not installed, so there won\'t be any GeoTIFFs')
+    made = make_fixtures(rest[0], count, width, height, formats, seed)
+    for fmt in formats:
+        for fname in made[fmt]:
+            print(fname)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+# bench_servers.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Local stand-ins for libremap.org and gisdata.usgs.gov
+
+# The benchmarks (see bench_suite.py) can't hammer the real servers, and
+# the real servers are too slow and too variable to time anything
+# against anyway.  These serve pages shaped like the real ones, close
+# enough for mapdown.py's and nedresolve.py's parsers, from memory.
+
+# LibremapSite serves a state's DRG index page, with a heading row of
+# headleftstyle cells and a row of leftstyle cells and a link to the
+# .tif for every map, and an ETag and Last-Modified so a resync gets a
+# 304.  Every .tif is the same payload, with HEAD and Range support so
+# the downloader can check sizes and resume.
+
+# UsgsSite goes through the NED download dance:
+#   - the first request for the index has no session, and gets an
+#     "Object moved" page linking to the same URL with a cookieless
+#     ASP.NET (S(...)) session in it
+#   - the index has a description row for each of several formats, and
+#     under it a link for every 1x1 degree cell in the bounding box,
+#     with the same unquoted onclick attributes as the real page
+#   - a cell's download page says to wait the first few times it's
+#     loaded, like while the tape library finds the data, and then has
+#     a downloadID link
+#   - which gets the .zip
+# Every response can be held back by a delay, to stand in for the round
+# trip to a faraway server.
+
+# Usage:
+#     ./bench_servers.py [--port=N] [--bind=address] [--delay=ms] [--log]
+#                        libremap [--maps=N] [--tif-size=KB]
+#     ./bench_servers.py [--port=N] [--bind=address] [--delay=ms] [--log]
+#                        usgs [--polls=N] [--size=WIDTHxHEIGHT | file.zip]
+#         Then point mapdown.py or neddown.py at it with --host=address:port
+
+import os
+import re
+import sys
+import html
+import math
+import time
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import email.utils
+import http.server
+import urllib.parse
+
+import numpy as np
+
+import catalog
+import nedresolve
+import bench_fixtures
+
+LIBREMAP_PORT = 8080
+USGS_PORT = 8081
+
+# The date every stand-in page was last modified
+LAST_MODIFIED = email.utils.formatdate(1300000000, usegmt=True)
+
+# Index page headings, the same ones catalog.MAP_COLUMNS reads
+HEADINGS = [heading for col, heading, conv in catalog.MAP_COLUMNS
+            if heading != 'url']
+
+# Formats listed for every NED cell, as (description, code)
+NED_FORMATS = [('National Elevation Dataset (1 arc second) Pre-packaged ArcGrid format', '1arcg'),
+               (nedresolve.WANTED_FORMAT, '13arcg'),
+               ('National Elevation Dataset (1/3 arc second) Pre-packaged GridFloat format', '13grdf')]
+
+# The (S(...)) session in a path
+SESSION_RX = re.compile(r'/\(S\(([^)]*)\)\)')
+
+# Pages are sent in pieces this big
+CHUNK_SIZE = 256 * 1024
+
+# Some incompressible bytes to stand in for a file
+def random_payload(size, seed=0):
+    return np.random.RandomState(seed).bytes(size)
+
+# A libremap.org look-alike for one state's DRGs
+class LibremapSite(object):
+    def __init__(self, state='colorado', count=500, payload=b''):
+        self.state = state
+        self.count = count
+        self.payload = payload
+        self.indexPath = '/data/state/{}/drg/'.format(state)
+        self.pages = dict()
+        self.lock = threading.Lock()
+
+    # The .tif URL path of map i
+    def tif_path(self, i):
+        return '{}drg{:06d}.tif'.format(self.indexPath, i+1)
+
+    # The index page as linked from host, and its ETag
+    # The maps are 7.5' quads going east and then north from the south
+    # west corner of the lower 48
+    def index(self, host):
+        with self.lock:
+            if host in self.pages:
+                return self.pages[host]
+            lines = ['<html><head><title>DRG maps for {}</title></head>'.format(
+                         html.escape(self.state)),
+                     '<body><table>',
+                     '<tr>' + ''.join('<td class="headleftstyle">{}</td>'.format(h)
+                                      for h in HEADINGS) + '<td>Download</td></tr>']
+            for i in range(self.count):
+                lon = -125.0 + (i % 464 + 1) * catalog.QUAD_SIZE
+                lat = 24.0 + (i // 464) * catalog.QUAD_SIZE
+                values = [i+1, 'Quad {}'.format(i+1), 'CO', 'DRG',
+                          '{:.3f}'.format(lat), '{:.3f}'.format(lon), '24000',
+                          'DRG{:06d}'.format(i+1)]
+                url = 'http://{}{}'.format(host, self.tif_path(i))
+                lines.append('<tr>' + ''.join('<td class="leftstyle">{}</td>'.format(v)
+                                              for v in values) +
+                             '<td><a href="{}">{}</a></td></tr>'.format(
+                                 url, os.path.basename(url)))
+            lines.append('</table></body></html>')
+            body = '\n'.join(lines).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+            self.pages[host] = (body, etag)
+            return body, etag
+
+# A gisdata.usgs.gov look-alike that hands out payload for every NED
+# cell, after polls "please wait" pages
+class UsgsSite(object):
+    def __init__(self, payload=b'', polls=2):
+        self.payload = payload
+        self.polls = polls
+        self.sessions = set()
+        self.loads = dict()
+        self.downloads = dict()
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        sessionID = os.urandom(12).hex()
+        with self.lock:
+            self.sessions.add(sessionID)
+        return sessionID
+
+    def has_session(self, sessionID):
+        with self.lock:
+            return sessionID in self.sessions
+
+    # Count another load of a cell's download page
+    # Returns its downloadID once it's been loaded more than polls times,
+    # otherwise None
+    def load(self, sessionID, cell, fmt):
+        key = (sessionID, cell, fmt)
+        with self.lock:
+            self.loads[key] = self.loads.get(key, 0) + 1
+            if self.loads[key] <= self.polls:
+                return None
+            if key not in self.downloads:
+                self.downloads[key] = len(self.downloads) + 1
+            return self.downloads[key]
+
+    # The names of the NED cells covering a bounding box, north to south
+    # NED cells are named after their north west corners
+    def cells(self, xmin, ymin, xmax, ymax):
+        names = list()
+        for lat in range(int(math.ceil(ymax)), int(math.floor(ymin)), -1):
+            for lon in range(int(math.floor(xmin)), int(math.ceil(xmax))):
+                names.append(bench_fixtures.cell_name(lon, lat))
+        return names
+
+    def index(self, query):
+        try:
+            bbox = [float(query[key][0]) for key in ('XMin', 'YMin', 'XMax', 'YMax')]
+        except (KeyError, ValueError):
+            bbox = [0.0, 0.0, 0.0, 0.0]
+        names = self.cells(*bbox)
+        lines = ['<html><head><title>TDDS Download URLs</title></head>',
+                 '<body><table>']
+        for desc, fmt in NED_FORMATS:
+            lines.append('<tr><td>{}</td></tr>'.format(html.escape(desc)))
+            for name in names:
+                # The onclick attributes really aren't quoted
+                lines.append('<tr><td><a href="#" onclick=window.open(\'TDDSDownload.aspx?cell={}&amp;fmt={}\',\'downloadWin\',\'left=100,top=100,width=600,height=500\'); return false;>{}</a></td></tr>'.format(name, fmt, name))
+        lines.append('</table></body></html>')
+        return '\n'.join(lines)
+
+# What both stand-ins have in common
+# Subclasses implement route(path, query, head)
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request(False)
+
+    def do_HEAD(self):
+        self.handle_request(True)
+
+    def handle_request(self, head):
+        if self.server.delay > 0:
+            time.sleep(self.server.delay)
+        url = urllib.parse.urlsplit(self.path)
+        self.route(urllib.parse.unquote(url.path),
+                   urllib.parse.parse_qs(url.query), head)
+
+    def send_page(self, code, body, head=False, contentType='text/html',
+                  headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_not_found(self, head=False):
+        self.send_page(404, '<html><body>Not found</body></html>', head)
+
+    # Send a file's contents, or the part of it a "bytes=N-" Range
+    # header asks for
+    def send_payload(self, payload, head=False, contentType='image/tiff'):
+        size = len(payload)
+        start = 0
+        rng = self.headers.get('Range')
+        if rng is not None and rng.startswith('bytes=') and rng.endswith('-'):
+            try:
+                start = int(rng[len('bytes='):-1])
+            except ValueError:
+                start = 0
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, size-1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.end_headers()
+        if head:
+            return
+        view = memoryview(payload)
+        for offset in range(start, size, CHUNK_SIZE):
+            self.wfile.write(view[offset:offset+CHUNK_SIZE])
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            super(StandInHandler, self).log_message(format, *args)
+
+class LibremapHandler(StandInHandler):
+    server_version = 'libremap-standin/1.0'
+
+    def route(self, path, query, head):
+        site = self.server.site
+        if path == site.indexPath:
+            body, etag = site.index(self.headers.get('Host', 'localhost'))
+            headers = {'ETag': etag, 'Last-Modified': LAST_MODIFIED}
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            self.send_page(200, body, head, headers=headers)
+        elif path.startswith(site.indexPath) and path.endswith('.tif'):
+            self.send_payload(site.payload, head)
+        else:
+            self.send_not_found(head)
+
+class UsgsHandler(StandInHandler):
+    server_version = 'Microsoft-IIS/6.0'
+
+    # Send an "Object moved" page pointing at the same page in a new
+    # session
+    def send_moved(self, path, head):
+        sessionID = self.server.site.new_session()
+        page = path.replace('/XMLWebServices2/',
+                            '/XMLWebServices2/(S({}))/'.format(sessionID), 1)
+        url = urllib.parse.quote(page, safe='/')
+        if '?' in self.path:
+            url += '?' + self.path.split('?', 1)[1]
+        self.send_page(200, '<html><head><title>Object moved</title></head>'
+                       '<body><h2>Object moved to <a href="{}">here</a>.</h2>'
+                       '</body></html>'.format(html.escape(url)), head)
+
+    def route(self, path, query, head):
+        site = self.server.site
+        mtch = SESSION_RX.search(path)
+        sessionID = None
+        if mtch is not None:
+            sessionID = mtch.group(1)
+            path = path[:mtch.start()] + path[mtch.end():]
+        if path == '/XMLWebServices2/download.aspx':
+            self.send_payload(site.payload, head, 'application/zip')
+        elif path in ('/XMLWebServices2/getTDDSDownloadURLs.aspx',
+                      '/XMLWebServices2/TDDSDownload.aspx'):
+            if sessionID is None or not site.has_session(sessionID):
+                self.send_moved(path, head)
+            elif path.endswith('getTDDSDownloadURLs.aspx'):
+                self.send_page(200, site.index(query), head)
+            else:
+                cell = query.get('cell', [''])[0]
+                downloadID = site.load(sessionID, cell,
+                                       query.get('fmt', [''])[0])
+                if downloadID is None:
+                    self.send_page(200, '<html><head><title>Please wait</title>'
+                                   '<meta http-equiv="refresh" content="5"></head>'
+                                   '<body>Your data is being prepared. '
+                                   '<a href="TDDSHelp.aspx">Help</a></body></html>',
+                                   head)
+                else:
+                    self.send_page(200, '<html><head><title>Download</title></head>'
+                                   '<body><a href="download.aspx?downloadID={}">'
+                                   '{}.zip</a></body></html>'.format(downloadID,
+                                                                     html.escape(cell)),
+                                   head)
+        else:
+            self.send_not_found(head)
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, handlerClass, site, delay=0.0, log=False):
+        super(StandInServer, self).__init__(address, handlerClass)
+        self.site = site
+        self.delay = delay
+        self.log = log
+
+    def get_request(self):
+        conn, addr = super(StandInServer, self).get_request()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, addr
+
+    # The address to give --host=, like localhost:8080
+    def host(self):
+        return '{}:{}'.format(self.server_address[0], self.server_address[1])
+
+# Start a stand-in in a background thread
+# Port 0 picks a free one, see StandInServer.host
+def start_server(handlerClass, site, port=0, bind='127.0.0.1', delay=0.0,
+                 log=False):
+    server = StandInServer((bind, port), handlerClass, site, delay, log)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Make a NED archive of a synthetic width x height grid, in memory
+def ned_payload(width, height):
+    tmpDir = tempfile.mkdtemp()
+    try:
+        made = bench_fixtures.make_fixtures(tmpDir, 1, width, height,
+                                            ('arcgrid',))
+        zipPath = bench_fixtures.zip_arcgrid(made['arcgrid'][0],
+                                             os.path.join(tmpDir, 'ned.zip'))
+        with open(zipPath, 'rb') as inf:
+            return inf.read()
+    finally:
+        shutil.rmtree(tmpDir)
+
+def main(args):
+    port = None
+    bind = '127.0.0.1'
+    delay = 0.0
+    log = False
+    maps = 500
+    tifSize = 4096
+    polls = 2
+    width = height = 1024
+    rest = list()
+    for arg in args:
+        if arg.startswith('--port='):
+            port = int(arg[len('--port='):])
+        elif arg.startswith('--bind='):
+            bind = arg[len('--bind='):]
+        elif arg.startswith('--delay='):
+            delay = float(arg[len('--delay='):]) / 1000.0
+        elif arg == '--log':
+            log = True
+        elif arg.startswith('--maps='):
+            maps = int(arg[len('--maps='):])
+        elif arg.startswith('--tif-size='):
+            tifSize = int(arg[len('--tif-size='):])
+        elif arg.startswith('--polls='):
+            polls = int(arg[len('--polls='):])
+        elif arg.startswith('--size='):
+            size = arg[len('--size='):].lower().split('x')
+            width = int(size[0])
+            height = int(size[-1])
+        else:
+            rest.append(arg)
+    if len(rest) not in (1, 2) or rest[0] not in ('libremap', 'usgs') or \
+       (rest[0] == 'libremap' and len(rest) != 1):
+        print('Syntax is:')
+        print('\t./bench_servers.py [--port=N] [--bind=address] [--delay=ms] [--log]')
+        print('\t                   libremap [--maps=N] [--tif-size=KB]')
+        print('\t./bench_servers.py [--port=N] [--bind=address] [--delay=ms] [--log]')
+        print('\t                   usgs [--polls=N] [--size=WIDTHxHEIGHT | file.zip]')
+        sys.exit(1)
+
+    if rest[0] == 'libremap':
+        site = LibremapSite(count=maps, payload=random_payload(tifSize * 1024))
+        handlerClass = LibremapHandler
+        if port is None:
+            port = LIBREMAP_PORT
+    else:
+        if len(rest) == 2:
+            with open(rest[1], 'rb') as inf:
+                payload = inf.read()
+        else:
+            payload = ned_payload(width, height)
+        site = UsgsSite(payload, polls)
+        handlerClass = UsgsHandler
+        if port is None:
+            port = USGS_PORT
+
+    server = StandInServer((bind, port), handlerClass, site, delay, log)
+    print('Serving {} on {}'.format(rest[0], server.host()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__=='__main__':
+    main(sys.argv[1:])
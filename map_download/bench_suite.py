@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+
+# bench_suite.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Benchmark every stage of getting maps and elevation data, end to end
+
+# Makes synthetic rasters (see bench_fixtures.py), starts local
+# stand-ins for libremap.org and gisdata.usgs.gov (see bench_servers.py)
+# and times each stage against them:
+#   index      scraping and syncing a libremap index page, like mapdown.py
+#   download   downloading the maps on it with the download scheduler
+#   resolve    getting the NED index and polling every download page
+#              until it has a link, like neddown.py
+#   neddown    all of neddown.py, resolving and downloading the archives
+#   mapdb      reading the fixtures with GDAL, one at a time and with
+#              mapdb.py --harvest, then a rescan with nothing changed
+#   pyramid    building a tile pyramid, then rebuilding it unchanged
+#   hillshade  shading the fixture into tiles
+#   viewtile   starting viewtile.py on the pyramid and panning around
+# The last three need the tiler directory in PYTHONPATH.
+# Each stage runs in a fresh process, so its peak RSS is its own, and
+# reports its throughput, the latency percentiles of its operations and
+# its peak RSS (and that of its worker processes).  Stages that need
+# GDAL or PyQt4 are skipped if they aren't installed.
+
+# The results are written as JSON, and --compare reads two of those and
+# flags anything that got more than --threshold percent worse, with an
+# exit status of 1 if anything did.  So a baseline can be kept and
+# checked against after every change.
+
+# Usage:
+#     ./bench_suite.py [--stages=index,download,...] [--output=file.json]
+#                      [--work-dir=directory] [--repeat=N] [--seed=N]
+#                      [--fixtures=N] [--size=WIDTHxHEIGHT] [--workers=N]
+#                      [--maps=N] [--tif-size=KB] [--per-host=N]
+#                      [--bbox=xmin,ymin,xmax,ymax] [--ned-size=WIDTHxHEIGHT]
+#                      [--polls=N] [--poll=seconds] [--resolvers=N]
+#                      [--delay=ms] [--frames=N]
+#     ./bench_suite.py --compare [--threshold=percent] <old.json> <new.json>
+# The JSON goes to stdout unless --output is given, and progress to
+# stderr.  The work directory is deleted afterwards unless it's given.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import os.path
+import platform
+import tempfile
+import importlib
+import traceback
+import contextlib
+import subprocess
+import http.client
+import resource
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+
+import catalog
+import fetcher
+import mapdown
+import scheduler
+import nedresolve
+import bench_servers
+import bench_fixtures
+
+# Version of the JSON layout
+RESULTS_VERSION = 1
+
+# Metrics compared by --compare, and whether bigger is better
+COMPARED = [('per_second', True),
+            ('mb_per_second', True),
+            ('latency_ms.p50', False),
+            ('latency_ms.p99', False),
+            ('peak_rss_kb', False)]
+
+# Raised by a stage that can't run here
+class SkipStage(Exception):
+    pass
+
+# Import one of the tilers (pyramid.py, hillshade.py and viewtile.py),
+# which can be found with the tiler directory in PYTHONPATH
+# The stage is skipped if it isn't there
+def import_tiler(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError as err:
+        if err.name != name:
+            raise
+        raise SkipStage('{}.py is not in PYTHONPATH'.format(name))
+
+# Peak resident set size of this process in kB
+# ru_maxrss would do, except that Linux carries it over from the process
+# that started this one, so a new process already has its parent's peak.
+# VmHWM starts over with the new program.
+def peak_rss():
+    try:
+        with open('/proc/self/status') as inf:
+            for line in inf:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on Mac OS X, kB everywhere else
+        rss //= 1024
+    return rss
+
+# Peak resident set size in kB of the biggest child process that has
+# finished, like the worker processes of a pool
+def peak_children_rss():
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+# Mean and percentiles of a list of times in seconds, in milliseconds
+def latency_stats(latencies):
+    if not latencies:
+        return None
+    ms = np.array(latencies, dtype=np.float64) * 1000.0
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return dict(n=len(ms), mean=float(ms.mean()), min=float(ms.min()),
+                p50=float(p50), p90=float(p90), p99=float(p99),
+                max=float(ms.max()))
+
+# The result of a stage that got count units done in seconds
+# latencies are the times of its operations, each one a latencyOf
+# (a page, a file, a frame, ...), and nbytes is how much data it moved
+def summarize(count, unit, seconds, latencies, latencyOf, nbytes=None,
+              errors=0, **extra):
+    result = dict(count=count, unit=unit, seconds=seconds, errors=errors,
+                  per_second=count / seconds if seconds > 0 else None)
+    if nbytes is not None:
+        result['bytes'] = nbytes
+        result['mb_per_second'] = None
+        if seconds > 0:
+            result['mb_per_second'] = nbytes / (1024.0 * 1024.0) / seconds
+    result['latency_of'] = latencyOf
+    result['latency_ms'] = latency_stats(latencies)
+    result.update(extra)
+    return result
+
+# A directory of a stage's own, emptied first
+def stage_dir(config, name):
+    path = os.path.join(config['work_dir'], name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+# The raster the tilers work on
+def tiler_source(config):
+    sources = config['gtiff'] + config['arcgrid']
+    if not sources:
+        raise SkipStage('No fixtures')
+    return sources[0]
+
+# A download scheduler that keeps the time each file took to transfer,
+# not counting the time it waited for a connection
+class TimedScheduler(scheduler.DownloadScheduler):
+    def __init__(self, *args, **kwargs):
+        super(TimedScheduler, self).__init__(*args, **kwargs)
+        self.fetchTimes = list()
+
+    def _fetch(self, job):
+        start = time.perf_counter()
+        nbytes = super(TimedScheduler, self)._fetch(job)
+        self.fetchTimes.append(time.perf_counter() - start)
+        return nbytes
+
+# A resolver that keeps the time each URL took in its NED
+class TimedResolver(nedresolve.Resolver):
+    def _resolve(self, ned):
+        start = time.perf_counter()
+        result = super(TimedResolver, self)._resolve(ned)
+        ned['resolve_seconds'] = time.perf_counter() - start
+        return result
+
+# Get, parse and sync the index page config['repeat'] times, each time
+# into a new catalog, and then once more with the ETag, for the 304
+def bench_index(config):
+    host = config['libremap']
+    indexPath = '/data/state/{}/drg/'.format(config['state'])
+    scratch = stage_dir(config, 'index')
+    latencies = list()
+    rows = 0
+    nbytes = 0
+    etag = None
+    start = time.perf_counter()
+    for i in range(config['repeat']):
+        begin = time.perf_counter()
+        dbc = catalog.connect(os.path.join(scratch, 'index{}.db'.format(i)))
+        conn = http.client.HTTPConnection(host)
+        conn.request('GET', indexPath)
+        resp = conn.getresponse()
+        mapSync = catalog.MapSync(dbc)
+
+        def handle_row(tiff):
+            mapSync.add(catalog.map_row(tiff))
+        with dbc:
+            mapdown.feed_response(mapdown.MyHTMLParser(handle_row), resp)
+            mapSync.finish()
+        conn.close()
+        dbc.close()
+        latencies.append(time.perf_counter() - begin)
+        rows += len(mapSync.seen)
+        nbytes += int(resp.getheader('Content-Length', 0))
+        etag = resp.getheader('ETag')
+    elapsed = time.perf_counter() - start
+
+    begin = time.perf_counter()
+    conn = http.client.HTTPConnection(host)
+    conn.request('GET', indexPath, headers={'If-None-Match': etag})
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    unchanged = time.perf_counter() - begin
+    if resp.status != 304:
+        raise ValueError('Expected a 304 for an unchanged index, got {}'.format(
+            resp.status))
+    return summarize(rows, 'rows', elapsed, latencies, 'page', nbytes,
+                     unchanged_ms=unchanged * 1000.0)
+
+# Download every map on the index page
+def bench_download(config):
+    # Getting the URLs isn't part of the time
+    conn = http.client.HTTPConnection(config['libremap'])
+    conn.request('GET', '/data/state/{}/drg/'.format(config['state']))
+    parser = mapdown.MyHTMLParser()
+    mapdown.feed_response(parser, conn.getresponse())
+    conn.close()
+
+    outDir = stage_dir(config, 'download')
+    sched = TimedScheduler(perHost=config['per_host'], retries=0)
+    for tiff in parser.tiffs:
+        sched.add(tiff['url'], mapdown.img_file_name(tiff['url'], outDir))
+    sched.close()
+    start = time.perf_counter()
+    results = sched.run(report=None)
+    elapsed = time.perf_counter() - start
+    failed = [r for r in results if not r.ok]
+    for r in failed:
+        print(r)
+    return summarize(len(results) - len(failed), 'files', elapsed,
+                     sched.fetchTimes, 'file', sum(r.nbytes for r in results),
+                     len(failed))
+
+# Get the NED index and the NEDs' download pages
+def ned_download_pages(config, outDir, pool):
+    start = time.perf_counter()
+    neds, sessionID = nedresolve.fetch_index(*config['bbox'],
+                                             host=config['usgs'], pool=pool)
+    indexTime = time.perf_counter() - start
+    toDownload = nedresolve.download_pages(neds, sessionID, outDir,
+                                           config['usgs'])
+    if not toDownload:
+        raise ValueError('No NEDs in the index')
+    return toDownload, indexTime
+
+# Resolve the download URL of every NED in the bounding box
+def bench_resolve(config):
+    pool = fetcher.ConnectionPool(maxIdle=config['resolvers'])
+    toDownload, indexTime = ned_download_pages(
+        config, stage_dir(config, 'resolve'), pool)
+    resolver = TimedResolver(config['resolvers'], config['polls'] + 10,
+                             config['poll_interval'], pool)
+    start = time.perf_counter()
+    results = list(resolver.resolve(toDownload))
+    elapsed = time.perf_counter() - start
+    pool.close()
+    errors = [err for ned, url, err in results if err is not None]
+    for err in errors:
+        print(err)
+    return summarize(len(results) - len(errors), 'urls', elapsed,
+                     [ned['resolve_seconds'] for ned, url, err in results],
+                     'url', errors=len(errors), index_ms=indexTime * 1000.0,
+                     polls=config['polls'])
+
+# Resolve and download every NED in the bounding box, the way
+# neddown.py does
+def bench_neddown(config):
+    outDir = stage_dir(config, 'neddown')
+    start = time.perf_counter()
+    resolver = nedresolve.Resolver(config['resolvers'], config['polls'] + 10,
+                                   config['poll_interval'])
+    toDownload, indexTime = ned_download_pages(config, outDir, resolver.pool)
+    sched = TimedScheduler(perHost=config['per_host'], retries=0)
+    sched.start(report=None)
+
+    # The same file names neddown.py uses
+    def ned_file_name(ned):
+        return os.path.join(ned['out_dir'], ned['name'] + '.zip')
+    failed = resolver.feed(toDownload, sched, ned_file_name)
+    results = sched.join()
+    elapsed = time.perf_counter() - start
+    resolver.pool.close()
+    failed += [r for r in results if not r.ok]
+    for r in failed:
+        print(r)
+    return summarize(len(results) - len(failed), 'archives', elapsed,
+                     sched.fetchTimes, 'file', sum(r.nbytes for r in results),
+                     len(failed), index_ms=indexTime * 1000.0)
+
+# Read every fixture, then harvest them all into a catalog, then
+# harvest again with nothing changed
+def bench_mapdb(config):
+    import mapdb
+    files = list(mapdb.find_rasters(config['fixture_dir']))
+    if not files:
+        raise SkipStage('No fixtures')
+    latencies = list()
+    for path, size, mtime in files:
+        begin = time.perf_counter()
+        mapdb.harvest_file(path)
+        latencies.append(time.perf_counter() - begin)
+
+    dbFileName = os.path.join(stage_dir(config, 'mapdb'), 'catalog.db')
+    start = time.perf_counter()
+    errors = mapdb.harvest(dbFileName, config['fixture_dir'],
+                           config['workers'])
+    elapsed = time.perf_counter() - start
+    begin = time.perf_counter()
+    mapdb.harvest(dbFileName, config['fixture_dir'], config['workers'])
+    rescan = time.perf_counter() - begin
+    return summarize(len(files) - len(errors), 'files', elapsed, latencies,
+                     'file', sum(size for path, size, mtime in files),
+                     len(errors), rescan_ms=rescan * 1000.0)
+
+# Build a pyramid from scratch config['repeat'] times, then rebuild the
+# last one, which shouldn't have anything to do
+def bench_pyramid(config):
+    pyramid = import_tiler('pyramid')
+    source = tiler_source(config)
+    scratch = stage_dir(config, 'pyramid')
+    latencies = list()
+    tiles = 0
+    outDir = None
+    start = time.perf_counter()
+    for i in range(config['repeat']):
+        outDir = os.path.join(scratch, 'tiles{}'.format(i))
+        begin = time.perf_counter()
+        written, skipped = pyramid.build(outDir, source, config['workers'])
+        latencies.append(time.perf_counter() - begin)
+        tiles += written
+    elapsed = time.perf_counter() - start
+    begin = time.perf_counter()
+    written, skipped = pyramid.build(outDir, source, config['workers'])
+    rebuild = time.perf_counter() - begin
+    return summarize(tiles, 'tiles', elapsed, latencies, 'build',
+                     rebuild_ms=rebuild * 1000.0, rebuild_written=written)
+
+# Shade the fixture into tiles config['repeat'] times
+def bench_hillshade(config):
+    hillshade = import_tiler('hillshade')
+    source = tiler_source(config)
+    scratch = stage_dir(config, 'hillshade')
+    latencies = list()
+    blocks = 0
+    start = time.perf_counter()
+    for i in range(config['repeat']):
+        begin = time.perf_counter()
+        blocks += hillshade.render(os.path.join(scratch, 'tiles{}'.format(i)),
+                                   source, config['workers'])
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    return summarize(blocks, 'tiles', elapsed, latencies, 'render')
+
+# Open viewtile.py on a pyramid of the fixture and pan around it
+# Building the pyramid isn't part of the time
+def bench_viewtile(config):
+    from PyQt4 import QtGui
+    pyramid = import_tiler('pyramid')
+    viewtile = import_tiler('viewtile')
+    tilesDir = os.path.join(stage_dir(config, 'viewtile'), 'tiles')
+    pyramid.build(tilesDir, tiler_source(config), config['workers'])
+
+    app = QtGui.QApplication([])
+    start = time.perf_counter()
+    tv = viewtile.TileViewer(tilesDir)
+    tv.show()
+    tv.canvas.repaint()
+    app.processEvents()
+    startup = time.perf_counter() - start
+
+    random.seed(config['seed'])
+    times = tv.benchmark(config['frames'])
+    tv.cache.shutdown()
+    return summarize(len(times), 'frames', sum(times), times, 'frame',
+                     startup_ms=startup * 1000.0, cache_hits=tv.cache.hits,
+                     cache_misses=tv.cache.misses,
+                     placeholders=tv.canvas.placeholders)
+
+STAGES = [('index', bench_index),
+          ('download', bench_download),
+          ('resolve', bench_resolve),
+          ('neddown', bench_neddown),
+          ('mapdb', bench_mapdb),
+          ('pyramid', bench_pyramid),
+          ('hillshade', bench_hillshade),
+          ('viewtile', bench_viewtile)]
+
+# Worker process entry point
+# Runs one stage with its output going to <work_dir>/<name>.log, and
+# returns its result, or why it was skipped or failed
+def run_stage(name, config):
+    startRss = peak_rss()
+    logName = os.path.join(config['work_dir'], name + '.log')
+    with open(logName, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            result = dict(STAGES)[name](config)
+        except SkipStage as err:
+            return dict(skipped=str(err))
+        except ImportError as err:
+            return dict(skipped='{} is not installed'.format(err.name or err))
+        except Exception as err:
+            traceback.print_exc(file=log)
+            return dict(error='{}: {}'.format(type(err).__name__, err))
+    result.update(start_rss_kb=startRss, peak_rss_kb=peak_rss(),
+                  peak_children_rss_kb=peak_children_rss())
+    return result
+
+# Run a stage in a process of its own
+def run_isolated(name, config):
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                mp_context=context) as executor:
+        try:
+            return executor.submit(run_stage, name, config).result()
+        except concurrent.futures.BrokenExecutor as err:
+            return dict(error='The stage\'s process died: {}'.format(err))
+
+# One line about a stage's result, for the progress output
+def describe(name, result):
+    if 'skipped' in result:
+        return '{:10s} skipped, {}'.format(name, result['skipped'])
+    if 'error' in result:
+        return '{:10s} FAILED, {}'.format(name, result['error'])
+    line = '{:10s} {:10.1f} {}/s'.format(name, result['per_second'] or 0.0,
+                                        result['unit'])
+    if result.get('mb_per_second') is not None:
+        line += ' {:8.1f} MB/s'.format(result['mb_per_second'])
+    lat = result['latency_ms']
+    if lat is not None:
+        line += '  per {} p50 {:.2f} ms p99 {:.2f} ms'.format(
+            result['latency_of'], lat['p50'], lat['p99'])
+    line += '  peak RSS {:.1f} MB'.format(result['peak_rss_kb'] / 1024.0)
+    if result['errors']:
+        line += '  {} errors'.format(result['errors'])
+    return line
+
+# The current git revision of the scripts, if they're in a checkout
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Make the fixtures, start the stand-ins and run the stages
+def run_suite(config, stages):
+    workDir = config['work_dir']
+    fixtureDir = os.path.join(workDir, 'fixtures')
+    print('Making {} {}x{} fixtures in {}'.format(config['fixtures'],
+                                                  config['width'],
+                                                  config['height'],
+                                                  fixtureDir),
+          file=sys.stderr)
+    start = time.perf_counter()
+    made = bench_fixtures.make_fixtures(fixtureDir, config['fixtures'],
+                                        config['width'], config['height'],
+                                        seed=config['seed'])
+    nedWidth, nedHeight = config['ned_size']
+    nedPayload = bench_servers.ned_payload(nedWidth, nedHeight)
+    fixtureTime = time.perf_counter() - start
+    config.update(fixture_dir=fixtureDir, gtiff=made['gtiff'],
+                  arcgrid=made['arcgrid'])
+
+    libremap = bench_servers.start_server(
+        bench_servers.LibremapHandler,
+        bench_servers.LibremapSite(config['state'], config['maps'],
+                                   bench_servers.random_payload(
+                                       config['tif_size'] * 1024,
+                                       config['seed'])),
+        delay=config['delay'])
+    usgs = bench_servers.start_server(
+        bench_servers.UsgsHandler,
+        bench_servers.UsgsSite(nedPayload, config['polls']),
+        delay=config['delay'])
+    config.update(libremap=libremap.host(), usgs=usgs.host())
+
+    results = dict(version=RESULTS_VERSION,
+                   started=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   revision=git_revision(),
+                   python=platform.python_version(),
+                   platform=platform.platform(),
+                   cpus=os.cpu_count(),
+                   config=dict((key, value) for key, value in config.items()
+                               if key not in ('work_dir', 'fixture_dir',
+                                              'gtiff', 'arcgrid', 'libremap',
+                                              'usgs')),
+                   fixture_seconds=fixtureTime,
+                   stages=dict())
+    try:
+        for name in stages:
+            result = run_isolated(name, config)
+            results['stages'][name] = result
+            print(describe(name, result), file=sys.stderr)
+    finally:
+        libremap.shutdown()
+        usgs.shutdown()
+    return results
+
+# Look up a dotted name like latency_ms.p50 in a stage's result
+def lookup(result, metric):
+    for key in metric.split('.'):
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+# Print how every metric changed between two sets of results
+# Returns the number of metrics that got more than threshold percent worse
+def compare(old, new, threshold=10.0):
+    regressions = 0
+    print('{:10s} {:16s} {:>12s} {:>12s} {:>8s}'.format('stage', 'metric',
+                                                         'old', 'new',
+                                                         'change'))
+    for name, stage in STAGES:
+        before = old['stages'].get(name)
+        after = new['stages'].get(name)
+        if before is None or after is None:
+            continue
+        if 'count' not in before or 'count' not in after:
+            print('{:10s} not run in both'.format(name))
+            continue
+        for metric, biggerIsBetter in COMPARED:
+            x = lookup(before, metric)
+            y = lookup(after, metric)
+            if x is None or y is None or x == 0:
+                continue
+            change = 100.0 * (y - x) / x
+            worse = -change if biggerIsBetter else change
+            flag = ''
+            if worse > threshold:
+                flag = '  <-- worse'
+                regressions += 1
+            print('{:10s} {:16s} {:12.2f} {:12.2f} {:+7.1f}%{}'.format(
+                name, metric, x, y, change, flag))
+    return regressions
+
+# Parse a WIDTHxHEIGHT option
+def parse_size(value):
+    size = value.lower().split('x')
+    return int(size[0]), int(size[-1])
+
+def syntax():
+    print('Syntax is:')
+    print('\t./bench_suite.py [--stages=index,download,...] [--output=file.json]')
+    print('\t                 [--work-dir=directory] [--repeat=N] [--seed=N]')
+    print('\t                 [--fixtures=N] [--size=WIDTHxHEIGHT] [--workers=N]')
+    print('\t                 [--maps=N] [--tif-size=KB] [--per-host=N]')
+    print('\t                 [--bbox=xmin,ymin,xmax,ymax] [--ned-size=WIDTHxHEIGHT]')
+    print('\t                 [--polls=N] [--poll=seconds] [--resolvers=N]')
+    print('\t                 [--delay=ms] [--frames=N]')
+    print('\t./bench_suite.py --compare [--threshold=percent] <old.json> <new.json>')
+    print('Stages: {}'.format(', '.join(name for name, stage in STAGES)))
+    sys.exit(1)
+
+def main(args):
+    config = dict(state='colorado', repeat=3, seed=0, fixtures=4,
+                  width=2048, height=2048, workers=None, maps=500,
+                  tif_size=1024, per_host=6, bbox=(-109.0, 37.0, -105.0, 41.0),
+                  ned_size=(1024, 1024), polls=2, poll_interval=0.05,
+                  resolvers=8, delay=0.0, frames=200)
+    stages = [name for name, stage in STAGES]
+    output = None
+    workDir = None
+    comparing = False
+    threshold = 10.0
+    intOptions = {'--repeat': 'repeat', '--seed': 'seed',
+                  '--fixtures': 'fixtures', '--workers': 'workers',
+                  '--maps': 'maps', '--tif-size': 'tif_size',
+                  '--per-host': 'per_host', '--polls': 'polls',
+                  '--resolvers': 'resolvers', '--frames': 'frames'}
+    rest = list()
+    for arg in args:
+        name = arg.split('=')[0]
+        value = arg[len(name)+1:]
+        if name in intOptions and '=' in arg:
+            config[intOptions[name]] = int(value)
+        elif name == '--stages' and '=' in arg:
+            stages = value.split(',')
+        elif name == '--output' and '=' in arg:
+            output = value
+        elif name == '--work-dir' and '=' in arg:
+            workDir = value
+        elif name == '--size' and '=' in arg:
+            config['width'], config['height'] = parse_size(value)
+        elif name == '--ned-size' and '=' in arg:
+            config['ned_size'] = parse_size(value)
+        elif name == '--bbox' and '=' in arg:
+            config['bbox'] = tuple(float(v) for v in value.split(','))
+        elif name == '--poll' and '=' in arg:
+            config['poll_interval'] = float(value)
+        elif name == '--delay' and '=' in arg:
+            config['delay'] = float(value) / 1000.0
+        elif name == '--threshold' and '=' in arg:
+            threshold = float(value)
+        elif arg == '--compare':
+            comparing = True
+        else:
+            rest.append(arg)
+
+    if comparing:
+        if len(rest) != 2:
+            syntax()
+        with open(rest[0]) as inf:
+            old = json.load(inf)
+        with open(rest[1]) as inf:
+            new = json.load(inf)
+        regressions = compare(old, new, threshold)
+        if regressions:
+            print('{} metrics got more than {}% worse'.format(regressions,
+                                                              threshold))
+            sys.exit(1)
+        return
+
+    known = [name for name, stage in STAGES]
+    if rest or len(config['bbox']) != 4 or \
+       any(name not in known for name in stages):
+        syntax()
+
+    keep = workDir is not None
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix='bench')
+    elif not os.path.exists(workDir):
+        os.makedirs(workDir)
+    config['work_dir'] = os.path.abspath(workDir)
+    try:
+        results = run_suite(config, stages)
+    finally:
+        if not keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output is None:
+        print(text)
+    else:
+        with open(output + '.tmp', 'w') as outf:
+            outf.write(text + '\n')
+        os.replace(output + '.tmp', output)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,453 @@
+# catalog.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# The SQLite map catalog, <state>/<state>.db
+
+# mapdown.py used to delete the database and rebuild it from scratch on
+# every run, which left a window where it was empty.
+# Now the catalog is synced in place: rows are upserted on the map id,
+# maps that disappeared from the index are deleted, and it all happens
+# in one transaction so anybody reading the database sees either the
+# old catalog or the new one.
+
+# Map bounds are kept in an R*Tree, so finding the quads that cover a
+# point or a bounding box doesn't need a full table scan.
+
+# The rasters table holds what GDAL says about each file on disk
+# (DRG GeoTIFFs, NED ArcGrids, ...), filled in by mapdb.py, with its
+# bounds in longitude/latitude in another R*Tree.
+# The file_state table remembers the size and modification time (and
+# optionally a quick hash) of each file when it was last read, so
+# unchanged files don't have to be opened again.
+
+import sqlite3
+
+# Columns of the maps table and the libremap index headings they come
+# from, along with a function to convert the text from the page
+MAP_COLUMNS = [('id', 'ID', int),
+               ('cell_name', 'Cell Name', str),
+               ('state', 'State', str),
+               ('category', 'Category', str),
+               ('se_latitude', 'SE Latitude', float),
+               ('se_longitude', 'SE Longitude', float),
+               ('min_val', 'MIN', str),
+               ('dsn', 'DSN', str),
+               ('tiff_url', 'url', str)]
+
+MAP_COLUMN_NAMES = [col for col, heading, conv in MAP_COLUMNS]
+
+# DRGs are USGS 7.5 minute quads, 1/8 of a degree on a side
+QUAD_SIZE = 0.125
+
+# Columns of the rasters table, other than id
+# The bounds are in the raster's own coordinate system, the lon/lat
+# bounds are in the R*Tree
+RASTER_COLUMNS = ['path',
+                  'map_id',
+                  'driver',
+                  'width',
+                  'height',
+                  'bands',
+                  'projection',
+                  'origin_x',
+                  'pixel_width',
+                  'row_rotation',
+                  'origin_y',
+                  'col_rotation',
+                  'pixel_height',
+                  'min_x',
+                  'max_x',
+                  'min_y',
+                  'max_y',
+                  'nodata']
+
+# Open the catalog, creating any missing tables
+# WAL mode lets readers keep going while a sync is being written
+def connect(dbFileName):
+    dbc = sqlite3.connect(dbFileName)
+    dbc.execute('pragma journal_mode=wal')
+    create_tables(dbc)
+    return dbc
+
+def create_tables(dbc):
+    with dbc:
+        dbc.execute('''\
+create table if not exists maps (
+    id integer primary key,
+    cell_name text,
+    state text,
+    category text,
+    se_latitude real,
+    se_longitude real,
+    min_val text,
+    dsn text,
+    tiff_url text)''')
+
+        # HTTP validators from the last time an index page was fetched
+        dbc.execute('''\
+create table if not exists sync_state (
+    url text primary key,
+    etag text,
+    last_modified text,
+    synced_at text)''')
+
+        # Bounds of each map, with the same id as the maps table
+        dbc.execute('''\
+create virtual table if not exists maps_rtree using rtree(
+    id,
+    min_lon, max_lon,
+    min_lat, max_lat)''')
+
+        # One row per raster file, see mapdb.py
+        dbc.execute('''\
+create table if not exists rasters (
+    id integer primary key,
+    path text unique,
+    map_id integer,
+    driver text,
+    width integer,
+    height integer,
+    bands integer,
+    projection text,
+    origin_x real,
+    pixel_width real,
+    row_rotation real,
+    origin_y real,
+    col_rotation real,
+    pixel_height real,
+    min_x real,
+    max_x real,
+    min_y real,
+    max_y real,
+    nodata real)''')
+
+        # DRGs with their collars cropped off, see decollar.py
+        # The bounds are in the raster's coordinate system
+        dbc.execute('''\
+create table if not exists cropped (
+    raster_id integer primary key,
+    path text,
+    width integer,
+    height integer,
+    origin_x real,
+    origin_y real,
+    min_x real,
+    max_x real,
+    min_y real,
+    max_y real)''')
+
+        # Elevation statistics, see rasterstats.py
+        # size and mtime_ns are the file's when they were computed, and
+        # histogram is a zlib compressed array of 64 bit counts, the
+        # first for values from hist_min to hist_min + bin_size
+        dbc.execute('''\
+create table if not exists raster_stats (
+    raster_id integer primary key,
+    path text,
+    size integer,
+    mtime_ns integer,
+    min real,
+    max real,
+    count integer,
+    nodata_count integer,
+    mean real,
+    stddev real,
+    hist_min real,
+    bin_size real,
+    histogram blob)''')
+
+        dbc.execute('''\
+create table if not exists file_state (
+    path text primary key,
+    size integer,
+    mtime_ns integer,
+    hash text)''')
+
+        dbc.execute('''\
+create virtual table if not exists rasters_rtree using rtree(
+    id,
+    min_lon, max_lon,
+    min_lat, max_lat)''')
+
+        # Catalogs from before the R*Tree existed need it filled in
+        rtreeRows = dbc.execute('select count(*) from maps_rtree').fetchone()[0]
+        mapRows = dbc.execute('select count(*) from maps').fetchone()[0]
+        if rtreeRows != mapRows:
+            dbc.execute('delete from maps_rtree')
+            index_maps(dbc, all_maps(dbc).values())
+
+# Convert a dictionary from mapdown.MyHTMLParser into a maps row
+def map_row(tiff):
+    return tuple(conv(tiff[heading]) for col, heading, conv in MAP_COLUMNS)
+
+# Get every row of the maps table, as a dictionary keyed on id
+def all_maps(dbc):
+    cur = dbc.execute('select {} from maps'.format(', '.join(MAP_COLUMN_NAMES)))
+    return dict((row[0], row) for row in cur)
+
+# Brings the maps table in line with a stream of rows
+# Must be used inside a transaction ("with dbc:")
+# Each row passed to add() is compared against what's in the catalog
+# and upserted in batches.  finish() deletes the maps that weren't
+# seen.  Afterwards added, changed and removed are lists of rows.
+class MapSync(object):
+    def __init__(self, dbc, batchSize=500):
+        self.dbc = dbc
+        self.batchSize = batchSize
+        self.seen = set()
+        self.batch = list()
+        self.added = list()
+        self.changed = list()
+        self.removed = list()
+        self.query = 'select {} from maps where id=?'.format(
+            ', '.join(MAP_COLUMN_NAMES))
+
+    # Add a row, returning 'A' if it's new, 'M' if it changed,
+    # or None if it's the same as before
+    def add(self, row):
+        self.seen.add(row[0])
+        prev = self.dbc.execute(self.query, (row[0],)).fetchone()
+        if prev == row:
+            return None
+        if prev is None:
+            self.added.append(row)
+            status = 'A'
+        else:
+            self.changed.append(row)
+            status = 'M'
+        self.batch.append(row)
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+        return status
+
+    def flush(self):
+        upsert_maps(self.dbc, self.batch)
+        self.batch = list()
+
+    def finish(self):
+        self.flush()
+        cur = self.dbc.execute('select {} from maps'.format(
+            ', '.join(MAP_COLUMN_NAMES)))
+        self.removed = [row for row in cur if row[0] not in self.seen]
+        self.dbc.executemany('delete from maps where id=?',
+                             [(row[0],) for row in self.removed])
+        self.dbc.executemany('delete from maps_rtree where id=?',
+                             [(row[0],) for row in self.removed])
+
+# Bring the maps table in line with rows
+# Must be called inside a transaction ("with dbc:")
+# Returns lists of the added, changed and removed rows
+def sync_maps(dbc, rows):
+    mapSync = MapSync(dbc)
+    for row in rows:
+        mapSync.add(row)
+    mapSync.finish()
+    return mapSync.added, mapSync.changed, mapSync.removed
+
+# Insert rows, replacing any existing rows with the same id
+def upsert_maps(dbc, rows):
+    dbc.executemany('''\
+insert into maps({cols})
+    values ({marks})
+    on conflict(id) do update set {updates}'''.format(
+        cols=', '.join(MAP_COLUMN_NAMES),
+        marks=','.join('?' * len(MAP_COLUMN_NAMES)),
+        updates=', '.join('{0}=excluded.{0}'.format(col)
+                          for col in MAP_COLUMN_NAMES[1:])),
+                    rows)
+    index_maps(dbc, rows)
+
+# The bounds of a maps row, as (min_lon, max_lon, min_lat, max_lat)
+# The catalog only has the south east corner, so the rest comes from
+# the size of a 7.5 minute quad
+def map_bounds(row):
+    lat = row[MAP_COLUMN_NAMES.index('se_latitude')]
+    lon = row[MAP_COLUMN_NAMES.index('se_longitude')]
+    return (lon - QUAD_SIZE, lon, lat, lat + QUAD_SIZE)
+
+# Add or replace the R*Tree entries for rows
+def index_maps(dbc, rows):
+    dbc.executemany('insert or replace into maps_rtree values (?,?,?,?,?)',
+                    ((row[0],) + map_bounds(row) for row in rows))
+
+# The R*Tree stores 32-bit floats, rounded outwards, so its answers can
+# include maps that just touch the query.  The join against the exact
+# corner in the maps table weeds those out.
+MAP_QUERY = '''\
+select {cols} from maps_rtree r join maps m on m.id=r.id
+    where r.max_lon >= :minLon and r.min_lon <= :maxLon
+      and r.max_lat >= :minLat and r.min_lat <= :maxLat
+      and m.se_longitude >= :minLon and m.se_longitude - {size} <= :maxLon
+      and m.se_latitude <= :maxLat and m.se_latitude + {size} >= :minLat
+'''.format(cols=', '.join('m.' + col for col in MAP_COLUMN_NAMES),
+           size=QUAD_SIZE)
+
+# Get the maps rows that intersect a bounding box
+def maps_in_bbox(dbc, minLon, minLat, maxLon, maxLat):
+    return dbc.execute(MAP_QUERY, dict(minLon=minLon, minLat=minLat,
+                                       maxLon=maxLon, maxLat=maxLat)).fetchall()
+
+# Get the maps rows that cover a point
+def maps_at_point(dbc, lon, lat):
+    return maps_in_bbox(dbc, lon, lat, lon, lat)
+
+# Insert or update rasters, given as dictionaries with a value for each
+# of RASTER_COLUMNS, plus 'lon_lat_bounds' as
+# (min_lon, max_lon, min_lat, max_lat) or None if it isn't known
+# Returns the ids of the rasters
+def upsert_rasters(dbc, recs):
+    sql = '''\
+insert into rasters({cols})
+    values ({marks})
+    on conflict(path) do update set {updates}'''.format(
+        cols=', '.join(RASTER_COLUMNS),
+        marks=','.join('?' * len(RASTER_COLUMNS)),
+        updates=', '.join('{0}=excluded.{0}'.format(col)
+                          for col in RASTER_COLUMNS[1:]))
+    dbc.executemany(sql, [tuple(rec[col] for col in RASTER_COLUMNS)
+                          for rec in recs])
+    ids = list()
+    for rec in recs:
+        rid = dbc.execute('select id from rasters where path=?',
+                          (rec['path'],)).fetchone()[0]
+        ids.append(rid)
+        dbc.execute('delete from rasters_rtree where id=?', (rid,))
+        if rec.get('lon_lat_bounds', None) is not None:
+            dbc.execute('insert into rasters_rtree values (?,?,?,?,?)',
+                        (rid,) + tuple(rec['lon_lat_bounds']))
+    return ids
+
+# Remove the rasters with the given paths
+def delete_rasters(dbc, paths):
+    for path in paths:
+        row = dbc.execute('select id from rasters where path=?',
+                          (path,)).fetchone()
+        if row is not None:
+            dbc.execute('delete from rasters_rtree where id=?', row)
+            dbc.execute('delete from raster_stats where raster_id=?', row)
+            dbc.execute('delete from cropped where raster_id=?', row)
+            dbc.execute('delete from rasters where id=?', row)
+
+# Get the rasters that intersect a bounding box, as dictionaries
+# like the ones given to upsert_rasters, plus 'id'
+def rasters_in_bbox(dbc, minLon, minLat, maxLon, maxLat):
+    cur = dbc.execute('''\
+select r.id, {cols}, t.min_lon, t.max_lon, t.min_lat, t.max_lat
+    from rasters_rtree t join rasters r on r.id=t.id
+    where t.max_lon >= ? and t.min_lon <= ?
+      and t.max_lat >= ? and t.min_lat <= ?'''.format(
+          cols=', '.join('r.' + col for col in RASTER_COLUMNS)),
+                      (minLon, maxLon, minLat, maxLat))
+    return [raster_record(row) for row in cur]
+
+# Get the rasters that cover a point
+def rasters_at_point(dbc, lon, lat):
+    return rasters_in_bbox(dbc, lon, lat, lon, lat)
+
+# Get one raster by path, or None
+def raster_by_path(dbc, path):
+    row = dbc.execute('''\
+select r.id, {cols}, t.min_lon, t.max_lon, t.min_lat, t.max_lat
+    from rasters r left join rasters_rtree t on r.id=t.id
+    where r.path=?'''.format(cols=', '.join('r.' + col
+                                            for col in RASTER_COLUMNS)),
+                      (path,)).fetchone()
+    if row is None:
+        return None
+    return raster_record(row)
+
+# Turn a row from the queries above into a dictionary
+def raster_record(row):
+    rec = dict(zip(['id'] + RASTER_COLUMNS, row))
+    rec['lon_lat_bounds'] = None
+    if row[-4] is not None:
+        rec['lon_lat_bounds'] = tuple(row[-4:])
+    return rec
+
+# Record where the cropped copy of a raster is
+# recs are dictionaries with the columns of the cropped table
+def save_cropped(dbc, recs):
+    cols = ['raster_id', 'path', 'width', 'height', 'origin_x', 'origin_y',
+            'min_x', 'max_x', 'min_y', 'max_y']
+    dbc.executemany('insert or replace into cropped({}) values ({})'.format(
+        ', '.join(cols), ','.join('?' * len(cols))),
+                    [tuple(rec[col] for col in cols) for rec in recs])
+
+STATS_COLUMNS = ['raster_id', 'path', 'size', 'mtime_ns', 'min', 'max',
+                 'count', 'nodata_count', 'mean', 'stddev', 'hist_min',
+                 'bin_size', 'histogram']
+
+# Save raster statistics, given as dictionaries with STATS_COLUMNS keys
+def save_stats(dbc, recs):
+    dbc.executemany('insert or replace into raster_stats({}) values ({})'.format(
+        ', '.join(STATS_COLUMNS), ','.join('?' * len(STATS_COLUMNS))),
+                    [tuple(rec[col] for col in STATS_COLUMNS) for rec in recs])
+
+# Get the statistics of the given rasters, as a dictionary mapping
+# raster id to a dictionary like the ones given to save_stats
+# Rasters without statistics are left out
+def raster_stats(dbc, rasterIds):
+    stats = dict()
+    for rid in rasterIds:
+        row = dbc.execute('select {} from raster_stats where raster_id=?'.format(
+            ', '.join(STATS_COLUMNS)), (rid,)).fetchone()
+        if row is not None:
+            stats[rid] = dict(zip(STATS_COLUMNS, row))
+    return stats
+
+# Get the saved state of every file, as a dictionary mapping
+# path to (size, mtime_ns, hash)
+def file_states(dbc):
+    cur = dbc.execute('select path, size, mtime_ns, hash from file_state')
+    return dict((row[0], row[1:]) for row in cur)
+
+# Save file states, given as (path, size, mtime_ns, hash) tuples
+def save_file_states(dbc, states):
+    dbc.executemany('''\
+insert or replace into file_state(path, size, mtime_ns, hash)
+    values (?, ?, ?, ?)''', states)
+
+# Forget about files that have been deleted
+def delete_file_states(dbc, paths):
+    dbc.executemany('delete from file_state where path=?',
+                    [(path,) for path in paths])
+
+# The GDAL style geotransform of a raster record
+def geotransform(rec):
+    return (rec['origin_x'], rec['pixel_width'], rec['row_rotation'],
+            rec['origin_y'], rec['col_rotation'], rec['pixel_height'])
+
+# Apply the inverse of geotransform gt to world coordinates xs, ys
+# (numbers or NumPy arrays), giving pixel and line coordinates
+def world_to_pixel(gt, xs, ys):
+    det = gt[1]*gt[5] - gt[2]*gt[4]
+    dx = xs - gt[0]
+    dy = ys - gt[3]
+    return (gt[5]*dx - gt[2]*dy) / det, (gt[1]*dy - gt[4]*dx) / det
+
+# Get the ETag and Last-Modified saved for url, or (None, None)
+def get_sync_state(dbc, url):
+    row = dbc.execute('select etag, last_modified from sync_state where url=?',
+                      (url,)).fetchone()
+    if row is None:
+        return None, None
+    return row
+
+# Save the ETag and Last-Modified headers for url
+def set_sync_state(dbc, url, etag, lastModified):
+    dbc.execute('''\
+insert or replace into sync_state(url, etag, last_modified, synced_at)
+    values (?, ?, ?, datetime('now'))''', (url, etag, lastModified))
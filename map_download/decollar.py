@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# decollar.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Strip the white collars off of downloaded DRGs
+
+# A DRG's map area (inside the "neatline") is a 7.5 minute quad, but
+# the GeoTIFF is in UTM, so the neatline is a slightly skewed, slightly
+# curved quadrilateral inside a rectangle of collar.  The collars waste
+# a lot of pixels and get in the way when maps are stitched together.
+
+# For each DRG in the catalog that mapdb.py --harvest has linked to its
+# maps row, this computes the neatline from the quad's corner and the
+# raster's geotransform, reads the neatline's bounding window in strips,
+# sets everything outside the neatline to nodata, and writes a tiled,
+# compressed GeoTIFF with overviews.  The maps are done in parallel,
+# and the cropped bounds are recorded in the catalog's cropped table.
+
+# Usage:
+#     ./decollar.py [--workers=N] [--force] <catalog.db> <output_directory>
+
+import os
+import sys
+import math
+import os.path
+import concurrent.futures
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+    from osgeo import osr
+except ImportError:
+    import gdal
+    import osr
+
+import catalog
+import utm
+
+# Rows read and written at a time
+STRIP_HEIGHT = 512
+
+# Points along each edge of the neatline, since lines of latitude are
+# curved in UTM
+EDGE_POINTS = 16
+
+# Color of the palette entry added for pixels outside the neatline in
+# paletted maps
+NODATA_COLOR = (255, 255, 255, 0)
+
+# The neatline of a quad whose south east corner is at (seLon, seLat),
+# as lon/lat points going around the quad
+def neatline_lon_lat(seLon, seLat, size=catalog.QUAD_SIZE):
+    west = seLon - size
+    north = seLat + size
+    corners = [(west, north), (seLon, north), (seLon, seLat), (west, seLat)]
+    pts = list()
+    for i in range(4):
+        (x0, y0), (x1, y1) = corners[i], corners[(i+1) % 4]
+        for t in np.arange(EDGE_POINTS) / float(EDGE_POINTS):
+            pts.append((float(x0 + t*(x1-x0)), float(y0 + t*(y1-y0))))
+    return pts
+
+# Transform lon/lat points in the datum of wkt's coordinate system
+# into that coordinate system
+# The DRGs are all UTM, which utm.py does without OSR
+def lon_lat_to_projected(wkt, pts):
+    proj = utm.UTM.from_wkt(wkt)
+    if proj is not None:
+        lons, lats = np.array(pts, dtype=np.float64).T
+        return np.column_stack(proj.forward(lons, lats))
+    dst = osr.SpatialReference()
+    dst.ImportFromWkt(wkt)
+    src = dst.CloneGeogCS()
+    for srs in (src, dst):
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    trans = osr.CoordinateTransformation(src, dst)
+    return np.array([p[:2] for p in trans.TransformPoints(pts)])
+
+# Which pixels of a width x height window at (xoff, yoff) have their
+# centers inside the polygon (px, py), by the even-odd rule
+# A scanline fill: each row's edge crossings are found for all rows and
+# edges at once, and a pixel is inside if an odd number of them are to
+# its right, which is a running sum along the row
+def polygon_mask(px, py, xoff, yoff, width, height):
+    x0 = np.asarray(px, dtype=np.float64)
+    y0 = np.asarray(py, dtype=np.float64)
+    x1 = np.roll(x0, -1)
+    y1 = np.roll(y0, -1)
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+
+    ys = np.arange(height) + yoff + 0.5
+    rows, edges = np.nonzero((y0 > ys[:, np.newaxis]) != (y1 > ys[:, np.newaxis]))
+    xint = x0[edges] + ((ys[rows] - y0[edges]) * (x1[edges] - x0[edges])
+                        / (y1[edges] - y0[edges]))
+    # The number of pixel centers in the row left of each crossing
+    cols = np.clip(np.ceil(xint - xoff - 0.5), 0, width).astype(np.int64)
+    counts = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(counts, (rows, cols), 1)
+    right = counts.sum(axis=1)[:, np.newaxis] - np.cumsum(counts[:, :width],
+                                                          axis=1)
+    return right % 2 == 1
+
+# The palette index for pixels outside the neatline, and whether it's a
+# new entry that needs a color
+# A palette with room gets a new entry, otherwise the highest index no
+# pixel uses is taken, so no real color is ever hidden
+def palette_nodata(band, ct):
+    if ct.GetCount() < 256:
+        return ct.GetCount(), True
+    hist = band.GetHistogram(-0.5, 255.5, 256, 0, 0)
+    for index in range(255, -1, -1):
+        if hist[index] == 0:
+            return index, False
+    raise ValueError('Every palette index is in use, none is free for nodata')
+
+# Crop one DRG
+# job is (raster record, se_longitude, se_latitude, output path)
+# Returns a dictionary for catalog.save_cropped, or raises
+def crop_map(job):
+    rec, seLon, seLat, outPath = job
+    gdal.UseExceptions()
+    src = gdal.Open(rec['path'])
+    gt = catalog.geotransform(rec)
+
+    pts = neatline_lon_lat(seLon, seLat)
+    world = lon_lat_to_projected(rec['projection'], pts)
+    px, py = catalog.world_to_pixel(gt, world[:, 0], world[:, 1])
+
+    # The window around the neatline, clipped to the file
+    x0 = max(0, int(math.floor(px.min())))
+    y0 = max(0, int(math.floor(py.min())))
+    x1 = min(rec['width'], int(math.ceil(px.max())))
+    y1 = min(rec['height'], int(math.ceil(py.max())))
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('Neatline is outside of the raster')
+    width = x1 - x0
+    height = y1 - y0
+
+    # Write to a temporary file so a half finished crop is never mistaken
+    # for a complete one
+    tmpPath = outPath + '.tmp.tif'
+    driver = gdal.GetDriverByName('GTiff')
+    srcBands = [src.GetRasterBand(i+1) for i in range(src.RasterCount)]
+    out = driver.Create(tmpPath, width, height, src.RasterCount,
+                        srcBands[0].DataType,
+                        ['TILED=YES', 'COMPRESS=DEFLATE'])
+    outGt = (gt[0] + x0*gt[1] + y0*gt[2], gt[1], gt[2],
+             gt[3] + x0*gt[4] + y0*gt[5], gt[4], gt[5])
+    out.SetGeoTransform(outGt)
+    out.SetProjection(rec['projection'])
+
+    nodata = rec['nodata']
+    ct = srcBands[0].GetColorTable()
+    if ct is not None and nodata is None:
+        ct = ct.Clone()
+        nodata, isNew = palette_nodata(srcBands[0], ct)
+        if isNew:
+            ct.SetColorEntry(nodata, NODATA_COLOR)
+    elif nodata is None:
+        nodata = 0
+    for i, band in enumerate(srcBands):
+        outBand = out.GetRasterBand(i+1)
+        outBand.SetNoDataValue(nodata)
+        if i == 0 and ct is not None:
+            outBand.SetColorTable(ct)
+
+    # Only a strip of the window is in memory at a time
+    for sy in range(0, height, STRIP_HEIGHT):
+        sh = min(STRIP_HEIGHT, height - sy)
+        inside = polygon_mask(px, py, x0, y0 + sy, width, sh)
+        for i, band in enumerate(srcBands):
+            data = band.ReadAsArray(x0, y0 + sy, width, sh)
+            data[~inside] = nodata
+            out.GetRasterBand(i+1).WriteArray(data, 0, sy)
+
+    out.BuildOverviews('NEAREST', [2, 4, 8, 16])
+    out = None
+    os.replace(tmpPath, outPath)
+
+    corners = [(outGt[0] + cx*outGt[1] + cy*outGt[2],
+                outGt[3] + cx*outGt[4] + cy*outGt[5])
+               for cx, cy in ((0, 0), (width, 0), (0, height), (width, height))]
+    return dict(raster_id=rec['id'], path=os.path.abspath(outPath),
+                width=width, height=height,
+                origin_x=outGt[0], origin_y=outGt[3],
+                min_x=min(c[0] for c in corners),
+                max_x=max(c[0] for c in corners),
+                min_y=min(c[1] for c in corners),
+                max_y=max(c[1] for c in corners))
+
+# Worker process entry point, returns (job, result, error)
+def crop_worker(job):
+    try:
+        return job, crop_map(job), None
+    except Exception as err:
+        return job, None, str(err)
+
+# The DRGs in the catalog that can be cropped, with their quad corners
+def find_jobs(dbc, outDir, force=False):
+    jobs = list()
+    for rec in catalog.rasters_in_bbox(dbc, -180, -90, 180, 90):
+        if rec['map_id'] is None:
+            continue
+        row = dbc.execute('select se_longitude, se_latitude from maps where id=?',
+                          (rec['map_id'],)).fetchone()
+        if row is None:
+            continue
+        outPath = os.path.join(outDir, os.path.basename(rec['path']))
+        if (not force and os.path.exists(outPath)
+                and os.path.getmtime(outPath) >= os.path.getmtime(rec['path'])):
+            continue
+        jobs.append((rec, row[0], row[1], outPath))
+    return jobs
+
+def decollar(dbFileName, outDir, workers=None, force=False, batchSize=50):
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    dbc = catalog.connect(dbFileName)
+    jobs = find_jobs(dbc, outDir, force)
+    print('{} maps to crop'.format(len(jobs)))
+
+    batch = list()
+    errors = list()
+    numDone = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for job, result, err in executor.map(crop_worker, jobs):
+            numDone += 1
+            if err is not None:
+                errors.append((job[0]['path'], err))
+                continue
+            batch.append(result)
+            if len(batch) >= batchSize:
+                with dbc:
+                    catalog.save_cropped(dbc, batch)
+                batch = list()
+                print('{} of {} done'.format(numDone, len(jobs)))
+    if batch:
+        with dbc:
+            catalog.save_cropped(dbc, batch)
+    dbc.close()
+
+    print('Cropped {} maps'.format(numDone - len(errors)))
+    for path, err in errors:
+        print('Could not crop {}: {}'.format(path, err))
+    return errors
+
+def main(args):
+    workers = None
+    force = False
+    rest = list()
+    for arg in args:
+        if arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):])
+        elif arg == '--force':
+            force = True
+        else:
+            rest.append(arg)
+    if len(rest) != 2:
+        print('Syntax is:')
+        print('\t./decollar.py [--workers=N] [--force] <catalog.db> <output_directory>')
+        sys.exit(1)
+    if decollar(rest[0], rest[1], workers, force):
+        sys.exit(1)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+
+# elevation.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Elevations of points and along tracks, from the NED rasters in the
+# catalog
+
+# hmrender's eleAt only works on its decimated copy of one grid, and
+# anything else meant opening the right ArcGrid in GDAL by hand.  This
+# finds the rasters under a batch of points with the catalog's R*Tree
+# (the finest resolution wins where they overlap) and interpolates
+# bilinearly between the four nearest samples.  Samples that are nodata
+# are left out of the interpolation, so the edges of the data still get
+# elevations.
+
+# ArcGrids are slow to decode, so every block of a grid that's used is
+# decoded once into a cache file, <cache>/<hash>.f32, which holds the
+# whole grid as float32 (NaN for nodata) and is memory mapped.  It's
+# created as a sparse file and only the blocks that are used take up
+# space; <hash>.blocks records which ones are done.  The hash covers the
+# raster's path, size and modification time, so a new version of a
+# file gets a new cache.  The cache is kept between runs, and pages that
+# aren't used are left to the operating system, so a warm query is just
+# NumPy indexing into the mapped files.
+
+# Usage:
+#     ./elevation.py [--cache=dir] <catalog.db> latitude longitude [...]
+#         Print the elevation (meters) of each point
+#     ./elevation.py [--cache=dir] [--step=meters] --profile <catalog.db> <track>
+#         Print distance, latitude, longitude and elevation along a GPX
+#         or NMEA track as CSV, every step meters if given, or at each
+#         point of the track
+#     ./elevation.py [--cache=dir] --serve [--port=8001] [--bind=address] [--log]
+#                    <catalog.db>
+#         Answer queries over HTTP with JSON:
+#           GET /elevation?lat=40.1&lon=-105.3[&lat=...&lon=...]
+#           POST /elevation {"points": [[lat, lon], ...]}
+#             -> {"elevations": [meters or null, ...]}
+#           POST /profile {"points": [[lat, lon], ...], "step": meters}
+#             -> {"distance": [...], "lat": [...], "lon": [...],
+#                 "elevation": [...], "ascent": m, "descent": m,
+#                 "min": m, "max": m}
+# The cache defaults to elevation_cache next to the catalog.
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import os.path
+import hashlib
+import threading
+import collections
+import http.server
+import urllib.parse
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+import catalog
+import mapdb
+import trackrender
+
+PORT = 8001
+
+# Size of the cache blocks, which are decoded a whole block at a time
+BLOCK_SIZE = 256
+
+# Grids kept open (mapped, with their GDAL datasets)
+MAX_GRIDS = 32
+
+# Mean radius of the earth, for distances along tracks
+EARTH_RADIUS = 6371008.8
+
+# Largest request body the server will read
+MAX_BODY = 64 * 1024 * 1024
+
+# Rough size of a pixel in meters, to put the finest rasters first
+def resolution(rec):
+    size = abs(rec['pixel_width'])
+    if not rec['projection'].startswith('PROJCS'):
+        size *= 111320.0
+    return size
+
+# One raster, decoded into a memory mapped cache file a block at a time
+# Safe to share between threads
+class DecodedGrid(object):
+    def __init__(self, rec, cacheDir, blockSize=BLOCK_SIZE):
+        self.rec = rec
+        self.path = rec['path']
+        self.width = rec['width']
+        self.height = rec['height']
+        self.nodata = rec['nodata']
+        self.blockSize = blockSize
+        self.blocksX = int(math.ceil(self.width / float(blockSize)))
+        self.blocksY = int(math.ceil(self.height / float(blockSize)))
+        self.lock = threading.Lock()
+        self.dataset = None
+
+        size, mtime = mapdb.file_signature(self.path)
+        key = hashlib.sha1('{}|{}|{}|{}'.format(os.path.abspath(self.path),
+                                                size, mtime,
+                                                blockSize).encode())
+        base = os.path.join(cacheDir, key.hexdigest()[:20])
+        dataName = base + '.f32'
+        doneName = base + '.blocks'
+        dataBytes = self.width * self.height * 4
+        if not (os.path.exists(doneName) and os.path.exists(dataName)
+                and os.path.getsize(dataName) == dataBytes):
+            os.makedirs(cacheDir, exist_ok=True)
+            # The data file has to be there before the record of which
+            # blocks are in it
+            for fname, nbytes in ((dataName, dataBytes),
+                                  (doneName, self.blocksX * self.blocksY)):
+                with open(fname + '.tmp', 'wb') as outf:
+                    outf.truncate(nbytes)
+                os.replace(fname + '.tmp', fname)
+        self.data = np.memmap(dataName, dtype=np.float32, mode='r+',
+                              shape=(self.height, self.width))
+        self.done = np.memmap(doneName, dtype=np.uint8, mode='r+',
+                              shape=(self.blocksY, self.blocksX))
+
+    # Decode block (bx, by) into the cache file
+    def decode(self, bx, by):
+        with self.lock:
+            if self.done[by, bx]:
+                return
+            if self.dataset is None:
+                gdal.UseExceptions()
+                self.dataset = gdal.Open(self.path)
+            x = bx * self.blockSize
+            y = by * self.blockSize
+            w = min(self.blockSize, self.width - x)
+            h = min(self.blockSize, self.height - y)
+            block = self.dataset.GetRasterBand(1).ReadAsArray(x, y, w, h)
+            block = block.astype(np.float32)
+            if self.nodata is not None:
+                block[block == self.nodata] = np.nan
+            self.data[y:y + h, x:x + w] = block
+            # The data has to be on disk before it's marked as done
+            self.data.flush()
+            self.done[by, bx] = 1
+            self.done.flush()
+
+    # Make sure every block with one of the pixels (xs, ys) is decoded
+    def ensure(self, xs, ys):
+        blocks = np.unique((ys // self.blockSize) * self.blocksX +
+                           xs // self.blockSize)
+        bys = blocks // self.blocksX
+        bxs = blocks % self.blocksX
+        missing = self.done[bys, bxs] == 0
+        for bx, by in zip(bxs[missing].tolist(), bys[missing].tolist()):
+            self.decode(bx, by)
+
+    # Bilinear interpolation at pixel coordinates px, py (0, 0 is the
+    # top left corner of the raster), NaN where there's no data
+    def sample(self, px, py):
+        u = px - 0.5
+        v = py - 0.5
+        x0 = np.floor(u)
+        y0 = np.floor(v)
+        fx = u - x0
+        fy = v - y0
+        x0 = x0.astype(np.int64)
+        y0 = y0.astype(np.int64)
+        xa = np.clip(x0, 0, self.width - 1)
+        xb = np.clip(x0 + 1, 0, self.width - 1)
+        ya = np.clip(y0, 0, self.height - 1)
+        yb = np.clip(y0 + 1, 0, self.height - 1)
+        self.ensure(np.concatenate((xa, xb, xa, xb)),
+                    np.concatenate((ya, ya, yb, yb)))
+
+        num = np.zeros(px.shape)
+        den = np.zeros(px.shape)
+        for xs, ys, weight in ((xa, ya, (1 - fx) * (1 - fy)),
+                               (xb, ya, fx * (1 - fy)),
+                               (xa, yb, (1 - fx) * fy),
+                               (xb, yb, fx * fy)):
+            z = self.data[ys, xs]
+            good = ~np.isnan(z)
+            num[good] += weight[good] * z[good]
+            den[good] += weight[good]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(den > 0, num / den, np.nan)
+
+    # Close the GDAL dataset, the mapped files go when the last thread
+    # using them is done
+    def close(self):
+        with self.lock:
+            self.dataset = None
+
+# Elevation queries against the catalog's rasters
+# Safe to share between threads
+class ElevationService(object):
+    def __init__(self, dbFileName, cacheDir=None, maxGrids=MAX_GRIDS):
+        self.dbFileName = dbFileName
+        if cacheDir is None:
+            cacheDir = os.path.join(os.path.dirname(os.path.abspath(dbFileName)),
+                                    'elevation_cache')
+        self.cacheDir = cacheDir
+        self.maxGrids = maxGrids
+        self.grids = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    # SQLite connections can't be shared between threads
+    def connection(self):
+        dbc = getattr(self.local, 'dbc', None)
+        if dbc is None:
+            dbc = catalog.connect(self.dbFileName)
+            self.local.dbc = dbc
+        return dbc
+
+    # The elevation rasters in a lon/lat box, finest first
+    # DRGs (rasters with a map) aren't elevations
+    def rasters(self, minLon, minLat, maxLon, maxLat):
+        recs = catalog.rasters_in_bbox(self.connection(), minLon, minLat,
+                                       maxLon, maxLat)
+        recs = [rec for rec in recs
+                if rec['map_id'] is None and rec['bands'] > 0
+                and rec['projection'] and rec['lon_lat_bounds']]
+        return sorted(recs, key=lambda rec: (resolution(rec), rec['path']))
+
+    # The DecodedGrid for a raster, keeping the most recently used open
+    def grid(self, rec):
+        with self.lock:
+            grid = self.grids.get(rec['path'])
+            if grid is not None:
+                self.grids.move_to_end(rec['path'])
+                return grid
+            grid = DecodedGrid(rec, self.cacheDir)
+            self.grids[rec['path']] = grid
+            while len(self.grids) > self.maxGrids:
+                path, old = self.grids.popitem(last=False)
+                old.close()
+            return grid
+
+    # Elevations at arrays of longitudes and latitudes, NaN where no
+    # raster has data
+    def elevations(self, lons, lats):
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        out = np.full(lons.shape, np.nan)
+        remaining = np.isfinite(lons) & np.isfinite(lats)
+        if not remaining.any():
+            return out
+        recs = self.rasters(lons[remaining].min(), lats[remaining].min(),
+                            lons[remaining].max(), lats[remaining].max())
+        for rec in recs:
+            minLon, maxLon, minLat, maxLat = rec['lon_lat_bounds']
+            idx = np.nonzero(remaining & (lons >= minLon) & (lons <= maxLon) &
+                             (lats >= minLat) & (lats <= maxLat))[0]
+            if len(idx) == 0:
+                continue
+            if rec['projection'].startswith('PROJCS'):
+                xs, ys = trackrender.project_points(lons[idx], lats[idx],
+                                                    rec['projection'])
+            else:
+                xs, ys = lons[idx], lats[idx]
+            px, py = catalog.world_to_pixel(catalog.geotransform(rec), xs, ys)
+            inside = ((px >= 0) & (px <= rec['width']) &
+                      (py >= 0) & (py <= rec['height']))
+            if not inside.any():
+                continue
+            idx = idx[inside]
+            values = self.grid(rec).sample(px[inside], py[inside])
+            # Points on this raster's nodata can still be on another one
+            hit = ~np.isnan(values)
+            out[idx[hit]] = values[hit]
+            remaining[idx[hit]] = False
+            if not remaining.any():
+                break
+        return out
+
+    # Elevations along a track, every step meters if step is given,
+    # otherwise at each point
+    # NaNs in the track separate segments, and the gaps between them
+    # don't add to the distance
+    # Returns a dictionary of arrays (distance, lon, lat, elevation)
+    # and the ascent, descent, min and max
+    def profile(self, lons, lats, step=None):
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        dist = track_distances(lons, lats)
+        good = np.isfinite(lons) & np.isfinite(lats)
+        lons, lats, dist = lons[good], lats[good], dist[good]
+        if step and len(dist):
+            at = np.arange(0, dist[-1], step)
+            if not len(at) or at[-1] < dist[-1]:
+                at = np.append(at, dist[-1])
+            lons = np.interp(at, dist, lons)
+            lats = np.interp(at, dist, lats)
+            dist = at
+        eles = self.elevations(lons, lats)
+        result = dict(distance=dist, lon=lons, lat=lats, elevation=eles,
+                      ascent=0.0, descent=0.0, min=None, max=None)
+        known = eles[~np.isnan(eles)]
+        if len(known):
+            diffs = np.diff(known)
+            result.update(ascent=float(diffs[diffs > 0].sum()),
+                          descent=float(-diffs[diffs < 0].sum()),
+                          min=float(known.min()), max=float(known.max()))
+        return result
+
+    def close(self):
+        with self.lock:
+            for grid in self.grids.values():
+                grid.close()
+            self.grids.clear()
+
+# Great circle distance along a track, from its first point
+# NaNs are breaks between segments, which count as no distance
+def track_distances(lons, lats):
+    lam = np.radians(lons)
+    phi = np.radians(lats)
+    h = (np.sin(np.diff(phi) / 2)**2 +
+         np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(np.diff(lam) / 2)**2)
+    steps = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    steps[np.isnan(steps)] = 0
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+# A list for json, with None instead of NaN
+def json_list(values):
+    return [None if v != v else v for v in np.asarray(values).tolist()]
+
+# Longitudes and latitudes out of a JSON request, which has either
+# "points": [[lat, lon], ...] or "lat": [...] and "lon": [...]
+def request_points(req):
+    if 'points' in req:
+        pts = np.array(req['points'], dtype=np.float64).reshape(-1, 2)
+        return pts[:, 1], pts[:, 0]
+    lons = np.array(req['lon'], dtype=np.float64).ravel()
+    lats = np.array(req['lat'], dtype=np.float64).ravel()
+    if lons.shape != lats.shape:
+        raise ValueError('lat and lon are different lengths')
+    return lons, lats
+
+# The "step" of a profile request, None if it isn't given, otherwise a
+# positive number of meters
+def request_step(req):
+    step = req.get('step')
+    if step is None:
+        return None
+    if (isinstance(step, bool) or not isinstance(step, (int, float))
+            or not 0 < step < math.inf):
+        raise ValueError('step must be a positive number of meters')
+    return float(step)
+
+class ElevationHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'elevation/1.0'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/elevation':
+            self.send_json(404, dict(error='Not found'))
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            lons, lats = request_points(dict(lon=query.get('lon', []),
+                                             lat=query.get('lat', [])))
+        except (ValueError, TypeError) as err:
+            self.send_json(400, dict(error=str(err)))
+            return
+        self.answer('/elevation', lons, lats)
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if path not in ('/elevation', '/profile'):
+            self.send_json(404, dict(error='Not found'))
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_BODY:
+                raise ValueError('Request is too big')
+            req = json.loads(self.rfile.read(length).decode('utf-8'))
+            lons, lats = request_points(req)
+            step = request_step(req)
+        except (ValueError, TypeError, KeyError) as err:
+            self.send_json(400, dict(error='Bad request: {}'.format(err)))
+            return
+        self.answer(path, lons, lats, step)
+
+    def answer(self, path, lons, lats, step=None):
+        service = self.server.service
+        try:
+            if path == '/elevation':
+                body = dict(elevations=json_list(service.elevations(lons, lats)))
+            else:
+                result = service.profile(lons, lats, step)
+                body = dict((key, json_list(value)
+                             if isinstance(value, np.ndarray) else value)
+                            for key, value in result.items())
+        except Exception as err:
+            self.log_error('%s failed: %s', path, err)
+            self.send_json(500, dict(error=str(err)))
+            return
+        self.send_json(200, body)
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            super(ElevationHandler, self).log_message(format, *args)
+
+class ElevationServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, service, log=False):
+        super(ElevationServer, self).__init__(address, ElevationHandler)
+        self.service = service
+        self.log = log
+
+    # Small responses shouldn't wait on Nagle's algorithm
+    def get_request(self):
+        conn, addr = super(ElevationServer, self).get_request()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, addr
+
+def format_elevation(value):
+    if value != value:
+        return 'nodata'
+    return '{:.2f}'.format(value)
+
+def main(args):
+    cacheDir = None
+    step = None
+    profile = False
+    serve = False
+    port = PORT
+    bind = ''
+    log = False
+    rest = list()
+    for arg in args:
+        if arg.startswith('--cache='):
+            cacheDir = arg[len('--cache='):]
+        elif arg.startswith('--step='):
+            step = float(arg[len('--step='):])
+        elif arg == '--profile':
+            profile = True
+        elif arg == '--serve':
+            serve = True
+        elif arg.startswith('--port='):
+            port = int(arg[len('--port='):])
+        elif arg.startswith('--bind='):
+            bind = arg[len('--bind='):]
+        elif arg == '--log':
+            log = True
+        else:
+            rest.append(arg)
+    if ((serve and len(rest) != 1) or (profile and len(rest) != 2)
+            or (step is not None and not 0 < step < math.inf)
+            or (not serve and not profile
+                and (len(rest) < 3 or len(rest) % 2 != 1))):
+        print('Syntax is:')
+        print('\t./elevation.py [--cache=dir] <catalog.db> latitude longitude [...]')
+        print('\t./elevation.py [--cache=dir] [--step=meters] --profile <catalog.db> <track>')
+        print('\t./elevation.py [--cache=dir] --serve [--port=8001] [--bind=address] [--log]')
+        print('\t               <catalog.db>')
+        sys.exit(1)
+
+    service = ElevationService(rest[0], cacheDir)
+    if serve:
+        server = ElevationServer((bind, port), service, log)
+        print('Serving elevations from {} on port {}'.format(
+            rest[0], server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    elif profile:
+        lons, lats = trackrender.read_track(rest[1])
+        start = time.time()
+        result = service.profile(lons, lats, step)
+        print('distance,latitude,longitude,elevation')
+        for d, lat, lon, ele in zip(result['distance'].tolist(),
+                                    result['lat'].tolist(),
+                                    result['lon'].tolist(),
+                                    result['elevation'].tolist()):
+            print('{:.1f},{:.7f},{:.7f},{}'.format(d, lat, lon,
+                                                   format_elevation(ele)))
+        summary = '{} points, {:.1f} m, in {:.3f}s'.format(
+            len(result['distance']), result['distance'][-1]
+            if len(result['distance']) else 0.0, time.time() - start)
+        if result['min'] is not None:
+            summary += ', ascent {:.1f} m, descent {:.1f} m, {:.1f}-{:.1f} m'.format(
+                result['ascent'], result['descent'], result['min'],
+                result['max'])
+        sys.stderr.write(summary + '\n')
+    else:
+        lats = [float(v) for v in rest[1::2]]
+        lons = [float(v) for v in rest[2::2]]
+        for lat, lon, ele in zip(lats, lons, service.elevations(lons, lats)):
+            print('{:.7f} {:.7f} {}'.format(lat, lon, format_elevation(ele)))
+    service.close()
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# fetcher.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Download engine shared by mapdown.py and neddown.py
+
+# urllib.request.urlretrieve opens a new connection for every file and
+# leaves a truncated file behind if the transfer dies part way through.
+# With hundreds of multi-megabyte TIFFs per state that's slow, and the
+# next run would skip the half written file because it already exists.
+
+# Instead, this module keeps a pool of keep-alive connections per host,
+# streams each download into "<name>.part", resumes partial files with
+# an HTTP Range request, checks the byte count against Content-Length and
+# only renames the file to its final name once it's complete.
+# So if a file exists under its real name, it's done.
+
+import os
+import os.path
+import sys
+import threading
+import http.client
+import urllib.parse
+
+# Size of each read from the socket
+CHUNK_SIZE = 256 * 1024
+
+# Number of redirects to follow before giving up
+MAX_REDIRECTS = 5
+
+# Raised when a download fails, or when the size doesn't match
+# Content-Length
+# status is the HTTP status code if the server returned an error
+class DownloadError(Exception):
+    def __init__(self, msg, status=None):
+        super(DownloadError, self).__init__(msg)
+        self.status = status
+
+# A pool of idle keep-alive connections, keyed on (scheme, host:port)
+# It's safe to share one pool between threads, but each connection is
+# only ever used by one thread at a time.
+class ConnectionPool(object):
+    def __init__(self, maxIdle=6, timeout=60):
+        self.maxIdle = maxIdle
+        self.timeout = timeout
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    # Get a connection to the given host, reusing an idle one if possible
+    # Returns the connection and whether or not it was reused
+    def get(self, scheme, netloc):
+        with self.lock:
+            conns = self.idle.get((scheme, netloc), None)
+            if conns:
+                return conns.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc,
+                                               timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    # Give a connection back to the pool after its response
+    # has been completely read
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            conns = self.idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.maxIdle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    # Close all of the idle connections
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = dict()
+
+# Connections shared by everything that doesn't pass in its own pool
+defaultPool = ConnectionPool()
+
+# Send a request on a pooled connection and return the pooled connection
+# and its response.
+# An idle keep-alive connection may have been closed by the server
+# in the meantime, so a failure on a reused connection gets one retry
+# on a fresh connection.
+def pooled_request(pool, method, url, headers=None):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    while True:
+        conn, reused = pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, headers=headers or dict())
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused:
+                raise
+
+# Read and discard the rest of a response so the connection can be reused
+def finish_response(pool, url, conn, resp):
+    resp.read()
+    if resp.will_close:
+        conn.close()
+    else:
+        parts = urllib.parse.urlsplit(url)
+        pool.put(parts.scheme, parts.netloc, conn)
+
+# Get the total size out of a Content-Range header
+# "bytes 100-199/200" and "bytes */200" both return 200
+def content_range_total(value):
+    if value is None or '/' not in value:
+        return None
+    total = value[value.rindex('/')+1:].strip()
+    if total == '*':
+        return None
+    return int(total)
+
+# Ask the server how big a file is without downloading it
+# Returns None if the server doesn't say
+def remote_size(url, pool=defaultPool):
+    for i in range(MAX_REDIRECTS):
+        conn, resp = pooled_request(pool, 'HEAD', url)
+        location = resp.getheader('Location')
+        length = resp.getheader('Content-Length')
+        finish_response(pool, url, conn, resp)
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if resp.status != 200 or length is None:
+            return None
+        return int(length)
+    raise DownloadError('Too many redirects for {}'.format(url))
+
+# Download url to fname
+# The data is written to fname + '.part' and renamed to fname when the
+# download is complete and its size has been verified.
+# If a .part file already exists, only the missing bytes are requested.
+# If fname already exists it's assumed to be complete, unless verify is
+# True, in which case its size is checked against the server's and a
+# short file is resumed.
+# progress, if given, is called with (bytesSoFar, totalBytes) after
+# every chunk.
+# limiter, if given, is an object with a consume(nBytes) method that
+# blocks as long as needed to keep under a bandwidth limit.
+# Returns the number of bytes actually transferred.
+def download_file(url, fname, pool=defaultPool, verify=False, progress=None,
+                  limiter=None):
+    partName = fname + '.part'
+
+    if os.path.exists(fname):
+        if not verify:
+            return 0
+        size = remote_size(url, pool)
+        haveSize = os.path.getsize(fname)
+        if size is None or size == haveSize:
+            return 0
+        # A short file left by an older, non-resumable download
+        # Resume it like any other partial file
+        os.replace(fname, partName)
+
+    transferred = 0
+    for i in range(MAX_REDIRECTS):
+        offset = 0
+        if os.path.exists(partName):
+            offset = os.path.getsize(partName)
+
+        headers = dict()
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
+
+        conn, resp = pooled_request(pool, 'GET', url, headers)
+
+        # Follow redirects by hand, http.client doesn't do it
+        location = resp.getheader('Location')
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            finish_response(pool, url, conn, resp)
+            url = urllib.parse.urljoin(url, location)
+            continue
+
+        # The requested range starts at or past the end of the file,
+        # which means the .part file is either complete or bogus
+        if resp.status == 416:
+            total = content_range_total(resp.getheader('Content-Range'))
+            finish_response(pool, url, conn, resp)
+            if total is not None and total == offset:
+                os.replace(partName, fname)
+                return transferred
+            os.remove(partName)
+            continue
+
+        if resp.status == 206:
+            start = resp.getheader('Content-Range', '')
+            if not start.startswith('bytes {}-'.format(offset)):
+                conn.close()
+                raise DownloadError(
+                    'Bad Content-Range "{}" for {}'.format(start, url))
+            mode = 'ab'
+        elif resp.status == 200:
+            # Server ignored the Range header, start over
+            offset = 0
+            mode = 'wb'
+        else:
+            finish_response(pool, url, conn, resp)
+            raise DownloadError('HTTP {} {} for {}'.format(resp.status,
+                                                          resp.reason, url),
+                                resp.status)
+
+        length = resp.getheader('Content-Length')
+        total = None
+        if length is not None:
+            total = offset + int(length)
+
+        # Stream the body to the .part file
+        cur = offset
+        try:
+            with open(partName, mode) as outf:
+                while True:
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    outf.write(chunk)
+                    if limiter is not None:
+                        limiter.consume(len(chunk))
+                    cur += len(chunk)
+                    transferred += len(chunk)
+                    if progress is not None:
+                        progress(cur, total)
+        except BaseException:
+            # The connection is in an unknown state, so don't reuse it
+            # The .part file is kept so the next attempt can resume
+            conn.close()
+            raise
+
+        if total is not None and cur != total:
+            conn.close()
+            raise DownloadError('Got {} of {} bytes for {}'.format(cur, total,
+                                                                  url))
+        finish_response(pool, url, conn, resp)
+        os.replace(partName, fname)
+        return transferred
+
+    raise DownloadError('Too many redirects for {}'.format(url))
+
+def main(args):
+    if len(args) != 2:
+        print('Command takes 2 arguments!')
+        print('\t./fetcher.py <url> <output_file>')
+        sys.exit(1)
+    got = download_file(args[0], args[1], verify=True)
+    print('Fetched {} bytes'.format(got))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,294 @@
+# jobstore.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# A persistent queue of NED download jobs in SQLite
+
+# Downloading all of the 1/3 arc-second cells for a state takes hours,
+# so neddown.py keeps track of every cell here instead of in memory:
+#   discovered   found on the index page, download page URL known
+#   resolved     the final .zip URL is known
+#   downloading  being downloaded, with the number of bytes so far
+#   done         the .zip is complete
+#   failed       gave up, with the error
+# A run that's killed for any reason picks up where it left off, and
+# a partial .zip is resumed from its .part file.
+
+# Several processes can work from the same store.  A job is claimed by
+# a worker (host:pid) inside a "begin immediate" transaction, so two
+# workers never get the same job, and claims by workers that died or
+# went quiet for too long can be taken over.  A running worker's
+# Heartbeat keeps all of its claims fresh, including the jobs that are
+# still waiting their turn.
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+DISCOVERED = 'discovered'
+RESOLVED = 'resolved'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds without any word from a worker before its claims can be
+# taken by someone else
+CLAIM_TIMEOUT = 15 * 60
+
+# Minimum bytes between saving the offset of a download
+OFFSET_INTERVAL = 4 * 1024 * 1024
+
+JOB_COLUMNS = ['name', 'description', 'page_url', 'url', 'fname', 'state',
+               'offset', 'size', 'error', 'attempts', 'claimed_by',
+               'claimed_at', 'updated_at']
+
+# The name of this process for claiming jobs
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+# Whether the worker that made a claim is known to be gone
+# Only processes on this host can be checked
+def worker_dead(name):
+    host, sep, pid = name.rpartition(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        return False
+    return False
+
+def job_dict(row):
+    return dict(zip(JOB_COLUMNS, row))
+
+# One connection to a job store, safe to share between the threads of a
+# process
+class JobStore(object):
+    def __init__(self, fileName, worker=None, claimTimeout=CLAIM_TIMEOUT):
+        if worker is None:
+            worker = worker_name()
+        self.worker = worker
+        self.claimTimeout = claimTimeout
+        self.lock = threading.Lock()
+        # Transactions are managed by hand so claims can use
+        # "begin immediate"
+        self.dbc = sqlite3.connect(fileName, timeout=60,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self.dbc.execute('pragma journal_mode=wal')
+        self.dbc.execute('''\
+create table if not exists jobs (
+    name text primary key,
+    description text,
+    page_url text,
+    url text,
+    fname text,
+    state text not null,
+    offset integer not null default 0,
+    size integer,
+    error text,
+    attempts integer not null default 0,
+    claimed_by text,
+    claimed_at real,
+    updated_at real
+)''')
+        self.dbc.execute('create index if not exists jobs_state on jobs(state)')
+        # Bytes written since the offset was last saved, per job
+        self.unsaved = dict()
+
+    def close(self):
+        with self.lock:
+            self.dbc.close()
+
+    # Run fn(dbc) inside a "begin immediate" transaction, holding the
+    # lock, and return what it returns
+    # Anything it raises rolls the transaction back
+    def _transaction(self, fn):
+        with self.lock:
+            self.dbc.execute('begin immediate')
+            try:
+                result = fn(self.dbc)
+                self.dbc.execute('commit')
+                return result
+            except BaseException:
+                self.dbc.execute('rollback')
+                raise
+
+    def _write(self, sql, params):
+        return self._transaction(lambda dbc: dbc.execute(sql, params).rowcount)
+
+    # Add newly discovered jobs, given as (name, description, page_url,
+    # fname) tuples
+    # Jobs that are already known get the new page URL (it has the
+    # current session ID in it) but otherwise keep their state
+    def discover(self, jobs):
+        now = time.time()
+        def insert(dbc):
+            dbc.executemany('''\
+insert into jobs(name, description, page_url, fname, state, updated_at)
+    values (?, ?, ?, ?, '{}', ?)
+    on conflict(name) do update set page_url=excluded.page_url,
+                                    description=excluded.description'''.format(
+                                        DISCOVERED),
+                            [job + (now,) for job in jobs])
+        self._transaction(insert)
+
+    # Claim up to limit jobs in any of states for this worker
+    # Unclaimed jobs come first, then ones whose worker is gone
+    # Jobs this worker already holds aren't returned again, so it can
+    # claim a batch at a time
+    # Returns the claimed jobs as dictionaries
+    def claim(self, states, limit=None):
+        now = time.time()
+        marks = ','.join('?' * len(states))
+        def claim_rows(dbc):
+            rows = dbc.execute('''\
+select {} from jobs where state in ({})
+    order by claimed_by is not null, name'''.format(', '.join(JOB_COLUMNS),
+                                                marks),
+                               tuple(states)).fetchall()
+            claimed = list()
+            for row in rows:
+                job = job_dict(row)
+                owner = job['claimed_by']
+                if (owner is not None
+                        and now - (job['claimed_at'] or 0) < self.claimTimeout
+                        and (owner == self.worker or not worker_dead(owner))):
+                    continue
+                dbc.execute('''\
+update jobs set claimed_by=?, claimed_at=? where name=?''',
+                            (self.worker, now, job['name']))
+                job['claimed_by'] = self.worker
+                job['claimed_at'] = now
+                claimed.append(job)
+                if limit is not None and len(claimed) >= limit:
+                    break
+            return claimed
+        return self._transaction(claim_rows)
+
+    # The final URL of a job is known
+    def resolved(self, name, url):
+        self._write('''\
+update jobs set state=?, url=?, error=null, claimed_at=?, updated_at=?
+    where name=?''', (RESOLVED, url, time.time(), time.time(), name))
+
+    # A job has been handed to the downloader
+    def downloading(self, name):
+        self._write('''\
+update jobs set state=?, attempts=attempts+1, claimed_at=?, updated_at=?
+    where name=?''', (DOWNLOADING, time.time(), time.time(), name))
+
+    # Record how far along a download is
+    # Called for every chunk, but only written every OFFSET_INTERVAL bytes
+    def progress(self, name, offset, size=None):
+        with self.lock:
+            last = self.unsaved.get(name, None)
+            if last is not None and offset - last < OFFSET_INTERVAL:
+                return
+            self.unsaved[name] = offset
+        self._write('''\
+update jobs set offset=?, size=?, claimed_at=?, updated_at=? where name=?''',
+                    (offset, size, time.time(), time.time(), name))
+
+    def done(self, name, size):
+        with self.lock:
+            self.unsaved.pop(name, None)
+        self._write('''\
+update jobs set state=?, offset=?, size=?, error=null, claimed_by=null,
+                claimed_at=null, updated_at=?
+    where name=?''', (DONE, size, size, time.time(), name))
+
+    def failed(self, name, error):
+        with self.lock:
+            self.unsaved.pop(name, None)
+        self._write('''\
+update jobs set state=?, error=?, claimed_by=null, claimed_at=null,
+                updated_at=?
+    where name=?''', (FAILED, str(error), time.time(), name))
+
+    # Put failed jobs back in the queue
+    # Their URLs may have expired, so they go back to being discovered
+    def retry_failed(self):
+        return self._write('''\
+update jobs set state=?, url=null, error=null, updated_at=? where state=?''',
+                           (DISCOVERED, time.time(), FAILED))
+
+    # Refresh the time of all of this worker's claims, so jobs it's still
+    # holding, like ones waiting for the resolver or the downloader,
+    # don't look abandoned
+    def heartbeat(self):
+        return self._write('''\
+update jobs set claimed_at=? where claimed_by=?''', (time.time(), self.worker))
+
+    # Give up this worker's claims, so jobs it didn't finish can be
+    # picked up right away by others
+    def release(self):
+        return self._write('''\
+update jobs set claimed_by=null, claimed_at=null where claimed_by=?''',
+                           (self.worker,))
+
+    # Number of jobs in each state
+    def counts(self):
+        with self.lock:
+            return dict(self.dbc.execute(
+                'select state, count(*) from jobs group by state').fetchall())
+
+    def jobs(self, state=None):
+        sql = 'select {} from jobs'.format(', '.join(JOB_COLUMNS))
+        params = ()
+        if state is not None:
+            sql += ' where state=?'
+            params = (state,)
+        with self.lock:
+            return [job_dict(row) for row in
+                    self.dbc.execute(sql + ' order by name', params)]
+
+# Calls store.heartbeat() every interval seconds (a third of the claim
+# timeout by default) in a background thread, until stop() is called
+class Heartbeat(object):
+    def __init__(self, store, interval=None):
+        if interval is None:
+            interval = store.claimTimeout / 3.0
+        self.store = store
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.store.heartbeat()
+            except sqlite3.Error as err:
+                # Try again next time
+                print('Could not refresh the job claims:', err)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+# Print the number of jobs in each state
+def print_counts(store):
+    counts = store.counts()
+    print(', '.join('{} {}'.format(counts.get(state, 0), state)
+                    for state in (DISCOVERED, RESOLVED, DOWNLOADING, DONE,
+                                  FAILED)))
+    for job in store.jobs(FAILED):
+        print('FAILED {}: {}'.format(job['name'], job['error']))
@@ -1,6 +1,4 @@
-#!/usr/bin/env python2.6
-
-from __future__ import print_function
+#!/usr/bin/env python3
 
 # mapdb.py
 
@@ -19,54 +17,336 @@ from __future__ import print_function
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
-# This script connects to the Sqlite DB created by mapdown.py
-# and uses PyGDAL to add some more information
+# This script uses PyGDAL to read information out of the raster files
+# downloaded by mapdown.py and neddown.py and adds it to the SQLite
+# catalog created by mapdown.py
+
+# It used to have to run under Python 2 because Debian didn't have
+# Python GDAL for Python 3, but that day has come.
 
-# This should really be included in mapdown.py, but Debian doesn't have
-# Python GDAL available for Python 3 yet.
-# But when that day comes, this script and mapdown.py should be merged
-# That said, care is being taken to make this script as Python3 compatible
-# as possible
+# Removing the image borders turned out to be "good enough" in Python
+# with NumPy, see decollar.py.
 
-# Alternatively, this script may eventually contain some significant
-# raster processing to do stuff like remove image borders.
-# In that case it may be beneficial to port it to C or C++ and use
-# the GDAL library directly.
-# It's possible Python's performance will be "good enough", though.
+# Usage:
+#     ./mapdb.py file.tif [file.tif ...]
+#         Print some information about each file
+#     ./mapdb.py --harvest [--workers=N] [--hash] [--full] <catalog.db> <directory>
+#         Scan directory for GeoTIFFs and ArcGrids and record their
+#         size, projection, geotransform, bounds, etc. in the catalog
+#         Only new or modified files are opened, unless --full is given.
+#         With --hash, files whose modification time changed but whose
+#         contents (by a quick hash) didn't aren't reopened either.
 
 import os
 import sys
 import os.path
-import sqlite3
+import hashlib
+import concurrent.futures
+
+try:
+    from osgeo import gdal
+    from osgeo import osr
+    from osgeo.gdalconst import *
+except ImportError:
+    import gdal
+    import osr
+    from gdalconst import *
+
+import catalog
+import utm
+
+# Files the harvester looks at
+# ArcGrids are directories of .adf files, hdr.adf stands in for the grid
+RASTER_EXTENSIONS = ('.tif', '.tiff')
+ARCGRID_HEADER = 'hdr.adf'
+
+# Bytes read from each end of a file for quick_hash
+HASH_BYTES = 64 * 1024
+
+# Find all of the raster files under directory
+# Yields (path, size, mtime_ns) for each one, using only the stat
+# information os.scandir already has or can get cheaply
+# An ArcGrid's size and time cover all of the .adf files in its
+# directory, since the data isn't in hdr.adf
+def find_rasters(directory):
+    entries = sorted(os.scandir(directory), key=lambda e: e.name)
+    names = [e.name.lower() for e in entries]
+    for entry, name in zip(entries, names):
+        if entry.is_dir(follow_symlinks=False):
+            for found in find_rasters(entry.path):
+                yield found
+        elif name.endswith(RASTER_EXTENSIONS):
+            st = entry.stat()
+            yield os.path.abspath(entry.path), st.st_size, st.st_mtime_ns
+        elif name == ARCGRID_HEADER:
+            size = 0
+            mtime = 0
+            for other, otherName in zip(entries, names):
+                if otherName.endswith('.adf'):
+                    st = other.stat()
+                    size += st.st_size
+                    mtime = max(mtime, st.st_mtime_ns)
+            yield os.path.abspath(entry.path), size, mtime
+
+# The size and mtime_ns of one raster, the same way find_rasters
+# figures them
+def file_signature(path):
+    if not is_arcgrid(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    size = 0
+    mtime = 0
+    directory = os.path.dirname(path)
+    for entry in os.scandir(directory):
+        if entry.name.lower().endswith('.adf'):
+            st = entry.stat()
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime_ns)
+    return size, mtime
+
+# The hash of hdr.adf says nothing about the grid's data, so ArcGrids
+# are always compared by size and time
+def is_arcgrid(path):
+    return os.path.basename(path).lower() == ARCGRID_HEADER
+
+# A quick content hash: the size plus the first and last HASH_BYTES
+# Good enough to tell a file that was only touched from one that was
+# rewritten, without reading hundreds of megabytes
+def quick_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as inf:
+        inf.seek(0, os.SEEK_END)
+        size = inf.tell()
+        h.update(str(size).encode())
+        inf.seek(0)
+        h.update(inf.read(HASH_BYTES))
+        if size > HASH_BYTES:
+            inf.seek(max(HASH_BYTES, size - HASH_BYTES))
+            h.update(inf.read(HASH_BYTES))
+    return h.hexdigest()
+
+# The bounds of a width x height raster with geotransform gt,
+# as (min_x, max_x, min_y, max_y) in the raster's coordinate system
+# and the four corners
+def corner_bounds(gt, width, height):
+    corners = list()
+    for px, py in ((0, 0), (width, 0), (0, height), (width, height)):
+        corners.append((gt[0] + px*gt[1] + py*gt[2],
+                        gt[3] + px*gt[4] + py*gt[5]))
+    xs = [c[0] for c in corners]
+    ys = [c[1] for c in corners]
+    return (min(xs), max(xs), min(ys), max(ys)), corners
+
+# Transform corners from the projection in wkt to longitude/latitude
+# Returns (min_lon, max_lon, min_lat, max_lat) or None if the raster
+# has no projection
+def lon_lat_bounds(wkt, corners):
+    if not wkt:
+        return None
+    proj = utm.UTM.from_wkt(wkt)
+    if proj is not None:
+        lons, lats = proj.inverse([c[0] for c in corners],
+                                  [c[1] for c in corners])
+        return (float(lons.min()), float(lons.max()),
+                float(lats.min()), float(lats.max()))
+    src = osr.SpatialReference()
+    src.ImportFromWkt(wkt)
+    dst = src.CloneGeogCS()
+    for srs in (src, dst):
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    trans = osr.CoordinateTransformation(src, dst)
+    pts = [trans.TransformPoint(x, y)[:2] for x, y in corners]
+    lons = [p[0] for p in pts]
+    lats = [p[1] for p in pts]
+    return (min(lons), max(lons), min(lats), max(lats))
+
+# Open a raster with GDAL and get everything the catalog wants to know
+# about it, as a dictionary in the form catalog.upsert_rasters takes
+def read_raster_info(path):
+    gdal.UseExceptions()
+    dataset = gdal.Open(path, GA_ReadOnly)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    gt = dataset.GetGeoTransform()
+    wkt = dataset.GetProjection()
+    bounds, corners = corner_bounds(gt, width, height)
+    rec = dict(path=path,
+               map_id=None,
+               driver=dataset.GetDriver().ShortName,
+               width=width,
+               height=height,
+               bands=dataset.RasterCount,
+               projection=wkt,
+               origin_x=gt[0],
+               pixel_width=gt[1],
+               row_rotation=gt[2],
+               origin_y=gt[3],
+               col_rotation=gt[4],
+               pixel_height=gt[5],
+               min_x=bounds[0],
+               max_x=bounds[1],
+               min_y=bounds[2],
+               max_y=bounds[3],
+               nodata=None,
+               lon_lat_bounds=lon_lat_bounds(wkt, corners))
+    if dataset.RasterCount > 0:
+        rec['nodata'] = dataset.GetRasterBand(1).GetNoDataValue()
+    return rec
+
+# Worker process entry point
+# Returns (path, record, hash, None) or (path, None, None, error message)
+def harvest_file(path, useHash=False):
+    try:
+        fileHash = None
+        if useHash and not is_arcgrid(path):
+            fileHash = quick_hash(path)
+        return path, read_raster_info(path), fileHash, None
+    except Exception as err:
+        return path, None, None, str(err)
 
-import gdal
+# Map the file names of downloaded DRGs to their ids in the maps table
+def map_ids_by_file(dbc):
+    ids = dict()
+    for mid, url in dbc.execute('select id, tiff_url from maps'):
+        ids[url[url.rindex('/')+1:]] = mid
+    return ids
 
-from gdalconst import *
+# Compare what's on disk against the file_state table
+# Returns the paths that need to be (re)read, the states of files that
+# were touched but not changed, and the paths that were deleted
+def find_changes(dbc, directory, useHash=False, full=False):
+    states = catalog.file_states(dbc)
+    toRead = list()
+    touched = list()
+    seen = set()
+    for path, size, mtime in find_rasters(directory):
+        seen.add(path)
+        old = states.get(path, None)
+        if not full and old is not None:
+            if old[0] == size and old[1] == mtime:
+                continue
+            if (useHash and old[0] == size and old[2] is not None
+                    and not is_arcgrid(path)):
+                fileHash = quick_hash(path)
+                if fileHash == old[2]:
+                    touched.append((path, size, mtime, fileHash))
+                    continue
+        toRead.append((path, size, mtime))
+
+    # Only forget about files under directory, the catalog may
+    # cover others too
+    prefix = os.path.join(os.path.abspath(directory), '')
+    deleted = [path for path in states
+               if path.startswith(prefix) and path not in seen]
+    return toRead, touched, deleted
+
+# Scan directory with a pool of worker processes and record every
+# new or modified raster in the catalog
+# GDAL does the slow part in the workers, and only this process
+# writes to the database, batchSize rows per transaction
+def harvest(dbFileName, directory, workers=None, batchSize=200,
+            useHash=False, full=False):
+    dbc = catalog.connect(dbFileName)
+    mapIds = map_ids_by_file(dbc)
+
+    toRead, touched, deleted = find_changes(dbc, directory, useHash, full)
+    with dbc:
+        catalog.save_file_states(dbc, touched)
+        catalog.delete_file_states(dbc, deleted)
+        catalog.delete_rasters(dbc, deleted)
+    print('{} new or modified raster files, {} deleted'.format(len(toRead),
+                                                               len(deleted)))
+
+    batch = list()
+    batchStates = list()
+    numDone = 0
+    errors = list()
+
+    def write_batch():
+        with dbc:
+            catalog.upsert_rasters(dbc, batch)
+            catalog.save_file_states(dbc, batchStates)
+        del batch[:]
+        del batchStates[:]
+
+    if toRead:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = dict()
+            for path, size, mtime in toRead:
+                fut = executor.submit(harvest_file, path, useHash)
+                futures[fut] = (size, mtime)
+            for fut in concurrent.futures.as_completed(futures):
+                path, rec, fileHash, err = fut.result()
+                numDone += 1
+                if err is not None:
+                    # No file state is saved, so it's tried again next time
+                    errors.append((path, err))
+                    continue
+                size, mtime = futures[fut]
+                rec['map_id'] = mapIds.get(os.path.basename(path), None)
+                batch.append(rec)
+                batchStates.append((path, size, mtime, fileHash))
+                if len(batch) >= batchSize:
+                    write_batch()
+                    print('{} of {} done'.format(numDone, len(toRead)))
+        if batch:
+            write_batch()
+    dbc.close()
+
+    print('Added {} rasters to {}'.format(numDone - len(errors), dbFileName))
+    for path, err in errors:
+        print('Could not read {}: {}'.format(path, err))
+    return errors
+
+# Print some info about a raster
+def print_info(tifFile):
+    # Open the specified TIFF file
+    dataset = gdal.Open(tifFile , GA_ReadOnly )
+
+    # Print some info
+    print('Driver:',
+          dataset.GetDriver().ShortName,'/',
+          dataset.GetDriver().LongName)
+
+    print('Size is',dataset.RasterXSize,'x',dataset.RasterYSize,
+          'x',dataset.RasterCount)
+
+    print('Projection is',dataset.GetProjection())
+
+    # Get the transform data and print it
+    geotransform = dataset.GetGeoTransform()
+    if geotransform is None:
+        return
+    print('Origin = (',geotransform[0], ',',geotransform[3],')')
+    print('Pixel Size = (',geotransform[1], ',',geotransform[5],')')
 
-# Right now this is more or less a stub script to test GDAL
 def main(args):
+    if len(args)>0 and args[0]=='--harvest':
+        workers = None
+        useHash = False
+        full = False
+        rest = list()
+        for arg in args[1:]:
+            if arg.startswith('--workers='):
+                workers = int(arg[len('--workers='):])
+            elif arg == '--hash':
+                useHash = True
+            elif arg == '--full':
+                full = True
+            else:
+                rest.append(arg)
+        if len(rest)!=2:
+            print('Syntax is:')
+            print('\t./mapdb.py --harvest [--workers=N] [--hash] [--full] <catalog.db> <directory>')
+            sys.exit(1)
+        errors = harvest(rest[0], rest[1], workers, useHash=useHash, full=full)
+        if errors:
+            sys.exit(1)
+        return
+
     for tifFile in args:
-        # Open the specified TIFF file
-        dataset = gdal.Open(tifFile , GA_ReadOnly )
-
-        # Print some info
-        print('Driver:',
-              dataset.GetDriver().ShortName,'/',
-              dataset.GetDriver().LongName)
-
-        print('Size is',dataset.RasterXSize,'x',dataset.RasterYSize,
-              'x',dataset.RasterCount)
-
-        print('Projection is',dataset.GetProjection())
-
-        # Get the transform data and print it
-        # Eventually this data should be added to the DB, and used to strip
-        # borders from the TIFF files.
-        geotransform = dataset.GetGeoTransform()
-        if geotransform is None:
-            continue
-        print('Origin = (',geotransform[0], ',',geotransform[3],')')
-        print('Pixel Size = (',geotransform[1], ',',geotransform[5],')')
+        print_info(tifFile)
 
 if __name__=='__main__':
     main(sys.argv[1:])
@@ -30,35 +30,39 @@
 import os
 import os.path
 
-import sqlite3
-
 import sys
-import subprocess
+import codecs
 import http.client
 import html.parser
-import urllib.request
-import concurrent.futures
 
-# Download an image to the given directory if it doesn't
-# already exist
-def download_img(img_url, directory):
-    fname = directory + '/' + img_url[img_url.rindex('/')+1:]
-    if not os.path.exists(fname):
-        urllib.request.urlretrieve(img_url, fname)
+import catalog
+import scheduler
+
+# Where the index pages and maps come from
+LIBREMAP_HOST = 'libremap.org'
+
+# The local file name for an image URL
+def img_file_name(img_url, directory):
+    return directory + '/' + img_url[img_url.rindex('/')+1:]
 
 # Parse an HTML document and get all of the links to .tif files
 # This HTMLParser subclass creates a list of dictionaries
 # containing information about all of the TIFF map files on the
 # libremap.org map download page.
+# If onRow is given, it's called with each dictionary as soon as its
+# row is complete instead, and the list isn't kept.  That way the page
+# can be fed in chunks as it arrives.
 class MyHTMLParser(html.parser.HTMLParser):
-    def __init__(self):
+    def __init__(self, onRow=None):
         super(MyHTMLParser, self).__init__()
         self.state = 0
         self.curTiff = dict()
         self.tiffs = []
+        self.onRow = onRow
         self.fields = []
         self.curField = None
         self.cfi = 0
+        self.text = []
         self.DEFAULT_STATE = 0
         self.HEADING_STATE = 1
         self.VALUE_STATE = 2
@@ -75,12 +79,13 @@ class MyHTMLParser(html.parser.HTMLParser):
             self.fieldNames = []
 
         if tag=='tr':
-            curTiff = dict()
+            self.curTiff = dict()
             self.curField = None
             self.cfi = 0
 
         
         elif tag=='td':
+            self.text = []
             for at,val in attrs:
                 # check if it's a heading
                 if at=='class' and val=='headleftstyle':
@@ -99,104 +104,184 @@ class MyHTMLParser(html.parser.HTMLParser):
                     # Set curTiff's image url
                     self.curTiff['url'] = val
 
-    # Only relevant endtag is tr, indicating the end of a row
-    # Append curTiff to tiffs and reset for next row
+    # A td ends a heading or value, and a tr ends a row
+    # Append curTiff to tiffs (or pass it to onRow) and reset for next row
     def handle_endtag(self, tag):
-        if tag=='tr' and self.curTiff.get('url',None) is not None:
-            self.tiffs.append(self.curTiff)
+        if tag in ('td', 'th'):
+            self.end_cell()
+
+        elif tag=='tr' and self.curTiff.get('url',None) is not None:
+            if self.onRow is not None:
+                self.onRow(self.curTiff)
+            else:
+                self.tiffs.append(self.curTiff)
             # print('Appending',self.curTiff['Cell Name'], 'id',self.curTiff['ID'])
             self.curTiff = dict()
 
-    # Handle data and reset state
+    # Collect a heading's or value's text until its cell ends
+    # The page is fed in chunks, so one cell's text can come in pieces
     def handle_data(self, data):
+        if self.state in (self.HEADING_STATE, self.VALUE_STATE):
+            self.text.append(data)
+
+    # Store the text of the cell that just ended and reset state
+    def end_cell(self):
+        data = ''.join(self.text)
+        self.text = []
+
         # Found a heading name, so add it to the field list
         if self.state == self.HEADING_STATE:
             self.fields.append(data)
-            self.state = self.DEFAULT_STATE
 
         # Found a field value, so add it to curTiff
         elif self.state == self.VALUE_STATE:
             self.curField = self.fields[self.cfi]
-            self.state = self.DEFAULT_STATE
             self.curTiff[self.curField] = data
             # Move to the next field
             self.cfi = self.cfi + 1
             if self.cfi >= len(self.fields):
                 self.cfi = 0
 
+        self.state = self.DEFAULT_STATE
+
+# Print what changed in the catalog, one line per map, svn status style
+def print_sync_report(added, changed, removed):
+    name = catalog.MAP_COLUMN_NAMES.index('cell_name')
+    for flag, rows in (('A', added), ('M', changed), ('D', removed)):
+        for row in sorted(rows, key=lambda r: r[name]):
+            print('{} {} ({})'.format(flag, row[name], row[0]))
+    print('{} added, {} changed, {} removed'.format(len(added), len(changed),
+                                                    len(removed)))
+
+# Feed an HTTP response to parser a chunk at a time
+def feed_response(parser, resp, chunkSize=64*1024):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        chunk = resp.read(chunkSize)
+        if not chunk:
+            break
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+
 def main(args):
+    # Pull out download scheduler options like --per-host=6
+    schedOpts, args = scheduler.parse_options(args, perHost=6)
+
+    # --force refetches the index page even if it hasn't changed
+    force = '--force' in args
+    args = [arg for arg in args if arg != '--force']
+
+    # --host=name[:port] syncs from somewhere else, like bench_servers.py
+    host = LIBREMAP_HOST
+    for arg in args:
+        if arg.startswith('--host='):
+            host = arg[len('--host='):]
+    args = [arg for arg in args if not arg.startswith('--host=')]
+
     # Default to CO, but check for an arg
     state = 'colorado'
     if len(args)>0:
         state = args[0]
 
-    # Connect to libremap and get the index page
-    conn =  http.client.HTTPConnection('libremap.org')
-    conn.request("GET", '/data/state/{}/drg/'.format(state))
-    r1 = conn.getresponse()
-
-    # Parse the HTML to populate the set of TIFF files
-    parser = MyHTMLParser()
-    parser.feed(r1.read().decode())
-    # print(parser.fields)
-    
-    print('Found {} tiffs'.format(len(parser.tiffs)))
-
     # Make the directory for the state's TIFFs
     if not os.path.exists(state):
         os.makedirs( state )
 
+    # The catalog is updated in place, so anything reading it keeps
+    # working against the old data until the sync commits
     dbFileName = state + '/' + state + '.db'
-    # Delete the DB file if it exists
-    if os.path.exists(dbFileName):
-        os.remove(dbFileName)
-
-    # Recreate it
-    dbc = sqlite3.connect(dbFileName)
-    dbc.execute('''\
-create table maps (
-    id integer primary key, 
-    cell_name text, 
-    state text, 
-    category text, 
-    se_latitude real, 
-    se_longitude real, 
-    min_val text, 
-    dsn text, 
-    tiff_url text)''')
-
-    # Loop through the results and add them to the DB
-    with dbc:
-        for tifi in parser.tiffs:
-            dbc.execute('''\
-insert into maps(
-    id,
-    cell_name,
-    state,
-    category,
-    se_latitude,
-    se_longitude,
-    min_val,
-    dsn,
-    tiff_url) 
-    values (?,?,?,?,?,?,?,?,?)''',
-                        (tifi['ID'],
-                         tifi['Cell Name'],
-                         tifi['State'],
-                         tifi['Category'],
-                         tifi['SE Latitude'],
-                         tifi['SE Longitude'],
-                         tifi['MIN'],
-                         tifi['DSN'],
-                         tifi['url']))
-    dbc.close()
-
-    # Concurrently download the TIFFs
-    # Not sure if concurrency helps here, actually, but it may?
-    # In any case, it was a chance to play with concurrent.futures...
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        for tif in parser.tiffs:
-            executor.submit(download_img, tif['url'], state )
+    dbc = catalog.connect(dbFileName)
+
+    # Connect to libremap and get the index page, but only if it
+    # changed since the last sync
+    indexPath = '/data/state/{}/drg/'.format(state)
+    headers = dict()
+    etag, lastModified = catalog.get_sync_state(dbc, indexPath)
+    if not force:
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if lastModified is not None:
+            headers['If-Modified-Since'] = lastModified
+    conn =  http.client.HTTPConnection(host)
+    conn.request("GET", indexPath, headers=headers)
+    r1 = conn.getresponse()
+
+    # Start the downloader now, so maps can be downloading while the
+    # rest of the index page is still coming in
+    # Partial downloads are resumed
+    sched = scheduler.DownloadScheduler(**schedOpts)
+    sched.start()
+    urlCol = catalog.MAP_COLUMN_NAMES.index('tiff_url')
+    queued = [0]
+
+    # Queue a map for download if it isn't on disk
+    def queue_download(row):
+        fname = img_file_name(row[urlCol], state)
+        if not os.path.exists(fname):
+            sched.add(row[urlCol], fname, row)
+            queued[0] += 1
+
+    failed = False
+    try:
+        if r1.status == 304:
+            r1.read()
+            print('Index page is unchanged since the last sync')
+            # Still pick up anything that didn't finish last time
+            for row in catalog.all_maps(dbc).values():
+                queue_download(row)
+        elif r1.status != 200:
+            # An error page has no maps on it, and syncing it would
+            # remove every map from the catalog
+            r1.read()
+            print('Could not get the index page: HTTP {} {}'.format(r1.status,
+                                                                   r1.reason))
+            failed = True
+        else:
+            # Each row goes into the catalog and, if it's new, changed
+            # or missing, to the downloader as soon as it's parsed
+            mapSync = catalog.MapSync(dbc)
+
+            # Changed maps are queued once the sync has committed and
+            # their old files are gone, so a failed sync leaves the old
+            # files with the old rows
+            def handle_row(tiff):
+                row = catalog.map_row(tiff)
+                if mapSync.add(row) != 'M':
+                    queue_download(row)
+
+            # Parse the HTML as it arrives
+            # It's all one transaction, so readers see the old catalog
+            # until the whole page has been synced
+            with dbc:
+                feed_response(MyHTMLParser(handle_row), r1)
+                mapSync.finish()
+                catalog.set_sync_state(dbc, indexPath, r1.getheader('ETag'),
+                                       r1.getheader('Last-Modified'))
+
+            # Changed maps have to be fetched again
+            for row in mapSync.changed:
+                fname = img_file_name(row[urlCol], state)
+                for old in (fname, fname + '.part'):
+                    if os.path.exists(old):
+                        os.remove(old)
+                queue_download(row)
+            print('Found {} tiffs'.format(len(mapSync.seen)))
+            print_sync_report(mapSync.added, mapSync.changed, mapSync.removed)
+    except BaseException:
+        # Don't wait for the downloads on Ctrl-C or a bad page, partial
+        # files are resumed next time
+        sched.cancel()
+        raise
+    finally:
+        conn.close()
+        dbc.close()
+
+    print('{} tiffs to download'.format(queued[0]))
+    results = sched.join()
+    scheduler.print_summary(results)
+    if failed or any(not r.ok for r in results):
+        sys.exit(1)
 
 if __name__=='__main__':
     main(sys.argv[1:])
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# mosaic.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# A virtual mosaic of many rasters from the catalog
+
+# Adjacent DRGs or NED cells that share a coordinate system and pixel
+# size look like one big georeferenced raster.  Reading a window only
+# touches the source files it overlaps, and only the blocks of those
+# files that intersect it.
+
+# Blocks go through a BlockCache that's limited by size and shared by
+# everything in the process, so panning or tiling across a quad
+# boundary reuses blocks that were already read instead of reopening
+# and rereading the file.
+
+# The C tools (pngtiler, hmrender) can read the same mosaic through
+# GDAL with Mosaic.write_vrt.  hillshade.py --catalog reads through a
+# Mosaic, so the halo around each block comes out of the cache.
+
+# Usage:
+#     ./mosaic.py <catalog.db> minLon minLat maxLon maxLat <output.vrt>
+#         Write a VRT of the catalog's rasters that intersect the box,
+#         for pngtiler, hmrender or anything else that reads GDAL
+
+import sys
+import math
+import threading
+import collections
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+import catalog
+
+# Blocks are cached in pieces this size, unless the file is tiled
+CACHE_BLOCK_SIZE = 256
+
+# A least recently used cache of raster blocks, limited to maxBytes
+# Safe to share between threads
+class BlockCache(object):
+    def __init__(self, maxBytes=256*1024*1024):
+        self.maxBytes = maxBytes
+        self.curBytes = 0
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Get the block for key, calling load() to read it on a miss
+    def get(self, key, load):
+        with self.lock:
+            block = self.blocks.get(key, None)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+        block = load()
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = block
+                self.curBytes += block.nbytes
+            while self.curBytes > self.maxBytes and len(self.blocks) > 1:
+                oldKey, old = self.blocks.popitem(last=False)
+                self.curBytes -= old.nbytes
+        return block
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.curBytes = 0
+
+# The cache shared by every Mosaic that doesn't get its own
+defaultCache = BlockCache()
+
+# One file in a mosaic
+# xoff and yoff are where its top left pixel lands in the mosaic
+class MosaicSource(object):
+    def __init__(self, rec, xoff, yoff, cache):
+        self.rec = rec
+        self.path = rec['path']
+        self.width = rec['width']
+        self.height = rec['height']
+        self.xoff = xoff
+        self.yoff = yoff
+        self.nodata = rec['nodata']
+        self.cache = cache
+        self.dataset = None
+        self.lock = threading.Lock()
+        self.blockWidth = None
+        self.blockHeight = None
+
+    # GDAL datasets aren't thread safe, so every read holds the lock
+    def _open(self):
+        if self.dataset is None:
+            self.dataset = gdal.Open(self.path)
+            bw, bh = self.dataset.GetRasterBand(1).GetBlockSize()
+            # Use the file's own tiles if it has reasonable ones,
+            # otherwise (scanlines, strips) read square pieces
+            if bw >= 64 and bh >= 64:
+                self.blockWidth, self.blockHeight = bw, bh
+            else:
+                self.blockWidth = self.blockHeight = CACHE_BLOCK_SIZE
+        return self.dataset
+
+    def block_size(self):
+        with self.lock:
+            self._open()
+            return self.blockWidth, self.blockHeight
+
+    # Get block (bx, by) of a band, through the cache
+    def block(self, band, bx, by):
+        def load():
+            with self.lock:
+                ds = self._open()
+                x = bx * self.blockWidth
+                y = by * self.blockHeight
+                w = min(self.blockWidth, self.width - x)
+                h = min(self.blockHeight, self.height - y)
+                return ds.GetRasterBand(band).ReadAsArray(x, y, w, h)
+        return self.cache.get((self.path, band, bx, by), load)
+
+    # Copy the part of this source inside a mosaic window into out,
+    # only where filled is False and the source has data
+    def read_into(self, band, xoff, yoff, out, filled):
+        h, w = out.shape
+        # The window in this source's pixels
+        sx0 = max(0, xoff - self.xoff)
+        sy0 = max(0, yoff - self.yoff)
+        sx1 = min(self.width, xoff + w - self.xoff)
+        sy1 = min(self.height, yoff + h - self.yoff)
+        if sx1 <= sx0 or sy1 <= sy0:
+            return
+        bw, bh = self.block_size()
+        for by in range(sy0 // bh, (sy1 - 1) // bh + 1):
+            for bx in range(sx0 // bw, (sx1 - 1) // bw + 1):
+                data = self.block(band, bx, by)
+                # Overlap of this block and the window, in source pixels
+                x0 = max(sx0, bx * bw)
+                y0 = max(sy0, by * bh)
+                x1 = min(sx1, bx * bw + data.shape[1])
+                y1 = min(sy1, by * bh + data.shape[0])
+                src = data[y0 - by*bh:y1 - by*bh, x0 - bx*bw:x1 - bx*bw]
+                ox = x0 + self.xoff - xoff
+                oy = y0 + self.yoff - yoff
+                dst = out[oy:oy + (y1-y0), ox:ox + (x1-x0)]
+                free = ~filled[oy:oy + (y1-y0), ox:ox + (x1-x0)]
+                if self.nodata is not None:
+                    free &= src != self.nodata
+                dst[free] = src[free]
+                filled[oy:oy + (y1-y0), ox:ox + (x1-x0)] |= free
+
+# Many rasters in the same coordinate system and at the same resolution,
+# presented as one
+class Mosaic(object):
+    # recs are raster records from the catalog
+    def __init__(self, recs, cache=defaultCache, nodata=None):
+        if not recs:
+            raise ValueError('A mosaic needs at least one raster')
+        first = recs[0]
+        self.projection = first['projection']
+        pw = first['pixel_width']
+        ph = first['pixel_height']
+        for rec in recs:
+            if (rec['projection'] != self.projection
+                    or not math.isclose(rec['pixel_width'], pw, rel_tol=1e-6)
+                    or not math.isclose(rec['pixel_height'], ph, rel_tol=1e-6)
+                    or rec['row_rotation'] or rec['col_rotation']):
+                raise ValueError('{} does not line up with {}'.format(
+                    rec['path'], first['path']))
+
+        # The mosaic covers all of the sources
+        left = min(rec['origin_x'] for rec in recs)
+        top = max(rec['origin_y'] for rec in recs)
+        self.geotransform = (left, pw, 0.0, top, 0.0, ph)
+        self.sources = list()
+        right = 0
+        bottom = 0
+        for rec in recs:
+            xoff = int(round((rec['origin_x'] - left) / pw))
+            yoff = int(round((rec['origin_y'] - top) / ph))
+            self.sources.append(MosaicSource(rec, xoff, yoff, cache))
+            right = max(right, xoff + rec['width'])
+            bottom = max(bottom, yoff + rec['height'])
+        self.width = right
+        self.height = bottom
+        self.cache = cache
+        if nodata is None:
+            nodata = first['nodata']
+        self.nodata = nodata
+
+    # Read a window of the mosaic, in mosaic pixels
+    # Anything not covered by a source is nodata (or 0)
+    def read(self, xoff, yoff, width, height, band=1, dtype=None):
+        if dtype is None:
+            dtype = self._dtype(band)
+        fill = self.nodata if self.nodata is not None else 0
+        out = np.full((height, width), fill, dtype=dtype)
+        filled = np.zeros((height, width), dtype=bool)
+        for src in self.sources:
+            src.read_into(band, xoff, yoff, out, filled)
+            if filled.all():
+                break
+        return out
+
+    # Read the window covering world coordinates minX..maxX, minY..maxY
+    # Returns the data and the window's geotransform
+    def read_bounds(self, minX, minY, maxX, maxY, band=1, dtype=None):
+        gt = self.geotransform
+        x0 = int(math.floor((minX - gt[0]) / gt[1]))
+        x1 = int(math.ceil((maxX - gt[0]) / gt[1]))
+        y0 = int(math.floor((maxY - gt[3]) / gt[5]))
+        y1 = int(math.ceil((minY - gt[3]) / gt[5]))
+        data = self.read(x0, y0, x1 - x0, y1 - y0, band, dtype)
+        return data, (gt[0] + x0*gt[1], gt[1], 0.0, gt[3] + y0*gt[5], 0.0,
+                      gt[5])
+
+    def _dtype(self, band):
+        # The first source block tells us the data type
+        src = self.sources[0]
+        return src.block(band, 0, 0).dtype
+
+    # Write a GDAL VRT of the mosaic, so programs using GDAL directly
+    # can read it as one dataset
+    def write_vrt(self, fileName):
+        opts = None
+        if self.nodata is not None:
+            opts = gdal.BuildVRTOptions(srcNodata=self.nodata,
+                                        VRTNodata=self.nodata)
+        vrt = gdal.BuildVRT(fileName, [src.path for src in self.sources],
+                            options=opts)
+        vrt = None
+
+# Make a mosaic out of the catalog's rasters that intersect a lon/lat
+# bounding box
+# If they're in more than one coordinate system, the one with the most
+# rasters is used, unless projection is given
+def from_catalog(dbFileName, minLon, minLat, maxLon, maxLat, projection=None,
+                 cache=defaultCache):
+    dbc = catalog.connect(dbFileName)
+    recs = catalog.rasters_in_bbox(dbc, minLon, minLat, maxLon, maxLat)
+    dbc.close()
+    recs = [rec for rec in recs if rec['bands'] > 0 and rec['projection']]
+    if projection is None and recs:
+        counts = collections.Counter(rec['projection'] for rec in recs)
+        projection = counts.most_common(1)[0][0]
+    recs = [rec for rec in recs if rec['projection'] == projection]
+    return Mosaic(sorted(recs, key=lambda r: r['path']), cache)
+
+def main(args):
+    if len(args) != 6:
+        print('Syntax is:')
+        print('\t./mosaic.py <catalog.db> minLon minLat maxLon maxLat <output.vrt>')
+        sys.exit(1)
+    minLon, minLat, maxLon, maxLat = [float(arg) for arg in args[1:5]]
+    try:
+        mosaic = from_catalog(args[0], minLon, minLat, maxLon, maxLat)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    mosaic.write_vrt(args[5])
+    print('Wrote {} ({}x{}, {} rasters)'.format(args[5], mosaic.width,
+                                                 mosaic.height,
+                                                 len(mosaic.sources)))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
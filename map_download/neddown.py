@@ -39,197 +39,113 @@
 
 # So, what this script does instead is to load that gisdata.usgs.gov page
 # and parse out the links
-# Then it opens a dialog box with a QWebKit control in it to handle all of
-# the wierd Javascript communication.
-# Then it grabs the final .zip file URL that the server returns and downloads
-# the file.
+# Then it follows each link's download page the way the Javascript
+# would (see nedresolve.py), many at a time, and hands the final .zip
+# file URL that the server returns to the download scheduler.
+
+# Every cell's state is kept in a SQLite job store (see jobstore.py) in
+# the output directory, so an interrupted run can simply be started
+# again.
+
+# With --ingest, each archive is unzipped and its grid added to the
+# catalog as soon as it's downloaded (see nedingest.py).
+
+# The old way, a dialog box with a QWebKit control in it to handle all of
+# the wierd Javascript communication, is still available with --webkit
+# in case the server starts doing something the resolver doesn't know
+# about.
 
 import os
 import os.path
-import re
 import sys
-import subprocess
+import threading
 import http.client
-import html.parser
-
-import urllib.request
-import urllib.parse
-
-from PyQt4 import QtWebKit
-from PyQt4 import QtGui
-from PyQt4 import QtCore
-
-import concurrent.futures
-
-# Simple parser to grab the final URL of the data
-class LinkParser(html.parser.HTMLParser):
-    def __init__(self):
-        super(LinkParser, self).__init__()
-        self.url = None
-    def handle_starttag(self, tag, attrs):
-        if tag=='a':
-            for at,val in attrs:
-                if at=='href':
-                    self.url = val
-
-# Download a zip file containing NED data
-# This function exists to be passed to an
-# concurrent.futures.ThreadPoolExecutor
-def download_ned(ned):
-    fname = ned['out_dir'] + '/' + ned['name']+'.zip'
-    if not os.path.exists(fname):
-        print('Downloading',fname)
-        urllib.request.urlretrieve(ned['good_url'], fname)
-
-# Dialog box with a QtWebKit control to download and process
-# downloads using Javascript
-class FancyDownloader(QtGui.QDialog):
-    def __init__(self, neds, executor, parent=None):
-        super(FancyDownloader, self).__init__(parent)
-            
-        # store some info for later
-        self.neds = neds
-        print(self.neds)
-        if len(self.neds)==0:
-            self.close()
-            self.destroy()
-            return
-        self.curNedIdx = 0
-        self.executor = executor
-        print('current idx',self.curNedIdx)
-        print('num neds', len(self.neds))
-        self.curNed = self.neds[self.curNedIdx]
-
-        # Create the web control
-        self.qwp = QtWebKit.QWebView(self)
-        self.qwp.load(QtCore.QUrl(self.curNed['new_url']))
-        self.connect(self.qwp, QtCore.SIGNAL('loadFinished(bool)'),
-                     self.loadFinished)
-
-        htl = QtGui.QHBoxLayout()
-        htl.addWidget(self.qwp)
-        self.setLayout(htl)
-
-    # After each step in the Javascript process a loadFinished() event
-    # is sent.
-    # This event handler parses the current HTML of the WebKit control
-    # and looks for the data URL.
-    def loadFinished(self, ok):
-        print('Got a load finished!')
-        htmlText = self.qwp.page().currentFrame().toHtml().__str__()
-        parser = LinkParser()
-        parser.feed(htmlText)
-        if parser.url is not None and parser.url.find('downloadID')>0:
-            print('The download URL is:', parser.url)
-            self.curNed['good_url'] = parser.url
-            self.executor.submit(download_ned, self.curNed)
-            self.curNedIdx += 1
-            if self.curNedIdx<len(self.neds):
-                self.curNed = self.neds[self.curNedIdx]
-                self.qwp.setUrl(QtCore.QUrl(self.curNed['new_url']))
-            else:
-                print('Done with WebKit, closing and destroying window!')
-                self.close()
-                self.destroy()
-
-            # A possible alternative that doesn't use an HTMLParser:
-            # urlRx = re.compile('.*"(http://extract\.cr\.usgs\.gov/axis2/services/DownloadService/getData\?downloadID=.*)" style.*')
-            # mt = urlRx.match(htmlText)
-            # if mt is not None:
-            #     self.ned['good_url'] = mt.group(1)
-            #     self.executor.submit(download_ned, self.ned)
-            # self.reject()
-
-# This is a mess
-# Parse the page at
-# http://gisdata.usgs.gov/XMLWebServices2/getTDDSDownloadURLs.aspx?XMin=
-# -109.2&YMin=35.8&XMax=-101.9&YMax=42.1&EPSG=4326&STATE=Colorado&COUNTY=#
-# and look for links to NED data
-# It's more or less a crude state machine based on emperical observations
-# of the page's HTML and some experimentation.
-# If the page layout is changed in any way, this will probably break.
-# But until then...
-
-# Also, it's slightly complicated by the fact that the first request
-# always (almost always) sends a "retry" with <a> link to a new URL
-# So this catches that.
-class MyHTMLParser(html.parser.HTMLParser):
-    def __init__(self):
-        super(MyHTMLParser, self).__init__()
-        self.curNed = dict()
-        self.neds = list()
-        self.state = 0
-        self.retryUrl = None
-        self.DEFAULT_STATE = 0
-        self.NAME_STATE = 1
-        self.TITLE_STATE = 2
-        self.TR_STATE=3
-        self.RETRY_STATE = 999
-        self.curDesc = ''
-
-    def handle_starttag(self, tag, attrs):
-        # Have to look at title tags to see if the title is
-        # "Object moved", which is the cue that the page
-        # needs to be fetched again at a new URL
-        if tag=='title':
-            self.state = self.TITLE_STATE
-
-        # First handle_data after a <tr> returns the
-        # type of data being linked to a couple rows over
-        # We need to save this description for later so that
-        # the appropriate links are followed
-        elif tag=='tr':
-            self.state = self.TR_STATE
-
-        # <a> tags that contain the actual links
-        elif tag=='a':
-            for at,val in attrs:
-                # Of course using href would be too easy
-                if at=='onclick':
-                    # Set curTiff's image url
-                    self.curNed['url'] = val
-                    self.curNed['desc'] = self.curDesc
-                    # Switch to the 'name' state, indicating that the
-                    # next handle_data will be the name of the NED link
-                    self.state = self.NAME_STATE
-                # But if a retry is necessary, it uses href,
-                # so check for that
-                elif at=='href' and self.state ==self.RETRY_STATE:
-                    # print('Retry at:',val)
-                    self.retryUrl = val
-
-    # </a> is as good a place as any to add the current NED to the list
-    def handle_endtag(self, tag):
-        if tag=='a' and self.curNed.get('url',None) is not None :
-            self.neds.append(self.curNed)
-            # and reset
-            self.curNed = dict()
-
-    # Handle data and reset state
-    def handle_data(self, data):
-        # Name of the current NED
-        # something like n<lat>w<long>
-        if self.state == self.NAME_STATE:
-            self.curNed['name'] = data.strip()
-            self.state = self.DEFAULT_STATE
-
-        # Grab the description of the next set of links
-        elif self.state==self.TR_STATE:
-            self.curDesc = data
-            self.state = self.DEFAULT_STATE
-
-        # An 'Object moved' title indicates a retry is necessary,
-        # so check for it and setup the RETRY_STATE if found
-        elif self.state == self.TITLE_STATE:
-            if data=='Object moved':
-                # try again
-                self.state = self.RETRY_STATE
-            else:
-                # Don't try again
-                self.state = self.DEFAULT_STATE
 
+import scheduler
+import jobstore
+import nedresolve
+
+# The local file name of the zip file containing NED data
+def ned_file_name(ned):
+    return ned['out_dir'] + '/' + ned['name']+'.zip'
+
+# Stands in for the DownloadScheduler when NEDs are resolved, recording
+# each URL in the job store before passing it along
+# It also counts the jobs the scheduler hasn't finished, so more are
+# only claimed when there's room for them
+class StoreFeeder(object):
+    def __init__(self, store, sched):
+        self.store = store
+        self.sched = sched
+        self.inFlight = 0
+        self.cond = threading.Condition()
+
+    def add(self, url, fname, ned):
+        self.store.resolved(ned['name'], url)
+        self.resume(url, fname, ned)
+
+    # Pass on a job whose URL is already known
+    def resume(self, url, fname, ned):
+        self.store.downloading(ned['name'])
+        with self.cond:
+            self.inFlight += 1
+        self.sched.add(url, fname, ned)
+
+    # The scheduler finished a job
+    def finished(self):
+        with self.cond:
+            self.inFlight -= 1
+            self.cond.notify_all()
+
+    # Wait until fewer than limit jobs are waiting for the scheduler, or
+    # it stopped
+    def wait_for_room(self, limit):
+        with self.cond:
+            while (self.inFlight >= limit and self.sched.thread is not None
+                   and self.sched.thread.is_alive()):
+                self.cond.wait(1.0)
 
 def main(args):
+    # Pull out download scheduler options like --per-host=6
+    schedOpts, args = scheduler.parse_options(args, perHost=6)
+
+    # And the URL resolver's options
+    host = nedresolve.NED_HOST
+    resolvers = 8
+    pollInterval = 5.0
+    useWebKit = False
+    jobsFile = None
+    retryFailed = False
+    ingestDb = None
+    ingestWorkers = None
+    deleteZips = False
+    commands = list()
+    rest = list()
+    for arg in args:
+        if arg.startswith('--host='):
+            host = arg[len('--host='):]
+        elif arg.startswith('--resolvers='):
+            resolvers = int(arg[len('--resolvers='):])
+        elif arg.startswith('--poll='):
+            pollInterval = float(arg[len('--poll='):])
+        elif arg == '--webkit':
+            useWebKit = True
+        elif arg.startswith('--jobs='):
+            jobsFile = arg[len('--jobs='):]
+        elif arg == '--retry-failed':
+            retryFailed = True
+        elif arg.startswith('--ingest='):
+            ingestDb = arg[len('--ingest='):]
+        elif arg.startswith('--ingest-workers='):
+            ingestWorkers = int(arg[len('--ingest-workers='):])
+        elif arg == '--delete-zips':
+            deleteZips = True
+        elif arg.startswith('--then='):
+            commands.append(arg[len('--then='):])
+        else:
+            rest.append(arg)
+    args = rest
+
     # Default to CO, but check for args that override that
     # Note that the whole state of Colorado is f'in huge
     # Probably a poor choice of default, but it makes my testing easier
@@ -249,86 +165,139 @@ def main(args):
         print('This script takes 0 or 5 arguments.')
         print('If arguments are given, the syntax should be:')
         print("\tneddown.py min_long min_lat max_long max_lat output_directory")
+        print('Download options: --per-host=N --workers=N --rate=N')
+        print('                  --bandwidth=KB/s --retries=N')
+        print('Resolver options: --resolvers=N --poll=seconds --host=name')
+        print('                  --webkit (use a QWebView instead)')
+        print('Job options: --jobs=file.db (default output_directory/neddown.db)')
+        print('             --retry-failed')
+        print('Ingest options: --ingest=catalog.db --ingest-workers=N')
+        print('                --delete-zips --then=command (see nedingest.py)')
         sys.exit(1)
 
-    # Download and parse the initial page
-    conn =  http.client.HTTPConnection('gisdata.usgs.gov')
-    url = '/XMLWebServices2/getTDDSDownloadURLs.aspx?XMin={}&YMin={}&XMax={}&YMax={}&EPSG=4326&STATE=&COUNTY=#'.format(xmin,ymin,xmax,ymax)
-    conn.request("GET", url)
-    r1 = conn.getresponse()
-    body = r1.read().decode()
-
-    # Fix some screwed up HTML before parsing it
-    body = body.replace('false;=', 'false=')
-    parser = MyHTMLParser()
-    # print(body)
-    parser.feed(body)
-    # print('Retry at:', parser.retryUrl)
-    neds = list()
-    sessionID = ''
-    sessionRx = re.compile('.*(\(S\(.+\)\)).*')
-    # Check for a retry
-    if parser.retryUrl is not None:
-        # Got a retry, so try again
-        newUrl = urllib.parse.unquote(parser.retryUrl)
-        conn.request("GET", newUrl)
-        # Should really error check this, but there's not much to do
-        # except fail anyway
-        mtch = sessionRx.match(newUrl)
-        sessionID = mtch.group(1)
-        r2 = conn.getresponse()
-
-        body = r2.read().decode()
-        # print(body)
-        # Again, fix bad HTML before parsing
-        body = body.replace('false;=', 'false=')
-        body = body.replace('onclick=','onclick="')
-        body = body.replace('false;>', 'false;">')
-        parser2 = MyHTMLParser()
-        parser2.feed(body)
-        # Theoretically possible there was another retry, but I've never
-        # seen it.
-        neds = parser2.neds
-    else:
-        # No retry
-        neds = parser.neds
-
-    if len(neds)==0:
-        print("An error occured fetching the NED URLs!")
-        exit(2)
     # Create the output directory if it doesn't exist
     if not os.path.exists(outDir):
         os.makedirs( outDir )
 
-    
-    nedTypes = set()
-    toDownload = list()
-    # Create a new list containing the NED urls we're interested in
-    # Choices are:
-    # 'National Elevation Dataset (1 arc second) Pre-packaged ArcGrid format'
-    # 'National Elevation Dataset (1/3 arc second) Pre-packaged ArcGrid format'
-    # 'National Elevation Dataset (1 arc second) Pre-packaged Float format'
-    # 'National Elevation Dataset (1/3 arc second) Pre-packaged Float format'
-    wantedFormat = 'National Elevation Dataset (1/3 arc second) Pre-packaged ArcGrid format'
-    for ned in neds:
-        if ned['desc']==wantedFormat:
-            nt = ned
-            rawUrl = nt['url']
-            # Remove the Javascript cruft and create the actual URLs
-            newUrl = rawUrl.replace('window.open(\'', '/XMLWebServices2/'+sessionID+'/')
-            newUrl = newUrl.replace("','downloadWin','left=100,top=100,width=600,height=500'); return false;", '')
-            newUrl = 'http://gisdata.usgs.gov' + newUrl
-            nt['new_url'] = newUrl
-            nt['out_dir'] = outDir
-            toDownload.append(nt)
-
-    # Create a "FancyDownloader" and start downloading the NEDs concurrently
-    app = QtGui.QApplication([])
+    # Every cell's progress is kept in the job store, so running again
+    # with the same output directory continues where the last run stopped
+    if jobsFile is None:
+        jobsFile = os.path.join(outDir, 'neddown.db')
+    store = jobstore.JobStore(jobsFile)
+    if retryFailed:
+        store.retry_failed()
+
+    # Download and parse the initial page, following the retry to
+    # get a session ID
+    # Jobs whose URLs are already known can still go ahead without it
+    try:
+        neds, sessionID = nedresolve.fetch_index(xmin, ymin, xmax, ymax, host)
+    except (OSError, http.client.HTTPException,
+            nedresolve.ResolveError) as err:
+        print('Could not fetch the NED index:', err)
+        neds, sessionID = list(), ''
+
+    # Create a new list containing the NED urls we're interested in,
+    # and add them to the store
+    toDownload = nedresolve.download_pages(neds, sessionID, outDir, host)
+    store.discover([(ned['name'], ned['desc'], ned['new_url'],
+                     ned_file_name(ned)) for ned in toDownload])
+    if len(neds)==0:
+        print("An error occured fetching the NED URLs!")
+        counts = store.counts()
+        if not (counts.get(jobstore.RESOLVED) or
+                counts.get(jobstore.DOWNLOADING)):
+            exit(2)
+    jobstore.print_counts(store)
+
+    # Start downloading the NEDs concurrently
+    # The scheduler runs in a background thread, and each NED is added
+    # to it as soon as its URL is known
+    def progress(job, sofar, total):
+        store.progress(job.info['name'], sofar, total)
+    # Each archive is unzipped and cataloged while the rest download
+    # Only ingesting needs GDAL, so nedingest is only imported for it
+    ingester = None
+    if ingestDb is not None:
+        import nedingest
+        stages = [nedingest.command_stage(command) for command in commands]
+        ingester = nedingest.Ingester(ingestDb, outDir, ingestWorkers,
+                                      deleteZips, stages)
+    def report(result):
+        print(result)
+        if result.ok:
+            store.done(result.job.info['name'], os.path.getsize(result.job.fname))
+            if ingester is not None:
+                ingester.add(result.job.fname)
+        else:
+            store.failed(result.job.info['name'], result.error)
+        feeder.finished()
+    sched = scheduler.DownloadScheduler(progress=progress, **schedOpts)
+    feeder = StoreFeeder(store, sched)
+    sched.start(report)
+    # Jobs are claimed a batch at a time, and only when the downloader
+    # has room for them, so other processes working from the same store
+    # get a share.  The claims held while jobs wait their turn are kept
+    # fresh until the run is over
+    heartbeat = jobstore.Heartbeat(store)
+    batchSize = max(1, resolvers)
+    room = sched.maxWorkers + batchSize
     rv = 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        fd = FancyDownloader(toDownload, executor)
-        fd.show()
-        rv = app.exec_()
+    try:
+        def job_file_name(job):
+            return job['fname']
+        resolver = None
+        if useWebKit:
+            import nedwebkit
+        else:
+            resolver = nedresolve.Resolver(workers=resolvers,
+                                           pollInterval=pollInterval)
+        while True:
+            feeder.wait_for_room(room)
+
+            # Jobs that already have a URL go straight to the downloader,
+            # partial downloads are resumed
+            toDownload = store.claim([jobstore.RESOLVED, jobstore.DOWNLOADING],
+                                     limit=batchSize)
+            for job in toDownload:
+                job['new_url'] = job['page_url']
+                feeder.resume(job['url'], job['fname'], job)
+
+            # The rest need their URLs resolved first
+            toResolve = store.claim([jobstore.DISCOVERED], limit=batchSize)
+            for job in toResolve:
+                job['new_url'] = job['page_url']
+            if not toDownload and not toResolve:
+                break
+            if not toResolve:
+                continue
+            if useWebKit:
+                rv = nedwebkit.run(toResolve, feeder, job_file_name) or rv
+            else:
+                for job, err in resolver.feed(toResolve, feeder,
+                                              job_file_name):
+                    store.failed(job['name'], err)
+                    rv = 1
+        results = sched.join()
+    except BaseException:
+        # Stop the downloads on Ctrl-C or an error instead of waiting for
+        # them, or the scheduler's and ingester's threads keep the process
+        # alive
+        sched.cancel()
+        if ingester is not None:
+            ingester.cancel()
+        raise
+    finally:
+        heartbeat.stop()
+        store.release()
+    scheduler.print_summary(results)
+    if ingester is not None:
+        if ingester.join():
+            rv = 1
+    jobstore.print_counts(store)
+    store.close()
+    if rv == 0 and any(not r.ok for r in results):
+        rv = 1
 
     # Bye
     sys.exit(rv)
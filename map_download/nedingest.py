@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# nedingest.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Unzip downloaded NED archives and add their grids to the catalog
+
+# neddown.py used to leave a pile of .zip files that had to be unzipped
+# by hand before pngtiler or hmrender could read the .adf files.
+# An Ingester takes each archive as soon as its download finishes and,
+# on a pool of worker processes:
+#   - extracts it, with zipfile checking the CRC of every member, into
+#     a temporary directory that's renamed into place when it's complete
+#   - optionally deletes the .zip
+#   - reads the size, geotransform and bounds of each grid in it
+# The results are written to the catalog (rasters and file_state, so
+# mapdb.py --harvest doesn't open them again) by one thread, which then
+# passes each grid on to the next stages, like tiling or statistics.
+# The stages run on their own pool of threads, so a slow one doesn't
+# hold up the catalog writes for the archives behind it.
+
+# Usage:
+#     ./nedingest.py [--workers=N] [--delete-zips] [--then=command]
+#                    <catalog.db> <output_directory> file.zip [file.zip ...]
+#         command is run for each grid after it's ingested, with {path}
+#         (the grid's hdr.adf), {dir} (the grid's directory) and {name}
+#         (the archive's name) filled in
+
+import os
+import sys
+import queue
+import shutil
+import os.path
+import zipfile
+import threading
+import subprocess
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+
+import catalog
+import mapdb
+
+# Bytes copied at a time while extracting
+COPY_SIZE = 1024 * 1024
+
+# Extract every member of zipPath into destDir
+# Reading a member to the end makes zipfile check its CRC, and a bad
+# one raises zipfile.BadZipFile
+# Nothing shows up in destDir unless the whole archive is good
+def extract_zip(zipPath, destDir):
+    tmpDir = destDir + '.partial'
+    if os.path.exists(tmpDir):
+        shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+    root = os.path.realpath(tmpDir)
+    try:
+        with zipfile.ZipFile(zipPath) as zf:
+            for info in zf.infolist():
+                outPath = os.path.realpath(os.path.join(tmpDir, info.filename))
+                # Don't let a strange archive write outside of destDir
+                if not outPath.startswith(root + os.sep):
+                    raise zipfile.BadZipFile('Bad member name {}'.format(
+                        info.filename))
+                if info.is_dir():
+                    os.makedirs(outPath, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(outPath), exist_ok=True)
+                with zf.open(info) as src, open(outPath, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, COPY_SIZE)
+    except BaseException:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        raise
+    if os.path.exists(destDir):
+        shutil.rmtree(destDir)
+    os.replace(tmpDir, destDir)
+
+# The directory a NED archive is extracted to
+def ingest_dir(zipPath, outDir):
+    name = os.path.basename(zipPath)
+    if name.lower().endswith('.zip'):
+        name = name[:-4]
+    return os.path.join(outDir, name)
+
+# Worker process entry point
+# Extracts zipPath and reads every grid in it
+# Returns (zipPath, [(record, size, mtime_ns), ...], None)
+# or (zipPath, None, error message)
+def ingest_zip(zipPath, outDir, deleteZip=False):
+    try:
+        destDir = ingest_dir(zipPath, outDir)
+        extract_zip(zipPath, destDir)
+        grids = list()
+        for path, size, mtime in mapdb.find_rasters(destDir):
+            grids.append((mapdb.read_raster_info(path), size, mtime))
+        if not grids:
+            raise ValueError('No grids in {}'.format(zipPath))
+        if deleteZip:
+            os.remove(zipPath)
+        return zipPath, grids, None
+    except Exception as err:
+        return zipPath, None, str(err)
+
+# A next stage that runs a command line for each grid
+# command is formatted with path, dir and name
+def command_stage(command):
+    def run(rec, zipPath):
+        name = os.path.basename(ingest_dir(zipPath, ''))
+        cmd = command.format(path=rec['path'],
+                             dir=os.path.dirname(rec['path']), name=name)
+        rv = subprocess.call(cmd, shell=True)
+        if rv != 0:
+            raise RuntimeError('"{}" returned {}'.format(cmd, rv))
+    return run
+
+# Ingests archives in the background as they're added
+# stages are called in order with (record, zipPath) for each grid once
+# it's in the catalog, on a pool of stage threads
+class Ingester(object):
+    def __init__(self, dbFileName, outDir, workers=None, deleteZip=False,
+                 stages=()):
+        self.dbFileName = dbFileName
+        self.outDir = outDir
+        self.deleteZip = deleteZip
+        self.stages = list(stages)
+        # Workers are started as archives come in, from whatever thread
+        # adds them, and forking a process with threads running can
+        # deadlock, so they're spawned instead
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        self.stagePool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self.finished = queue.Queue()
+        self.numAdded = 0
+        self.numDone = 0
+        self.errors = list()
+        self.lock = threading.Lock()
+        self.cancelled = False
+        # A daemon, so an error elsewhere can't leave it keeping the
+        # process alive
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    # Queue an archive to be ingested
+    def add(self, zipPath):
+        self.numAdded += 1
+        try:
+            fut = self.executor.submit(ingest_zip, zipPath, self.outDir,
+                                       self.deleteZip)
+        except concurrent.futures.process.BrokenProcessPool as err:
+            self._failed(zipPath, 'Worker process died: {}'.format(err))
+            return
+        fut.add_done_callback(lambda fut: self.finished.put((zipPath, fut)))
+
+    def _failed(self, path, err):
+        print('Could not ingest {}: {}'.format(path, err))
+        with self.lock:
+            self.errors.append((path, err))
+
+    # Writer thread: record each archive's grids as soon as they're read
+    def _write(self):
+        dbc = catalog.connect(self.dbFileName)
+        while True:
+            item = self.finished.get()
+            if item is None or self.cancelled:
+                break
+            zipPath, fut = item
+            self.numDone += 1
+            # A worker process that died takes the pool, and every
+            # archive still in it, with it
+            try:
+                zipPath, grids, err = fut.result()
+            except concurrent.futures.process.BrokenProcessPool as brokenErr:
+                err = 'Worker process died: {}'.format(brokenErr)
+            if err is not None:
+                self._failed(zipPath, err)
+                continue
+            recs = [rec for rec, size, mtime in grids]
+            with dbc:
+                catalog.upsert_rasters(dbc, recs)
+                catalog.save_file_states(dbc, [(rec['path'], size, mtime, None)
+                                               for rec, size, mtime in grids])
+            print('Ingested {} ({} grids)'.format(zipPath, len(recs)))
+            try:
+                for rec in recs if self.stages else ():
+                    self.stagePool.submit(self._run_stages, rec, zipPath)
+            except RuntimeError:
+                # cancel() shut the stage pool down
+                break
+        dbc.close()
+
+    # Stage thread: run every stage for one grid
+    def _run_stages(self, rec, zipPath):
+        for stage in self.stages:
+            try:
+                stage(rec, zipPath)
+            except Exception as err:
+                print('Stage failed for {}: {}'.format(rec['path'], err))
+                with self.lock:
+                    self.errors.append((rec['path'], str(err)))
+
+    # Wait for every archive to be ingested and every stage to finish
+    # Returns a list of (path, error) for the ones that failed
+    def join(self):
+        self.executor.shutdown(wait=True)
+        self.finished.put(None)
+        self.thread.join()
+        self.stagePool.shutdown(wait=True)
+        return self.errors
+
+    # Stop without waiting, on Ctrl-C or an error
+    # Archives that haven't started aren't ingested, and the writer
+    # thread stops after the one it's on
+    def cancel(self):
+        self.cancelled = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.stagePool.shutdown(wait=False, cancel_futures=True)
+        self.finished.put(None)
+
+def main(args):
+    workers = None
+    deleteZip = False
+    stages = list()
+    rest = list()
+    for arg in args:
+        if arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):])
+        elif arg == '--delete-zips':
+            deleteZip = True
+        elif arg.startswith('--then='):
+            stages.append(command_stage(arg[len('--then='):]))
+        else:
+            rest.append(arg)
+    if len(rest) < 3:
+        print('Syntax is:')
+        print('\t./nedingest.py [--workers=N] [--delete-zips] [--then=command]')
+        print('\t               <catalog.db> <output_directory> file.zip [file.zip ...]')
+        sys.exit(1)
+
+    ingester = Ingester(rest[0], rest[1], workers, deleteZip, stages)
+    for zipPath in rest[2:]:
+        ingester.add(zipPath)
+    errors = ingester.join()
+    print('{} archives, {} errors'.format(ingester.numAdded, len(errors)))
+    if errors:
+        sys.exit(1)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
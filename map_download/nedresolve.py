@@ -0,0 +1,293 @@
+# nedresolve.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Find the download URLs of NED cells without a web browser
+
+# neddown.py originally loaded each NED's download page in a QWebView
+# and waited for the Javascript on it to come up with a link to the
+# .zip file.  That needs an X display and only does one cell at a time.
+
+# All the Javascript really does is follow the session redirects and
+# reload the page until the server has the data ready, so this does the
+# same thing over plain HTTP:
+#   - 3xx responses and "Object moved" pages are followed, keeping the
+#     (S(...)) session ID the server puts in the URL
+#   - a page without a downloadID link yet is fetched again after a
+#     short wait, up to a limit
+# Many cells are resolved at once by a pool of threads, and each URL is
+# handed off (usually to a DownloadScheduler) as soon as it's found.
+
+# The host is a parameter everywhere so all of this can be pointed at a
+# local stand-in server.
+
+import re
+import time
+import html.parser
+import urllib.parse
+import concurrent.futures
+
+import fetcher
+
+# Where the NED index and download pages live
+NED_HOST = 'gisdata.usgs.gov'
+
+INDEX_PATH = '/XMLWebServices2/getTDDSDownloadURLs.aspx?XMin={}&YMin={}&XMax={}&YMax={}&EPSG=4326&STATE=&COUNTY=#'
+
+# Choices are:
+# 'National Elevation Dataset (1 arc second) Pre-packaged ArcGrid format'
+# 'National Elevation Dataset (1/3 arc second) Pre-packaged ArcGrid format'
+# 'National Elevation Dataset (1 arc second) Pre-packaged Float format'
+# 'National Elevation Dataset (1/3 arc second) Pre-packaged Float format'
+WANTED_FORMAT = 'National Elevation Dataset (1/3 arc second) Pre-packaged ArcGrid format'
+
+# Most redirects and "Object moved" retries followed for one page
+MAX_MOVES = 5
+
+# The session ID ASP.NET puts in the path, like /(S(abc123))/
+SESSION_RX = re.compile(r'.*(\(S\(.+\)\)).*')
+
+# Raised when a page can't be fetched or never gets a download link
+class ResolveError(Exception):
+    pass
+
+# Simple parser to grab the final URL of the data
+class LinkParser(html.parser.HTMLParser):
+    def __init__(self):
+        super(LinkParser, self).__init__()
+        self.url = None
+    def handle_starttag(self, tag, attrs):
+        if tag=='a':
+            for at,val in attrs:
+                if at=='href':
+                    self.url = val
+
+# This is a mess
+# Parse the page at
+# http://gisdata.usgs.gov/XMLWebServices2/getTDDSDownloadURLs.aspx?XMin=
+# -109.2&YMin=35.8&XMax=-101.9&YMax=42.1&EPSG=4326&STATE=Colorado&COUNTY=#
+# and look for links to NED data
+# It's more or less a crude state machine based on emperical observations
+# of the page's HTML and some experimentation.
+# If the page layout is changed in any way, this will probably break.
+# But until then...
+
+# Also, it's slightly complicated by the fact that the first request
+# always (almost always) sends a "retry" with <a> link to a new URL
+# So this catches that.
+class MyHTMLParser(html.parser.HTMLParser):
+    def __init__(self):
+        super(MyHTMLParser, self).__init__()
+        self.curNed = dict()
+        self.neds = list()
+        self.state = 0
+        self.retryUrl = None
+        self.DEFAULT_STATE = 0
+        self.NAME_STATE = 1
+        self.TITLE_STATE = 2
+        self.TR_STATE=3
+        self.RETRY_STATE = 999
+        self.curDesc = ''
+
+    def handle_starttag(self, tag, attrs):
+        # Have to look at title tags to see if the title is
+        # "Object moved", which is the cue that the page
+        # needs to be fetched again at a new URL
+        if tag=='title':
+            self.state = self.TITLE_STATE
+
+        # First handle_data after a <tr> returns the
+        # type of data being linked to a couple rows over
+        # We need to save this description for later so that
+        # the appropriate links are followed
+        elif tag=='tr':
+            self.state = self.TR_STATE
+
+        # <a> tags that contain the actual links
+        elif tag=='a':
+            for at,val in attrs:
+                # Of course using href would be too easy
+                if at=='onclick':
+                    # Set curTiff's image url
+                    self.curNed['url'] = val
+                    self.curNed['desc'] = self.curDesc
+                    # Switch to the 'name' state, indicating that the
+                    # next handle_data will be the name of the NED link
+                    self.state = self.NAME_STATE
+                # But if a retry is necessary, it uses href,
+                # so check for that
+                elif at=='href' and self.state ==self.RETRY_STATE:
+                    # print('Retry at:',val)
+                    self.retryUrl = val
+
+    # </a> is as good a place as any to add the current NED to the list
+    def handle_endtag(self, tag):
+        if tag=='a' and self.curNed.get('url',None) is not None :
+            self.neds.append(self.curNed)
+            # and reset
+            self.curNed = dict()
+
+    # Handle data and reset state
+    def handle_data(self, data):
+        # Name of the current NED
+        # something like n<lat>w<long>
+        if self.state == self.NAME_STATE:
+            self.curNed['name'] = data.strip()
+            self.state = self.DEFAULT_STATE
+
+        # Grab the description of the next set of links
+        elif self.state==self.TR_STATE:
+            self.curDesc = data
+            self.state = self.DEFAULT_STATE
+
+        # An 'Object moved' title indicates a retry is necessary,
+        # so check for it and setup the RETRY_STATE if found
+        elif self.state == self.TITLE_STATE:
+            if data=='Object moved':
+                # try again
+                self.state = self.RETRY_STATE
+            else:
+                # Don't try again
+                self.state = self.DEFAULT_STATE
+
+# Fix some screwed up HTML before parsing it
+def fix_html(body):
+    body = body.replace('false;=', 'false=')
+    body = re.sub('onclick=(?=[^"\'])', 'onclick="', body)
+    body = body.replace('false;>', 'false;">')
+    return body
+
+# The (S(...)) session ID in a URL, or '' if there isn't one
+def session_id(url):
+    mtch = SESSION_RX.match(url)
+    if mtch is None:
+        return ''
+    return mtch.group(1)
+
+# GET a page, following HTTP redirects and "Object moved" retries
+# Returns the URL the page finally came from, its (fixed up) HTML, and
+# a MyHTMLParser that has parsed it
+def get_page(url, pool=fetcher.defaultPool):
+    for i in range(MAX_MOVES):
+        conn, resp = fetcher.pooled_request(pool, 'GET', url)
+        body = resp.read()
+        location = resp.getheader('Location')
+        if resp.will_close:
+            conn.close()
+        else:
+            parts = urllib.parse.urlsplit(url)
+            pool.put(parts.scheme, parts.netloc, conn)
+
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            url = urllib.parse.urljoin(url, urllib.parse.unquote(location))
+            continue
+        if resp.status != 200:
+            raise ResolveError('HTTP {} {} for {}'.format(resp.status,
+                                                          resp.reason, url))
+
+        body = fix_html(body.decode('utf-8', 'replace'))
+        parser = MyHTMLParser()
+        parser.feed(body)
+        if parser.retryUrl is not None:
+            url = urllib.parse.urljoin(url,
+                                       urllib.parse.unquote(parser.retryUrl))
+            continue
+        return url, body, parser
+    raise ResolveError('Too many redirects for {}'.format(url))
+
+# Fetch the index of NED cells covering a lon/lat bounding box
+# Returns the list of NED dictionaries and the session ID
+def fetch_index(xmin, ymin, xmax, ymax, host=NED_HOST,
+                pool=fetcher.defaultPool):
+    url = 'http://' + host + INDEX_PATH.format(xmin, ymin, xmax, ymax)
+    finalUrl, body, parser = get_page(url, pool)
+    return parser.neds, session_id(finalUrl)
+
+# Pick out the NEDs of the wanted format and work out their download
+# page URLs from the Javascript in their onclick attributes
+def download_pages(neds, sessionID, outDir, host=NED_HOST,
+                   wantedFormat=WANTED_FORMAT):
+    toDownload = list()
+    for ned in neds:
+        if ned['desc']==wantedFormat:
+            nt = ned
+            rawUrl = nt['url']
+            # Remove the Javascript cruft and create the actual URLs
+            newUrl = rawUrl.replace('window.open(\'', '/XMLWebServices2/'+sessionID+'/')
+            newUrl = newUrl.replace("','downloadWin','left=100,top=100,width=600,height=500'); return false;", '')
+            newUrl = 'http://' + host + newUrl
+            nt['new_url'] = newUrl
+            nt['out_dir'] = outDir
+            toDownload.append(nt)
+    return toDownload
+
+# Get the final download URL from a NED's download page
+# The page is reloaded every pollInterval seconds until the server puts
+# a downloadID link on it, at most polls times
+def resolve_url(ned, pool=fetcher.defaultPool, polls=60, pollInterval=5.0):
+    url = ned['new_url']
+    for i in range(polls):
+        url, body, parser = get_page(url, pool)
+        links = LinkParser()
+        links.feed(body)
+        if links.url is not None and links.url.find('downloadID')>0:
+            return urllib.parse.urljoin(url, links.url)
+        time.sleep(pollInterval)
+    raise ResolveError('No download link for {} after {} tries'.format(
+        ned.get('name', url), polls))
+
+# Resolves the download URLs of many NEDs at once
+class Resolver(object):
+    # workers is the number of pages being worked on at the same time
+    # polls and pollInterval are passed on to resolve_url
+    def __init__(self, workers=8, polls=60, pollInterval=5.0, pool=None):
+        self.workers = workers
+        self.polls = polls
+        self.pollInterval = pollInterval
+        if pool is None:
+            pool = fetcher.ConnectionPool(maxIdle=workers)
+        self.pool = pool
+
+    def _resolve(self, ned):
+        try:
+            return ned, resolve_url(ned, self.pool, self.polls,
+                                    self.pollInterval), None
+        except Exception as err:
+            return ned, None, err
+
+    # Generate (ned, url, error) in the order the URLs come back
+    # url is None and error is set if a NED couldn't be resolved
+    def resolve(self, neds):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            futures = [executor.submit(self._resolve, ned) for ned in neds]
+            for fut in concurrent.futures.as_completed(futures):
+                yield fut.result()
+
+    # Resolve neds and add each one to a DownloadScheduler as soon as
+    # its URL is known, downloading to fileName(ned)
+    # Returns a list of (ned, error) for the ones that couldn't be resolved
+    def feed(self, neds, sched, fileName):
+        failed = list()
+        for ned, url, err in self.resolve(neds):
+            if err is not None:
+                print('Could not resolve {}: {}'.format(ned.get('name', ''),
+                                                        err))
+                failed.append((ned, err))
+                continue
+            print('The download URL is:', url)
+            ned['good_url'] = url
+            sched.add(url, fileName(ned), ned)
+        return failed
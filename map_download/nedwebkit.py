@@ -0,0 +1,100 @@
+# nedwebkit.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# The original way neddown.py found NED download URLs, kept for when
+# nedresolve.py can't cope with whatever the server is doing
+
+# A QWebView loads each NED's download page in turn and runs the
+# Javascript on it, and the link it ends up with is added to the
+# download scheduler.  It needs PyQt4 and an X display, and only works
+# on one page at a time.
+
+from PyQt4 import QtWebKit
+from PyQt4 import QtGui
+from PyQt4 import QtCore
+
+import nedresolve
+
+# Dialog box with a QtWebKit control to download and process
+# downloads using Javascript
+class FancyDownloader(QtGui.QDialog):
+    def __init__(self, neds, sched, fileName, parent=None):
+        super(FancyDownloader, self).__init__(parent)
+            
+        # store some info for later
+        self.neds = neds
+        print(self.neds)
+        if len(self.neds)==0:
+            self.close()
+            self.destroy()
+            return
+        self.curNedIdx = 0
+        self.sched = sched
+        self.fileName = fileName
+        print('current idx',self.curNedIdx)
+        print('num neds', len(self.neds))
+        self.curNed = self.neds[self.curNedIdx]
+
+        # Create the web control
+        self.qwp = QtWebKit.QWebView(self)
+        self.qwp.load(QtCore.QUrl(self.curNed['new_url']))
+        self.connect(self.qwp, QtCore.SIGNAL('loadFinished(bool)'),
+                     self.loadFinished)
+
+        htl = QtGui.QHBoxLayout()
+        htl.addWidget(self.qwp)
+        self.setLayout(htl)
+
+    # After each step in the Javascript process a loadFinished() event
+    # is sent.
+    # This event handler parses the current HTML of the WebKit control
+    # and looks for the data URL.
+    def loadFinished(self, ok):
+        print('Got a load finished!')
+        htmlText = self.qwp.page().currentFrame().toHtml().__str__()
+        parser = nedresolve.LinkParser()
+        parser.feed(htmlText)
+        if parser.url is not None and parser.url.find('downloadID')>0:
+            print('The download URL is:', parser.url)
+            self.curNed['good_url'] = parser.url
+            self.sched.add(self.curNed['good_url'], self.fileName(self.curNed),
+                           self.curNed)
+            self.curNedIdx += 1
+            if self.curNedIdx<len(self.neds):
+                self.curNed = self.neds[self.curNedIdx]
+                self.qwp.setUrl(QtCore.QUrl(self.curNed['new_url']))
+            else:
+                print('Done with WebKit, closing and destroying window!')
+                self.close()
+                self.destroy()
+
+            # A possible alternative that doesn't use an HTMLParser:
+            # urlRx = re.compile('.*"(http://extract\.cr\.usgs\.gov/axis2/services/DownloadService/getData\?downloadID=.*)" style.*')
+            # mt = urlRx.match(htmlText)
+            # if mt is not None:
+            #     self.ned['good_url'] = mt.group(1)
+            #     self.sched.add(self.ned['good_url'], ned_file_name(self.ned))
+            # self.reject()
+
+# Run a FancyDownloader over neds and return the application's exit code
+# Can be called again for more neds, reusing the application
+def run(neds, sched, fileName):
+    app = QtGui.QApplication.instance()
+    if app is None:
+        app = QtGui.QApplication([])
+    fd = FancyDownloader(neds, sched, fileName)
+    fd.show()
+    return app.exec_()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# rasterstats.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Elevation statistics for the rasters in the catalog
+
+# pngtiler and hmrender scale each NED cell by its own minimum and
+# maximum, so neighboring cells get different gray levels for the same
+# elevation and there are seams where they meet.  GDAL's minimum and
+# maximum can also be approximate, or missing altogether.
+
+# This reads each raster once, a strip of blocks at a time, and gets
+# the exact minimum and maximum, the mean and standard deviation, and a
+# histogram.  Every histogram uses the same 1 meter bins, so they can
+# be added together, and percentiles for a whole region come out of the
+# catalog without reading any rasters again.
+# Statistics are recomputed when a file's size or time changes.
+
+# Usage:
+#     ./rasterstats.py [--workers=N] [--force] [--scale[=low,high]]
+#                      <catalog.db> [min_lon min_lat max_lon max_lat]
+#         Compute the statistics of any rasters in the box (or in the
+#         catalog) that don't have them, then print the region's
+#         With --scale, only print the elevations at the low and high
+#         percentiles (default 0 and 100, the minimum and maximum),
+#         to pass to pngtiler, hmrender or pyramid.py, like:
+#             set -- $(./rasterstats.py --scale=1,99 catalog.db -106 39 -104 41)
+#             ../tiler/pyramid.py --min=$1 --max=$2 tiles grid/hdr.adf
+
+import sys
+import zlib
+import math
+import concurrent.futures
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+import catalog
+import mapdb
+
+# The histogram bins, which cover every elevation in the country
+HIST_MIN = -500.0
+HIST_MAX = 9000.0
+BIN_SIZE = 1.0
+NUM_BINS = int((HIST_MAX - HIST_MIN) / BIN_SIZE)
+
+# About how many bytes of raster are read at a time
+STRIP_BYTES = 16 * 1024 * 1024
+
+def encode_histogram(hist):
+    return zlib.compress(hist.astype('<i8').tobytes())
+
+def decode_histogram(blob):
+    return np.frombuffer(zlib.decompress(blob), dtype='<i8').astype(np.int64)
+
+# Compute the statistics of band 1 of path
+# Returns a dictionary for catalog.save_stats, without the raster_id
+def compute_stats(path):
+    gdal.UseExceptions()
+    size, mtime = mapdb.file_signature(path)
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    nodata = band.GetNoDataValue()
+
+    # Whole rows of blocks, as many as fit in STRIP_BYTES
+    blockHeight = band.GetBlockSize()[1]
+    rowBytes = width * 8
+    strip = max(1, STRIP_BYTES // (rowBytes * blockHeight)) * blockHeight
+
+    hist = np.zeros(NUM_BINS, dtype=np.int64)
+    minEle = math.inf
+    maxEle = -math.inf
+    count = 0
+    nodataCount = 0
+    total = 0.0
+    totalSq = 0.0
+    for y in range(0, height, strip):
+        data = band.ReadAsArray(0, y, width, min(strip, height - y))
+        data = data.astype(np.float64).ravel()
+        valid = np.isfinite(data)
+        if nodata is not None:
+            valid &= data != nodata
+        values = data[valid]
+        nodataCount += data.size - values.size
+        if values.size == 0:
+            continue
+        minEle = min(minEle, float(values.min()))
+        maxEle = max(maxEle, float(values.max()))
+        count += values.size
+        total += float(values.sum())
+        totalSq += float(np.dot(values, values))
+        bins = ((values - HIST_MIN) / BIN_SIZE).astype(np.int64)
+        np.clip(bins, 0, NUM_BINS - 1, out=bins)
+        hist += np.bincount(bins, minlength=NUM_BINS)
+
+    mean = None
+    stddev = None
+    if count > 0:
+        mean = total / count
+        stddev = math.sqrt(max(0.0, totalSq / count - mean * mean))
+    else:
+        minEle = maxEle = None
+    return dict(path=path, size=size, mtime_ns=mtime, min=minEle, max=maxEle,
+                count=count, nodata_count=nodataCount, mean=mean,
+                stddev=stddev, hist_min=HIST_MIN, bin_size=BIN_SIZE,
+                histogram=encode_histogram(hist))
+
+# Worker process entry point, returns (raster id, stats, error)
+def stats_worker(job):
+    rid, path = job
+    try:
+        return rid, compute_stats(path), None
+    except Exception as err:
+        return rid, None, str(err)
+
+# The rasters in a lon/lat box (or all of them) whose statistics are
+# missing or out of date, as (raster id, path)
+def find_stale(dbc, bbox=None, force=False):
+    if bbox is None:
+        bbox = (-180, -90, 180, 90)
+    recs = catalog.rasters_in_bbox(dbc, *bbox)
+    stats = catalog.raster_stats(dbc, [rec['id'] for rec in recs])
+    stale = list()
+    for rec in recs:
+        # Paletted maps aren't elevations
+        if rec['map_id'] is not None:
+            continue
+        old = stats.get(rec['id'], None)
+        if not force and old is not None:
+            try:
+                if mapdb.file_signature(rec['path']) == (old['size'],
+                                                         old['mtime_ns']):
+                    continue
+            except OSError:
+                continue
+        stale.append((rec['id'], rec['path']))
+    return stale
+
+# Compute the statistics of every raster in bbox that needs it
+# Returns a list of (path, error) for the ones that couldn't be read
+def update_stats(dbFileName, bbox=None, workers=None, force=False,
+                 batchSize=50):
+    dbc = catalog.connect(dbFileName)
+    jobs = find_stale(dbc, bbox, force)
+    paths = dict(jobs)
+    errors = list()
+    batch = list()
+    if jobs:
+        print('Computing statistics for {} rasters'.format(len(jobs)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for rid, stats, err in executor.map(stats_worker, jobs):
+                if err is not None:
+                    errors.append((paths[rid], err))
+                    continue
+                stats['raster_id'] = rid
+                batch.append(stats)
+                if len(batch) >= batchSize:
+                    with dbc:
+                        catalog.save_stats(dbc, batch)
+                    batch = list()
+        if batch:
+            with dbc:
+                catalog.save_stats(dbc, batch)
+    dbc.close()
+    for path, err in errors:
+        print('Could not read {}: {}'.format(path, err))
+    return errors
+
+# Combine the statistics of several rasters into one
+# The result has the same keys as the catalog's, with the histogram as
+# an array, plus 'rasters', the number combined
+def combine(statsList):
+    statsList = [s for s in statsList if s['count']]
+    merged = dict(rasters=len(statsList), min=None, max=None, count=0,
+                  nodata_count=0, mean=None, stddev=None, hist_min=HIST_MIN,
+                  bin_size=BIN_SIZE, histogram=np.zeros(NUM_BINS,
+                                                        dtype=np.int64))
+    if not statsList:
+        return merged
+    total = 0.0
+    totalSq = 0.0
+    for s in statsList:
+        merged['count'] += s['count']
+        merged['nodata_count'] += s['nodata_count']
+        total += s['mean'] * s['count']
+        totalSq += (s['stddev']**2 + s['mean']**2) * s['count']
+        hist = s['histogram']
+        if not isinstance(hist, np.ndarray):
+            hist = decode_histogram(hist)
+        if (s['hist_min'], s['bin_size'], len(hist)) != (HIST_MIN, BIN_SIZE,
+                                                         NUM_BINS):
+            raise ValueError('{} has a different histogram layout'.format(
+                s.get('path', 'A raster')))
+        merged['histogram'] += hist
+    merged['min'] = min(s['min'] for s in statsList)
+    merged['max'] = max(s['max'] for s in statsList)
+    merged['mean'] = total / merged['count']
+    merged['stddev'] = math.sqrt(max(0.0, totalSq / merged['count']
+                                     - merged['mean']**2))
+    return merged
+
+# The elevation below which p percent of the values fall, interpolated
+# within the histogram bin and kept between the exact min and max
+def percentile(stats, p):
+    hist = stats['histogram']
+    if not isinstance(hist, np.ndarray):
+        hist = decode_histogram(hist)
+    if stats['count'] == 0:
+        return None
+    if p <= 0:
+        return stats['min']
+    if p >= 100:
+        return stats['max']
+    target = stats['count'] * p / 100.0
+    cum = np.cumsum(hist)
+    i = int(np.searchsorted(cum, target))
+    before = cum[i-1] if i > 0 else 0
+    frac = (target - before) / float(hist[i]) if hist[i] else 0.0
+    value = stats['hist_min'] + (i + frac) * stats['bin_size']
+    return min(max(float(value), stats['min']), stats['max'])
+
+# The combined statistics of every raster in a lon/lat box that has them
+def region_stats(dbc, minLon, minLat, maxLon, maxLat):
+    recs = catalog.rasters_in_bbox(dbc, minLon, minLat, maxLon, maxLat)
+    stats = catalog.raster_stats(dbc, [rec['id'] for rec in recs])
+    return combine(list(stats.values()))
+
+def main(args):
+    workers = None
+    force = False
+    scale = None
+    rest = list()
+    for arg in args:
+        if arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):])
+        elif arg == '--force':
+            force = True
+        elif arg == '--scale':
+            scale = (0.0, 100.0)
+        elif arg.startswith('--scale='):
+            scale = tuple(float(v) for v in arg[len('--scale='):].split(','))
+        else:
+            rest.append(arg)
+    if len(rest) not in (1, 5) or (scale is not None and len(scale) != 2):
+        print('Syntax is:')
+        print('\t./rasterstats.py [--workers=N] [--force] [--scale[=low,high]]')
+        print('\t                 <catalog.db> [min_lon min_lat max_lon max_lat]')
+        sys.exit(1)
+    bbox = None
+    if len(rest) == 5:
+        bbox = tuple(float(v) for v in rest[1:])
+
+    if scale is not None:
+        # Only the numbers go to stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+    errors = update_stats(rest[0], bbox, workers, force)
+    dbc = catalog.connect(rest[0])
+    stats = region_stats(dbc, *(bbox or (-180, -90, 180, 90)))
+    dbc.close()
+
+    if scale is not None:
+        sys.stdout = stdout
+        if stats['count'] == 0:
+            sys.exit(1)
+        print('{!r} {!r}'.format(percentile(stats, scale[0]),
+                                 percentile(stats, scale[1])))
+        return
+
+    print('{} rasters, {} values, {} nodata'.format(
+        stats['rasters'], stats['count'], stats['nodata_count']))
+    if stats['count']:
+        print('Min={:.3f}, Max={:.3f}, Mean={:.3f}, StdDev={:.3f}'.format(
+            stats['min'], stats['max'], stats['mean'], stats['stddev']))
+        print('Percentiles: ' + ', '.join(
+            '{}%={:.1f}'.format(p, percentile(stats, p))
+            for p in (1, 5, 25, 50, 75, 95, 99)))
+    if errors:
+        sys.exit(1)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,357 @@
+# scheduler.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# asyncio download scheduler shared by mapdown.py and neddown.py
+
+# The scripts used to hand every file to a
+# ThreadPoolExecutor(max_workers=6) and never look at the futures, so
+# failed downloads vanished without a trace.
+# This scheduler limits the number of concurrent downloads per host,
+# optionally limits the request rate and total bandwidth with token
+# buckets, retries failures with exponential backoff, and reports the
+# outcome of every file as it finishes.
+
+# The transfers themselves are done by fetcher.download_file on a
+# thread pool, so they still get keep-alive connections and resuming.
+# Jobs can be added from any thread while the scheduler is running,
+# which lets neddown.py feed it from the Qt event loop.
+
+# Any URL works, including http://127.0.0.1:<port>/..., so it can be
+# pointed at a local stand-in server for testing.
+
+import time
+import random
+import asyncio
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+
+import fetcher
+
+# A token bucket
+# Tokens accumulate at rate per second, up to burst.
+# Taking more tokens than are available "borrows" them, and the caller
+# is told how long to wait until the debt is paid off.  That way a
+# large request doesn't starve, it just waits longer.
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take n tokens and return the number of seconds to wait before
+    # using them
+    def reserve(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # Blocking version, for use from worker threads
+    def consume(self, n=1):
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    # asyncio version
+    async def acquire(self, n=1):
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# A single file to download
+# info is anything the caller wants to get back with the result
+class Job(object):
+    def __init__(self, url, fname, info=None):
+        self.url = url
+        self.fname = fname
+        self.info = info
+
+# The outcome of a Job
+# ok is True if the file is complete on disk, and nbytes is the number
+# of bytes transferred to get it there (0 if it was already there).
+# error is the last exception if it failed.
+class Result(object):
+    def __init__(self, job, ok, nbytes, attempts, elapsed, error=None):
+        self.job = job
+        self.ok = ok
+        self.nbytes = nbytes
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.error = error
+
+    def __str__(self):
+        if self.ok:
+            return 'OK     {} ({} bytes in {:.1f}s)'.format(self.job.fname,
+                                                          self.nbytes,
+                                                          self.elapsed)
+        return 'FAILED {} after {} tries: {}'.format(self.job.fname,
+                                                     self.attempts,
+                                                     self.error)
+
+# The error of a job that was stopped by DownloadScheduler.cancel
+class Cancelled(Exception):
+    pass
+
+# Errors that are worth trying again
+# Client errors like 404 aren't going to fix themselves
+def is_retryable(err):
+    if isinstance(err, fetcher.DownloadError):
+        return err.status is None or err.status >= 500 or err.status == 429
+    return isinstance(err, (OSError, http.client.HTTPException))
+
+class DownloadScheduler(object):
+    # perHost is the number of simultaneous downloads from one host
+    # maxWorkers is the total number of simultaneous downloads
+    # requestRate limits new requests per second, bandwidth limits
+    # bytes per second over all downloads (None means no limit)
+    # retries is the number of extra attempts after a failure, waiting
+    # backoff * 2**attempt seconds (plus some jitter) in between
+    # progress, if given, is called with (job, bytesSoFar, totalBytes)
+    # from the download threads as each file comes in
+    def __init__(self, perHost=4, maxWorkers=None, requestRate=None,
+                 bandwidth=None, retries=3, backoff=1.0, verify=True,
+                 pool=None, progress=None):
+        self.perHost = perHost
+        if maxWorkers is None:
+            maxWorkers = perHost * 4
+        self.maxWorkers = maxWorkers
+        self.retries = retries
+        self.backoff = backoff
+        self.verify = verify
+        self.progress = progress
+
+        self.requestBucket = None
+        if requestRate:
+            self.requestBucket = TokenBucket(requestRate)
+        self.bandwidthBucket = None
+        if bandwidth:
+            # Allow a second's worth of burst, but at least one chunk
+            self.bandwidthBucket = TokenBucket(bandwidth,
+                                               max(bandwidth,
+                                                   fetcher.CHUNK_SIZE))
+
+        if pool is None:
+            pool = fetcher.ConnectionPool(maxIdle=maxWorkers)
+        self.pool = pool
+
+        self.pending = list()
+        self.closed = False
+        self.cancelled = False
+        self.loop = None
+        self.queue = None
+        self.thread = None
+        self.results = list()
+        self.lock = threading.Lock()
+
+    # Queue url to be downloaded to fname
+    # Safe to call from any thread, before or after the scheduler starts
+    def add(self, url, fname, info=None):
+        self._put(Job(url, fname, info))
+
+    # Signal that no more jobs will be added
+    def close(self):
+        self._put(None)
+
+    def _put(self, job):
+        with self.lock:
+            if job is None:
+                if self.closed:
+                    return
+                self.closed = True
+            elif self.closed:
+                raise RuntimeError('add() called after close()')
+            if self.loop is None:
+                self.pending.append(job)
+                return
+            loop = self.loop
+        loop.call_soon_threadsafe(self.queue.put_nowait, job)
+
+    # Download one job, with retries
+    async def _download(self, job, hostSems, executor):
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(job.url).netloc
+        start = time.monotonic()
+        attempt = 0
+        nbytes = 0
+        async with hostSems.setdefault(host, asyncio.Semaphore(self.perHost)):
+            while True:
+                if self.cancelled:
+                    return Result(job, False, nbytes, attempt,
+                                  time.monotonic() - start,
+                                  Cancelled('Cancelled'))
+                attempt += 1
+                if self.requestBucket is not None:
+                    await self.requestBucket.acquire()
+                try:
+                    nbytes += await loop.run_in_executor(
+                        executor, self._fetch, job)
+                    return Result(job, True, nbytes, attempt,
+                                  time.monotonic() - start)
+                except Exception as err:
+                    if attempt > self.retries or not is_retryable(err):
+                        return Result(job, False, nbytes, attempt,
+                                      time.monotonic() - start, err)
+                    delay = self.backoff * 2**(attempt-1)
+                    await asyncio.sleep(delay * (0.5 + random.random()))
+
+    # A cancelled download stops at its next chunk, and its .part file
+    # is kept to be resumed
+    def _fetch(self, job):
+        def progress(sofar, total):
+            if self.cancelled:
+                raise Cancelled('Cancelled')
+            if self.progress is not None:
+                self.progress(job, sofar, total)
+        return fetcher.download_file(job.url, job.fname, self.pool,
+                                     verify=self.verify, progress=progress,
+                                     limiter=self.bandwidthBucket)
+
+    # Async generator yielding a Result for each job as it finishes
+    # Ends once close() has been called and every job is done
+    async def stream(self):
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue()
+            for job in self.pending:
+                self.queue.put_nowait(job)
+            self.pending = list()
+
+        hostSems = dict()
+        done = asyncio.Queue()
+        running = 0
+        moreJobs = True
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.maxWorkers)
+
+        async def run_job(job):
+            await done.put(await self._download(job, hostSems, executor))
+
+        getter = None
+        doneGetter = None
+        try:
+            while moreJobs or running > 0:
+                if moreJobs and getter is None:
+                    getter = asyncio.ensure_future(self.queue.get())
+                if doneGetter is None:
+                    doneGetter = asyncio.ensure_future(done.get())
+                waitFor = [doneGetter]
+                if getter is not None:
+                    waitFor.append(getter)
+                await asyncio.wait(waitFor,
+                                   return_when=asyncio.FIRST_COMPLETED)
+
+                if getter is not None and getter.done():
+                    job = getter.result()
+                    getter = None
+                    if job is None:
+                        moreJobs = False
+                    else:
+                        running += 1
+                        asyncio.ensure_future(run_job(job))
+
+                if doneGetter.done():
+                    result = doneGetter.result()
+                    doneGetter = None
+                    running -= 1
+                    yield result
+        finally:
+            for fut in (getter, doneGetter):
+                if fut is not None:
+                    fut.cancel()
+            executor.shutdown(wait=False)
+
+    # Run until every job is done, calling report with each Result
+    # Returns the list of Results
+    def run(self, report=print):
+        async def collect():
+            async for result in self.stream():
+                self.results.append(result)
+                if report is not None:
+                    report(result)
+        asyncio.run(collect())
+        self.pool.close()
+        return self.results
+
+    # Run the scheduler in a background thread
+    def start(self, report=print):
+        self.thread = threading.Thread(target=self.run, args=(report,))
+        self.thread.start()
+
+    # close() the scheduler and wait for the background thread to finish
+    # Returns the list of Results
+    def join(self):
+        self.close()
+        self.thread.join()
+        return self.results
+
+    # Stop without waiting for the jobs that are left: the ones that
+    # haven't started fail with Cancelled, and the running ones stop at
+    # their next chunk
+    # Waits for the background thread, if there is one, and returns the
+    # list of Results
+    def cancel(self):
+        self.cancelled = True
+        self.close()
+        if self.thread is not None:
+            self.thread.join()
+        return self.results
+
+# Print a one line summary of a list of Results
+def print_summary(results):
+    failed = [r for r in results if not r.ok]
+    nbytes = sum(r.nbytes for r in results)
+    print('{} files, {} failed, {:.1f} MB transferred'.format(
+        len(results), len(failed), nbytes / (1024.0*1024.0)))
+    for r in failed:
+        print(r)
+
+# Pull the scheduler options out of a command line
+# Returns a dictionary of keyword arguments for DownloadScheduler,
+# starting from defaults, and the remaining arguments
+# --per-host=N       simultaneous downloads per host
+# --workers=N        total simultaneous downloads
+# --rate=N           new requests per second
+# --bandwidth=N      kilobytes per second over all downloads
+# --retries=N        extra attempts after a failure
+def parse_options(args, **defaults):
+    opts = dict(defaults)
+    rest = list()
+    names = {'--per-host': ('perHost', int),
+             '--workers': ('maxWorkers', int),
+             '--rate': ('requestRate', float),
+             '--bandwidth': ('bandwidth', float),
+             '--retries': ('retries', int)}
+    for arg in args:
+        name = arg.split('=')[0]
+        if name in names and '=' in arg:
+            key, conv = names[name]
+            opts[key] = conv(arg[arg.index('=')+1:])
+        else:
+            rest.append(arg)
+    if 'bandwidth' in opts:
+        opts['bandwidth'] *= 1024
+    return opts, rest
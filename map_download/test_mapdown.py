@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# test_mapdown.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Checks that MyHTMLParser reads the same rows from an index page no
+# matter how the page is split up as it arrives
+
+# Usage:
+#     ./test_mapdown.py
+
+import io
+import unittest
+
+import mapdown
+import bench_servers
+
+# Parse body with feed_response, reading chunkSize bytes at a time
+def parse_chunked(body, chunkSize):
+    rows = []
+    mapdown.feed_response(mapdown.MyHTMLParser(rows.append),
+                          io.BytesIO(body), chunkSize)
+    return rows
+
+class TestIndexParser(unittest.TestCase):
+    def setUp(self):
+        site = bench_servers.LibremapSite(count=50)
+        self.body, etag = site.index('localhost')
+
+        parser = mapdown.MyHTMLParser()
+        parser.feed(self.body.decode('utf-8'))
+        parser.close()
+        self.rows = parser.tiffs
+
+    def test_whole_page(self):
+        self.assertEqual(len(self.rows), 50)
+        self.assertEqual(self.rows[0]['ID'], '1')
+        self.assertEqual(self.rows[0]['Cell Name'], 'Quad 1')
+        self.assertTrue(self.rows[0]['url'].endswith('drg000001.tif'))
+
+    def test_small_chunks(self):
+        for chunkSize in (1, 7, 64, 1000):
+            self.assertEqual(parse_chunked(self.body, chunkSize), self.rows,
+                             'chunkSize={}'.format(chunkSize))
+
+if __name__ == '__main__':
+    unittest.main()
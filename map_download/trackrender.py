@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+# trackrender.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Plot GPS tracks on the topo maps, stitching maps together as needed
+
+# The track (GPX or NMEA) is read as a stream, the maps it crosses are
+# looked up in the catalog (see mapdb.py --harvest), and every point is
+# projected into each map's pixel space with NumPy.
+# The output image is split into blocks, and only the blocks the track
+# passes through (plus a margin) are filled in.  Each of those reads
+# just the matching window out of each map, so a long track across
+# dozens of quads never has a whole GeoTIFF in memory.
+
+# Usage:
+#     ./trackrender.py [options] <catalog.db> <output.tif> <track> [track ...]
+# Options:
+#     --margin=N   pixels of map to show around the track (default 256)
+#     --scale=N    output pixel size as a multiple of the maps' (default 1)
+#     --width=N    width of the track line in pixels (default 3)
+
+import sys
+import array
+import math
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+    from osgeo import osr
+except ImportError:
+    import gdal
+    import osr
+
+import catalog
+import utm
+
+# Size of the output blocks
+BLOCK_SIZE = 512
+
+# Color of the track line
+TRACK_COLOR = (255, 0, 0)
+
+# GPX files are read with iterparse, clearing elements as they're used,
+# so memory doesn't grow with the file size
+# Yields (lon, lat) for every track and route point, and (nan, nan)
+# at the end of each segment so separate segments aren't joined up
+def read_gpx(fileName):
+    for event, elem in ET.iterparse(fileName, events=('end',)):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag in ('trkpt', 'rtept'):
+            yield float(elem.get('lon')), float(elem.get('lat'))
+            elem.clear()
+        elif tag in ('trkseg', 'rte'):
+            yield float('nan'), float('nan')
+            elem.clear()
+        elif tag == 'trk':
+            elem.clear()
+
+# Convert an NMEA ddmm.mmmm value and hemisphere to degrees
+def nmea_degrees(value, hemi):
+    dot = value.index('.')
+    deg = float(value[:dot-2]) + float(value[dot-2:]) / 60.0
+    if hemi in ('S', 'W'):
+        deg = -deg
+    return deg
+
+# Check the *hh checksum on an NMEA sentence, if it has one
+def nmea_checksum_ok(line):
+    if '*' not in line:
+        return True
+    body, check = line[1:].split('*', 1)
+    calc = 0
+    for ch in body:
+        calc ^= ord(ch)
+    try:
+        return calc == int(check[:2], 16)
+    except ValueError:
+        return False
+
+# Read GGA and RMC sentences out of an NMEA log, a line at a time
+# Yields (lon, lat)
+def read_nmea(fileName):
+    last = None
+    with open(fileName, errors='replace') as inf:
+        for line in inf:
+            line = line.strip()
+            if len(line) < 7 or line[0] != '$' or not nmea_checksum_ok(line):
+                continue
+            fields = line.split('*')[0].split(',')
+            kind = fields[0][3:]
+            try:
+                if kind == 'GGA' and fields[6] not in ('', '0'):
+                    pt = (nmea_degrees(fields[4], fields[5]),
+                          nmea_degrees(fields[2], fields[3]))
+                elif kind == 'RMC' and fields[2] == 'A':
+                    pt = (nmea_degrees(fields[5], fields[6]),
+                          nmea_degrees(fields[3], fields[4]))
+                else:
+                    continue
+            except (IndexError, ValueError):
+                continue
+            # GGA and RMC usually come in pairs for the same fix
+            if pt != last:
+                yield pt
+                last = pt
+
+# Read a track file into arrays of longitudes and latitudes
+# NaNs separate track segments
+def read_track(fileName):
+    if fileName.lower().endswith('.gpx'):
+        points = read_gpx(fileName)
+    else:
+        points = read_nmea(fileName)
+    lons = array.array('d')
+    lats = array.array('d')
+    for lon, lat in points:
+        lons.append(lon)
+        lats.append(lat)
+    lons.append(float('nan'))
+    lats.append(float('nan'))
+    return np.frombuffer(lons, dtype=np.float64), np.frombuffer(lats,
+                                                                dtype=np.float64)
+
+# A spatial reference from WKT, with x/y in lon/lat order
+def make_srs(wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+WGS84_WKT = ('GEOGCS["WGS 84",DATUM["WGS_1984",'
+             'SPHEROID["WGS 84",6378137,298.257223563]],'
+             'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]')
+
+# Project lon/lat arrays into the coordinate system in wkt
+# NaNs are passed through
+# UTM on WGS 84 or NAD83 doesn't need a datum shift, so utm.py does it
+# without OSR
+def project_points(lons, lats, wkt):
+    proj = utm.UTM.from_wkt(wkt)
+    if proj is not None and proj.is_wgs84():
+        return proj.forward(lons, lats)
+    trans = osr.CoordinateTransformation(make_srs(WGS84_WKT), make_srs(wkt))
+    xs = np.full(lons.shape, np.nan)
+    ys = np.full(lats.shape, np.nan)
+    good = np.isfinite(lons)
+    if good.any():
+        pts = np.column_stack((lons[good], lats[good]))
+        out = np.array(trans.TransformPoints(pts.tolist()))
+        xs[good] = out[:, 0]
+        ys[good] = out[:, 1]
+    return xs, ys
+
+# The blocks (bx, by) of size blockSize that contain the pixel
+# coordinates px, py, grown by margin pixels in every direction
+def touched_blocks(px, py, blockSize, margin):
+    good = np.isfinite(px) & np.isfinite(py)
+    bx = np.floor(px[good] / blockSize).astype(np.int64)
+    by = np.floor(py[good] / blockSize).astype(np.int64)
+    grow = int(math.ceil(margin / float(blockSize)))
+    blocks = set()
+    for x, y in set(zip(bx.tolist(), by.tolist())):
+        for dy in range(-grow, grow+1):
+            for dx in range(-grow, grow+1):
+                blocks.add((x+dx, y+dy))
+    return blocks
+
+# Color lookup table for a band with a color table, or None
+def band_lut(band):
+    ct = band.GetColorTable()
+    if ct is None:
+        return None
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    for i in range(min(256, ct.GetCount())):
+        lut[i] = ct.GetColorEntry(i)[:3]
+    return lut
+
+# Read a window of a dataset as an RGB array of shape (h, w, 3),
+# resampled to bufWidth x bufHeight, plus a mask of valid pixels
+def read_rgb(dataset, xoff, yoff, w, h, bufWidth, bufHeight):
+    band = dataset.GetRasterBand(1)
+    data = band.ReadAsArray(xoff, yoff, w, h, bufWidth, bufHeight)
+    nodata = band.GetNoDataValue()
+    valid = np.ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid = data != nodata
+    lut = band_lut(band)
+    if lut is not None:
+        rgb = lut[data]
+    elif dataset.RasterCount >= 3:
+        rgb = np.dstack([data] + [dataset.GetRasterBand(i).ReadAsArray(
+            xoff, yoff, w, h, bufWidth, bufHeight) for i in (2, 3)])
+    else:
+        rgb = np.dstack((data, data, data))
+    return rgb.astype(np.uint8), valid
+
+# A map that might be drawn in the output
+class SourceMap(object):
+    def __init__(self, rec):
+        self.rec = rec
+        self.gt = catalog.geotransform(rec)
+        self.dataset = None
+
+    def open(self):
+        if self.dataset is None:
+            self.dataset = gdal.Open(self.rec['path'])
+        return self.dataset
+
+    # Copy the part of this map under an output block into rgb/filled
+    # The block covers world coordinates x0..x1, y1..y0 (y0 > y1)
+    # Only this map's matching window is read
+    def paste(self, outWkt, x0, y0, x1, y1, rgb, filled):
+        h, w = filled.shape
+        if self.rec['projection'] != outWkt:
+            self.paste_warped(outWkt, x0, y0, x1, y1, rgb, filled)
+            return
+        px, py = catalog.world_to_pixel(self.gt, np.array([x0, x1]), np.array([y0, y1]))
+        sx0, sx1 = sorted(px)
+        sy0, sy1 = sorted(py)
+        # Clip to the map
+        cx0 = max(0.0, sx0)
+        cy0 = max(0.0, sy0)
+        cx1 = min(float(self.rec['width']), sx1)
+        cy1 = min(float(self.rec['height']), sy1)
+        if cx1 <= cx0 or cy1 <= cy0:
+            return
+        # Where the clipped window lands in the output block
+        ox0 = int(round((cx0 - sx0) / (sx1 - sx0) * w))
+        oy0 = int(round((cy0 - sy0) / (sy1 - sy0) * h))
+        ox1 = int(round((cx1 - sx0) / (sx1 - sx0) * w))
+        oy1 = int(round((cy1 - sy0) / (sy1 - sy0) * h))
+        if ox1 <= ox0 or oy1 <= oy0:
+            return
+        xoff = int(math.floor(cx0))
+        yoff = int(math.floor(cy0))
+        win = max(1, int(math.ceil(cx1)) - xoff)
+        hin = max(1, int(math.ceil(cy1)) - yoff)
+        data, valid = read_rgb(self.open(), xoff, yoff, win, hin,
+                               ox1 - ox0, oy1 - oy0)
+        valid &= ~filled[oy0:oy1, ox0:ox1]
+        rgb[oy0:oy1, ox0:ox1][valid] = data[valid]
+        filled[oy0:oy1, ox0:ox1] |= valid
+
+    # Maps in another coordinate system are warped by GDAL, which only
+    # reads the source window it needs
+    def paste_warped(self, outWkt, x0, y0, x1, y1, rgb, filled):
+        h, w = filled.shape
+        dataset = self.open()
+        expand = None
+        if dataset.GetRasterBand(1).GetColorTable() is not None:
+            expand = 'rgb'
+        src = gdal.Translate('', dataset, format='VRT', rgbExpand=expand)
+        warped = gdal.Warp('', src, format='MEM', dstSRS=outWkt,
+                           outputBounds=(x0, y1, x1, y0), width=w, height=h,
+                           dstAlpha=True)
+        bands = [warped.GetRasterBand(i+1).ReadAsArray()
+                 for i in range(warped.RasterCount)]
+        valid = (bands[-1] > 0) & ~filled
+        if len(bands) >= 4:
+            data = np.dstack(bands[:3])
+        else:
+            data = np.dstack((bands[0], bands[0], bands[0]))
+        rgb[valid] = data[valid]
+        filled |= valid
+
+# Draw the track segments (xs, ys are output pixel coordinates) into an
+# RGB block whose top left corner is at pixel (bx0, by0)
+# Each segment is sampled at least once per pixel along its length,
+# all segments at once
+def draw_track(rgb, bx0, by0, xs, ys, width, color=TRACK_COLOR):
+    h, w = rgb.shape[:2]
+    pad = width
+    x0 = xs[:-1] - bx0
+    y0 = ys[:-1] - by0
+    x1 = xs[1:] - bx0
+    y1 = ys[1:] - by0
+    keep = np.isfinite(x0) & np.isfinite(x1)
+    keep &= (np.maximum(x0, x1) >= -pad) & (np.minimum(x0, x1) < w + pad)
+    keep &= (np.maximum(y0, y1) >= -pad) & (np.minimum(y0, y1) < h + pad)
+    if not keep.any():
+        return
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    dx = x1 - x0
+    dy = y1 - y0
+    n = np.ceil(np.maximum(np.abs(dx), np.abs(dy))).astype(np.int64) + 1
+    seg = np.repeat(np.arange(len(n)), n)
+    starts = np.cumsum(n) - n
+    t = (np.arange(n.sum()) - starts[seg]) / np.maximum(n[seg] - 1, 1)
+    px = np.rint(x0[seg] + t * dx[seg]).astype(np.int64)
+    py = np.rint(y0[seg] + t * dy[seg]).astype(np.int64)
+    half = width // 2
+    for oy in range(-half, width - half):
+        for ox in range(-half, width - half):
+            qx = px + ox
+            qy = py + oy
+            inside = (qx >= 0) & (qx < w) & (qy >= 0) & (qy < h)
+            rgb[qy[inside], qx[inside]] = color
+
+# Render tracks over the maps in the catalog to outName
+def render(dbFileName, outName, trackFiles, margin=256, scale=1, width=3):
+    lonList = list()
+    latList = list()
+    for fn in trackFiles:
+        lons, lats = read_track(fn)
+        lonList.append(lons)
+        latList.append(lats)
+    lons = np.concatenate(lonList)
+    lats = np.concatenate(latList)
+    good = np.isfinite(lons)
+    if not good.any():
+        print('No track points found')
+        return False
+    print('Read {} track points'.format(int(good.sum())))
+
+    # Maps near the track
+    dbc = catalog.connect(dbFileName)
+    slop = 0.02
+    recs = catalog.rasters_in_bbox(dbc, lons[good].min() - slop,
+                                   lats[good].min() - slop,
+                                   lons[good].max() + slop,
+                                   lats[good].max() + slop)
+    dbc.close()
+    recs = [rec for rec in recs if rec['bands'] > 0 and rec['projection']]
+    if not recs:
+        print('No maps in the catalog cover the track')
+        return False
+
+    # Project the track into every map and keep the ones it crosses,
+    # along with how many points land in each
+    sources = list()
+    projected = dict()
+    for rec in recs:
+        wkt = rec['projection']
+        if wkt not in projected:
+            projected[wkt] = project_points(lons, lats, wkt)
+        xs, ys = projected[wkt]
+        px, py = catalog.world_to_pixel(catalog.geotransform(rec), xs, ys)
+        m = margin * scale
+        inside = ((px >= -m) & (px < rec['width'] + m)
+                  & (py >= -m) & (py < rec['height'] + m))
+        if inside.any():
+            sources.append((int(inside.sum()), SourceMap(rec)))
+    if not sources:
+        print('No maps in the catalog cover the track')
+        return False
+    sources.sort(key=lambda s: -s[0])
+    sources = [s for count, s in sources]
+    print('Track crosses {} maps'.format(len(sources)))
+
+    # The output is in the coordinate system and resolution of the map
+    # with the most track points
+    ref = sources[0].rec
+    outWkt = ref['projection']
+    pixSize = abs(ref['pixel_width']) * scale
+    xs, ys = projected[outWkt]
+    good = np.isfinite(xs)
+    pad = (margin + BLOCK_SIZE) * pixSize
+    originX = math.floor((xs[good].min() - pad) / pixSize) * pixSize
+    originY = math.ceil((ys[good].max() + pad) / pixSize) * pixSize
+    outWidth = int(math.ceil((xs[good].max() + pad - originX) / pixSize))
+    outHeight = int(math.ceil((originY - ys[good].min() + pad) / pixSize))
+    outGt = (originX, pixSize, 0.0, originY, 0.0, -pixSize)
+    tx, ty = catalog.world_to_pixel(outGt, xs, ys)
+
+    blocks = sorted(touched_blocks(tx, ty, BLOCK_SIZE, margin))
+    blocks = [(bx, by) for bx, by in blocks
+              if 0 <= bx*BLOCK_SIZE < outWidth and 0 <= by*BLOCK_SIZE < outHeight]
+    print('Output is {}x{}, drawing {} blocks'.format(outWidth, outHeight,
+                                                      len(blocks)))
+
+    # Only the touched blocks are written, the rest stays empty
+    driver = gdal.GetDriverByName('GTiff')
+    tifName = outName
+    if not outName.lower().endswith(('.tif', '.tiff')):
+        tifName = outName + '.tmp.tif'
+    out = driver.Create(tifName, outWidth, outHeight, 3, gdal.GDT_Byte,
+                        ['TILED=YES', 'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+                         'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+                         'COMPRESS=DEFLATE', 'SPARSE_OK=TRUE',
+                         'PHOTOMETRIC=RGB'])
+    out.SetGeoTransform(outGt)
+    out.SetProjection(outWkt)
+
+    for bx, by in blocks:
+        px0 = bx * BLOCK_SIZE
+        py0 = by * BLOCK_SIZE
+        w = min(BLOCK_SIZE, outWidth - px0)
+        h = min(BLOCK_SIZE, outHeight - py0)
+        x0 = originX + px0 * pixSize
+        y0 = originY - py0 * pixSize
+        x1 = x0 + w * pixSize
+        y1 = y0 - h * pixSize
+        rgb = np.full((h, w, 3), 255, dtype=np.uint8)
+        filled = np.zeros((h, w), dtype=bool)
+        for src in sources:
+            src.paste(outWkt, x0, y0, x1, y1, rgb, filled)
+            if filled.all():
+                break
+        draw_track(rgb, px0, py0, tx, ty, width)
+        for i in range(3):
+            out.GetRasterBand(i+1).WriteArray(rgb[:, :, i], px0, py0)
+    out = None
+
+    if tifName != outName:
+        gdal.Translate(outName, tifName)
+        gdal.GetDriverByName('GTiff').Delete(tifName)
+    print('Wrote', outName)
+    return True
+
+def main(args):
+    opts = dict(margin=256, scale=1, width=3)
+    rest = list()
+    for arg in args:
+        name = arg.split('=')[0][2:]
+        if arg.startswith('--') and name in opts and '=' in arg:
+            opts[name] = int(arg[arg.index('=')+1:])
+        else:
+            rest.append(arg)
+    if len(rest) < 3:
+        print('Syntax is:')
+        print('\t./trackrender.py [--margin=N] [--scale=N] [--width=N] <catalog.db> <output.tif> <track> [track ...]')
+        sys.exit(1)
+    if not render(rest[0], rest[1], rest[2:], **opts):
+        sys.exit(1)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+# utm.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Latitude/longitude <-> UTM with NumPy
+
+# coord_convert used to start Perl and Geo::Coordinates::UTM for every
+# single point.  This converts whole arrays at once, with Kruger's series
+# to the 6th order of n (Karney, "Transverse Mercator with an accuracy of
+# a few nanometers", 2011), which is good to well under a millimeter
+# anywhere in a zone and a long way outside of it.
+# It's only a projection: the latitude and longitude have to be on the
+# same ellipsoid (datum) as the UTM coordinates.  That's always true for
+# the corners and neatlines of a map in its own datum, but a WGS 84 GPS
+# track on a NAD27 map still needs GDAL's datum shift.
+
+# The zone of each point is picked automatically (including the Norway
+# and Svalbard exceptions) unless one is given, and every point can be
+# in a different zone.  Zones are written like Geo::Coordinates::UTM
+# does, with the latitude band letter, so 13S is a northern zone (band S
+# is 32-40 degrees north) and the southern hemisphere is bands C to M.
+
+# The other scripts import this, and UTM.from_wkt recognizes a GDAL
+# coordinate system that is a UTM zone, so they can skip OSR for it.
+
+# Usage:
+#     ./utm.py [--ellipsoid=WGS84] [--zone=N] latitude longitude
+#     ./utm.py --inverse [--ellipsoid=WGS84] zone easting northing
+#         Convert one point, zone is like 13S, or a number with --south
+#     ./utm.py [--inverse] [--ellipsoid=WGS84] [--zone=N] [--south]
+#              [--columns=a,b[,c]] [--chunk=N] [file.csv|-]
+#         Convert a CSV file (or stdin), adding zone, easting and
+#         northing columns (or latitude and longitude with --inverse)
+#         columns are the latitude and longitude (or zone, easting and
+#         northing) columns, by name or number, found from the header
+#         or assumed to be the first ones if not given
+
+import re
+import sys
+import csv
+import math
+import itertools
+
+import numpy as np
+
+# Semi-major axis and inverse flattening
+ELLIPSOIDS = {
+    'WGS84': (6378137.0, 298.257223563),
+    'GRS80': (6378137.0, 298.257222101),
+    'WGS72': (6378135.0, 298.26),
+    'Clarke1866': (6378206.4, 294.9786982),
+    'Clarke1880': (6378249.145, 293.465),
+    'International': (6378388.0, 297.0),
+    'Bessel1841': (6377397.155, 299.1528128),
+    'Airy': (6377563.396, 299.3249646),
+    'Everest': (6377276.345, 300.8017),
+    'Krassovsky': (6378245.0, 298.3),
+    'AustralianNational': (6378160.0, 298.25),
+}
+
+# Datums and other names for the ellipsoids
+ELLIPSOID_ALIASES = {
+    'NAD27': 'Clarke1866',
+    'NAD83': 'GRS80',
+    'ED50': 'International',
+    'Hayford': 'International',
+    'Pulkovo1942': 'Krassovsky',
+    'OSGB36': 'Airy',
+}
+
+K0 = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING_SOUTH = 10000000.0
+
+# Latitude bands, 8 degrees each from 80 south, X is 12 degrees
+BANDS = 'CDEFGHJKLMNPQRSTUVWXX'
+
+# Points converted at a time from CSV
+CHUNK_SIZE = 100000
+
+def normalize_name(name):
+    return re.sub(r'[\s_\-]', '', name).lower()
+
+# (semi-major axis, flattening) of an ellipsoid or datum by name
+def ellipsoid(name):
+    names = dict((normalize_name(n), n) for n in ELLIPSOIDS)
+    names.update((normalize_name(alias), n)
+                 for alias, n in ELLIPSOID_ALIASES.items())
+    key = normalize_name(name)
+    if key not in names:
+        raise ValueError('Unknown ellipsoid {}, use one of {}'.format(
+            name, ', '.join(sorted(ELLIPSOIDS) + sorted(ELLIPSOID_ALIASES))))
+    a, invF = ELLIPSOIDS[names[key]]
+    return a, 1.0 / invF
+
+# The series coefficients for an ellipsoid, worked out once each
+seriesCache = dict()
+
+def series(a, f):
+    key = (a, f)
+    if key in seriesCache:
+        return seriesCache[key]
+    n = f / (2 - f)
+    n2, n3, n4, n5, n6 = n**2, n**3, n**4, n**5, n**6
+    # The radius of the rectifying sphere
+    radius = a / (1 + n) * (1 + n2/4 + n4/64 + n6/256)
+    alpha = (n/2 - 2*n2/3 + 5*n3/16 + 41*n4/180 - 127*n5/288 + 7891*n6/37800,
+             13*n2/48 - 3*n3/5 + 557*n4/1440 + 281*n5/630 - 1983433*n6/1935360,
+             61*n3/240 - 103*n4/140 + 15061*n5/26880 + 167603*n6/181440,
+             49561*n4/161280 - 179*n5/168 + 6601661*n6/7257600,
+             34729*n5/80640 - 3418889*n6/1995840,
+             212378941*n6/319334400)
+    beta = (n/2 - 2*n2/3 + 37*n3/96 - n4/360 - 81*n5/512 + 96199*n6/604800,
+            n2/48 + n3/15 - 437*n4/1440 + 46*n5/105 - 1118711*n6/3870720,
+            17*n3/480 - 37*n4/840 - 209*n5/4480 + 5569*n6/90720,
+            4397*n4/161280 - 11*n5/504 - 830251*n6/7257600,
+            4583*n5/161280 - 108847*n6/3991680,
+            20648693*n6/638668800)
+    e = math.sqrt(f * (2 - f))
+    seriesCache[key] = (radius, alpha, beta, e)
+    return seriesCache[key]
+
+# sum(coeffs[j-1] * sin(2*j*zeta)) for complex zeta, by Clenshaw's method,
+# so there's only one complex sin and cos however many terms there are
+def sin_series(coeffs, zeta):
+    twoCos = 2 * np.cos(2 * zeta)
+    y1 = np.zeros_like(zeta)
+    y2 = np.zeros_like(zeta)
+    for c in reversed(coeffs):
+        y1, y2 = twoCos * y1 - y2 + c, y1
+    return np.sin(2 * zeta) * y1
+
+# The UTM zone of each point, with the Norway and Svalbard exceptions
+# Scalars give a 0-d array, which is worked on as one point
+def zone_of(lons, lats):
+    lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64),
+                                     np.asarray(lats, dtype=np.float64))
+    shape = lons.shape
+    lons = np.atleast_1d(lons)
+    lats = np.atleast_1d(lats)
+    lons = (lons + 180) % 360 - 180
+    zones = np.floor((lons + 180) / 6).astype(np.int64) % 60 + 1
+    zones[(lats >= 56) & (lats < 64) & (lons >= 3) & (lons < 12)] = 32
+    svalbard = (lats >= 72) & (lats <= 84)
+    for zone, west, east in ((31, 0, 9), (33, 9, 21), (35, 21, 33),
+                             (37, 33, 42)):
+        zones[svalbard & (lons >= west) & (lons < east)] = zone
+    return zones.reshape(shape)
+
+# The latitude band letter of each point, '' outside of 80S to 84N
+def band_of(lats):
+    lats = np.asarray(lats, dtype=np.float64)
+    idx = np.floor((lats + 80) / 8)
+    good = (lats >= -80) & (lats <= 84)
+    idx = np.clip(np.where(good, idx, 0), 0, len(BANDS) - 1).astype(np.int64)
+    return np.where(good, np.array(list(BANDS))[idx], '')
+
+# The zone names, like 13S
+def zone_names(zones, lats):
+    bands = band_of(lats)
+    return ['{}{}'.format(z, b) for z, b in zip(np.ravel(zones).tolist(),
+                                                np.ravel(bands).tolist())]
+
+# Zone number and whether it's south from a name like 13S, or a number
+# and south
+def parse_zone(zone, south=False):
+    mtch = re.match(r'^\s*(\d+)\s*([A-Za-z]?)\s*$', str(zone))
+    if mtch is None or not 1 <= int(mtch.group(1)) <= 60:
+        raise ValueError('Bad UTM zone {}'.format(zone))
+    if mtch.group(2):
+        return int(mtch.group(1)), mtch.group(2).upper() < 'N'
+    return int(mtch.group(1)), south
+
+def central_meridian(zones):
+    return np.asarray(zones) * 6.0 - 183.0
+
+# Project lon/lat (degrees) to UTM
+# zones is a zone for every point, or one for all of them, and south
+# is whether northings are from the south pole, for every point or all
+# Returns (eastings, northings)
+def project(lons, lats, zones, south, a, f):
+    radius, alpha, beta, e = series(a, f)
+    lats = np.asarray(lats, dtype=np.float64)
+    lam = np.radians(np.asarray(lons, dtype=np.float64) -
+                     central_meridian(zones))
+    lam = (lam + math.pi) % (2 * math.pi) - math.pi
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sinPhi = np.sin(np.radians(lats))
+        # The conformal latitude, as its tangent
+        tau = np.sinh(np.arctanh(sinPhi) - e * np.arctanh(e * sinPhi))
+        zeta = (np.arctan2(tau, np.cos(lam)) +
+                1j * np.arcsinh(np.sin(lam) / np.hypot(tau, np.cos(lam))))
+    zeta = zeta + sin_series(alpha, zeta)
+    eastings = FALSE_EASTING + K0 * radius * zeta.imag
+    northings = K0 * radius * zeta.real
+    northings = northings + np.where(south, FALSE_NORTHING_SOUTH, 0.0)
+    return eastings, northings
+
+# UTM to lon/lat (degrees), the inverse of project
+# Returns (lons, lats)
+def unproject(eastings, northings, zones, south, a, f):
+    radius, alpha, beta, e = series(a, f)
+    northings = (np.asarray(northings, dtype=np.float64) -
+                 np.where(south, FALSE_NORTHING_SOUTH, 0.0))
+    eastings = np.asarray(eastings, dtype=np.float64) - FALSE_EASTING
+    zeta = (northings + 1j * eastings) / (K0 * radius)
+    zeta = zeta - sin_series(beta, zeta)
+    xi = zeta.real
+    eta = zeta.imag
+    sinhEta = np.sinh(eta)
+    cosXi = np.cos(xi)
+    lam = np.arctan2(sinhEta, cosXi)
+    # Tangent of the conformal latitude, then Newton's method for the
+    # tangent of the latitude, which is done in 2 or 3 steps
+    tauP = np.sin(xi) / np.hypot(sinhEta, cosXi)
+    tau = tauP.copy()
+    e2m = 1 - e*e
+    for i in range(5):
+        sqrt1Tau = np.hypot(1, tau)
+        sig = np.sinh(e * np.arctanh(e * tau / sqrt1Tau))
+        tauPi = tau * np.hypot(1, sig) - sig * sqrt1Tau
+        delta = ((tauP - tauPi) / np.hypot(1, tauPi) *
+                 (1 + e2m * tau*tau) / (e2m * sqrt1Tau))
+        tau = tau + delta
+        if not np.any(np.abs(delta) > 1e-14 * np.maximum(1, np.abs(tau))):
+            break
+    lons = np.degrees(lam) + central_meridian(zones)
+    lons = (lons + 180) % 360 - 180
+    return lons, np.degrees(np.arctan(tau))
+
+# Convert lon/lat to UTM, picking the zone of every point unless zone is
+# given, and the hemisphere from the latitudes unless south is given
+# Returns (zones, eastings, northings)
+def to_utm(lons, lats, zone=None, south=None, ellps='WGS84'):
+    a, f = ellipsoid(ellps)
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    zones = zone_of(lons, lats) if zone is None else np.full(lons.shape, zone)
+    if south is None:
+        south = lats < 0
+    eastings, northings = project(lons, lats, zones, south, a, f)
+    return zones, eastings, northings
+
+# Convert UTM to lon/lat
+# zones is a zone number, or an array of them, and south is whether the
+# northings are in the southern hemisphere
+# Returns (lons, lats)
+def from_utm(zones, eastings, northings, south=False, ellps='WGS84'):
+    a, f = ellipsoid(ellps)
+    return unproject(eastings, northings, zones, south, a, f)
+
+# A single UTM zone, on an ellipsoid
+class UTM(object):
+    def __init__(self, zone, south=False, ellps='WGS84'):
+        self.zone = zone
+        self.south = south
+        if isinstance(ellps, str):
+            self.a, self.f = ellipsoid(ellps)
+        else:
+            self.a, self.f = ellps
+
+    # lon/lat arrays to (eastings, northings)
+    def forward(self, lons, lats):
+        return project(lons, lats, self.zone, self.south, self.a, self.f)
+
+    # UTM arrays to (lons, lats)
+    def inverse(self, eastings, northings):
+        return unproject(eastings, northings, self.zone, self.south,
+                         self.a, self.f)
+
+    # Whether lon/lat on WGS 84 can go through this without a datum
+    # shift, because the ellipsoid is WGS 84 or GRS 80 (NAD83), which
+    # are the same to a fraction of a millimeter
+    def is_wgs84(self):
+        return (abs(self.a - 6378137.0) < 1e-3 and
+                abs(1 / self.f - 298.2572) < 1e-3)
+
+    # The UTM zone that a GDAL (WKT) coordinate system is, or None if
+    # it's something else
+    @staticmethod
+    def from_wkt(wkt):
+        if not wkt or not wkt.startswith('PROJCS'):
+            return None
+        if not re.search(r'PROJECTION\["Transverse_Mercator"\]', wkt, re.I):
+            return None
+        params = dict((name.lower(), float(value)) for name, value in
+                      re.findall(r'PARAMETER\["([^"]+)",\s*([-+.\deE]+)\]',
+                                 wkt))
+        spheroid = re.search(r'SPHEROID\["[^"]*",\s*([-+.\deE]+),\s*([-+.\deE]+)',
+                             wkt)
+        # The last UNIT is the projection's
+        units = re.findall(r'UNIT\["[^"]*",\s*([-+.\deE]+)', wkt)
+        if spheroid is None or not units or abs(float(units[-1]) - 1) > 1e-9:
+            return None
+        lon0 = params.get('central_meridian')
+        if (lon0 is None or params.get('latitude_of_origin', 0) != 0
+                or abs(params.get('scale_factor', 0) - K0) > 1e-9
+                or params.get('false_easting') != FALSE_EASTING
+                or params.get('false_northing') not in (0, FALSE_NORTHING_SOUTH)):
+            return None
+        zone = (lon0 + 183) / 6
+        if zone != int(zone) or not 1 <= zone <= 60:
+            return None
+        invF = float(spheroid.group(2))
+        return UTM(int(zone), params['false_northing'] != 0,
+                   (float(spheroid.group(1)), 1 / invF if invF else 0.0))
+
+# Find the columns in a CSV header, by name or number
+# Returns the column numbers and whether the first row is a header
+def find_columns(first, wanted, defaults):
+    isHeader = False
+    for value in first:
+        try:
+            float(value)
+        except ValueError:
+            if not re.match(r'^\s*\d+\s*[A-Za-z]\s*$', value):
+                isHeader = True
+    lower = [c.strip().lower() for c in first]
+    columns = list()
+    for i, names in enumerate(wanted):
+        if isinstance(names, int):
+            columns.append(names)
+            continue
+        found = [lower.index(n) for n in names if n in lower] if isHeader else []
+        if found:
+            columns.append(found[0])
+        elif len(names) == 1 and names[0].isdigit():
+            columns.append(int(names[0]))
+        else:
+            columns.append(defaults[i])
+    return columns, isHeader
+
+# Convert CSV rows from inf to outf a chunk at a time, adding columns
+def convert_csv(inf, outf, inverse=False, zone=None, south=None,
+                ellps='WGS84', columns=None, chunkSize=CHUNK_SIZE):
+    reader = csv.reader(inf)
+    writer = csv.writer(outf, lineterminator='\n')
+    first = next(reader, None)
+    if first is None:
+        return 0
+    if inverse:
+        wanted = [('easting', 'east', 'x'), ('northing', 'north', 'y')]
+        defaults = [0, 1]
+        if zone is None:
+            wanted.insert(0, ('zone',))
+            defaults = [0, 1, 2]
+        added = ['latitude', 'longitude']
+    else:
+        wanted = [('latitude', 'lat'), ('longitude', 'lon', 'lng', 'long')]
+        defaults = [0, 1]
+        added = ['zone', 'easting', 'northing']
+    if columns:
+        wanted = [(c.lower(),) for c in columns]
+    cols, isHeader = find_columns(first, wanted, defaults)
+    if isHeader:
+        writer.writerow(first + added)
+        rows = reader
+    else:
+        rows = itertools.chain([first], reader)
+
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunkSize))
+        if not chunk:
+            break
+        values = [[row[c] for row in chunk] for c in cols]
+        if inverse:
+            if zone is None:
+                parsed = [parse_zone(z, bool(south)) for z in values.pop(0)]
+                zones = np.array([p[0] for p in parsed])
+                souths = np.array([p[1] for p in parsed])
+            else:
+                zones, souths = zone, bool(south)
+            lons, lats = from_utm(zones, np.array(values[0], dtype=np.float64),
+                                  np.array(values[1], dtype=np.float64),
+                                  souths, ellps)
+            writer.writerows(row + ['%.9f' % lat, '%.9f' % lon]
+                             for row, lat, lon in zip(chunk, lats.tolist(),
+                                                      lons.tolist()))
+        else:
+            lats = np.array(values[0], dtype=np.float64)
+            zones, eastings, northings = to_utm(
+                np.array(values[1], dtype=np.float64), lats, zone, south, ellps)
+            names = zone_names(zones, lats)
+            writer.writerows(row + [name, '%.3f' % x, '%.3f' % y]
+                             for row, name, x, y in zip(chunk, names,
+                                                        eastings.tolist(),
+                                                        northings.tolist()))
+        count += len(chunk)
+    return count
+
+def main(args):
+    opts = dict()
+    rest = list()
+    names = {'--ellipsoid': ('ellps', str),
+             '--zone': ('zone', int),
+             '--columns': ('columns', lambda v: v.split(',')),
+             '--chunk': ('chunkSize', int)}
+    for arg in args:
+        name = arg.split('=')[0]
+        if name in names and '=' in arg:
+            key, conv = names[name]
+            opts[key] = conv(arg[arg.index('=')+1:])
+        elif arg == '--inverse':
+            opts['inverse'] = True
+        elif arg == '--south':
+            opts['south'] = True
+        else:
+            rest.append(arg)
+    inverse = opts.get('inverse', False)
+    try:
+        ellipsoid(opts.get('ellps', 'WGS84'))
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    single = len(rest) == (3 if inverse else 2)
+    if not single and len(rest) > 1:
+        print('Syntax is:')
+        print('\t./utm.py [--ellipsoid=WGS84] [--zone=N] latitude longitude')
+        print('\t./utm.py --inverse [--ellipsoid=WGS84] [--south] zone easting northing')
+        print('\t./utm.py [--inverse] [--ellipsoid=WGS84] [--zone=N] [--south]')
+        print('\t         [--columns=a,b[,c]] [--chunk=N] [file.csv|-]')
+        print('Ellipsoids: {}'.format(', '.join(sorted(ELLIPSOIDS) +
+                                                sorted(ELLIPSOID_ALIASES))))
+        sys.exit(1)
+
+    ellps = opts.get('ellps', 'WGS84')
+    if single and inverse:
+        zone, south = parse_zone(rest[0], opts.get('south', False))
+        lons, lats = from_utm(zone, float(rest[1]), float(rest[2]), south,
+                              ellps)
+        print('Latitude:  {:.9f}\nLongitude: {:.9f}'.format(float(lats),
+                                                            float(lons)))
+    elif single:
+        lat = float(rest[0])
+        zones, eastings, northings = to_utm(np.array([float(rest[1])]),
+                                            np.array([lat]), opts.get('zone'),
+                                            opts.get('south'), ellps)
+        print('Zone:  {}\nEast:  {:.3f}\nNorth: {:.3f}'.format(
+            zone_names(zones, [lat])[0], eastings[0], northings[0]))
+    elif not rest or rest[0] == '-':
+        opts.pop('ellps', None)
+        convert_csv(sys.stdin, sys.stdout, ellps=ellps, **opts)
+    else:
+        opts.pop('ellps', None)
+        with open(rest[0], newline='') as inf:
+            convert_csv(inf, sys.stdout, ellps=ellps, **opts)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+
+# hillshade.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Hillshade, slope and aspect of NED data with NumPy
+
+# hmrender gives a nice view of a NED dataset, but it takes 3Delight and
+# 36 frames to get it.  This makes a shaded relief map (and slope and
+# aspect) directly from the elevations, fast enough to preview a whole
+# 1 degree cell in a few seconds.
+
+# The raster is split into blocks (tile_size x tile_size, the same
+# blocks pyramid.py makes tiles from), and a pool of processes each
+# reads a block with a one pixel halo around it, so every pixel has all
+# 8 neighbors, and computes the gradient with Horn's method, like
+# gdaldem.  Only a few blocks are waiting to be written at any time, so
+# memory use doesn't grow with the size of the raster.
+#   - hillshade is 1-255, 0 for nodata, lit from --azimuth (degrees
+#     clockwise from north) and --altitude (degrees above the horizon),
+#     with the elevations exaggerated by --z-factor
+#   - slope is in degrees, aspect is the direction the slope faces, in
+#     degrees clockwise from north, and both are -9999 for nodata (and
+#     aspect is also -9999 where it's flat)
+# Geographic (lat/lon) data, like NED, has its pixel sizes converted to
+# meters for every row, so the slopes are right at any latitude.
+
+# The output can be:
+#   - a .tif: a GeoTIFF per product, named output_slope.tif, etc., if
+#     there's more than one
+#   - a .png: an 8 bit image per product, scaled like the tiles below,
+#     which is handy with --level=N to preview at 1/2**N the resolution
+#   - a directory or .mbtiles file: a pyramid of 8 bit PNG tiles of one
+#     product, laid out like pyramid.py's, with a manifest, for
+#     viewtile.py and tileserver.py.  Each level is shaded from the
+#     elevations at that level's resolution, instead of shrinking the
+#     full resolution shading.  Slope and aspect tiles are scaled from
+#     0-90 and 0-360 degrees to 1-255.
+
+# With --catalog, the input is every raster in a catalog (see mapdb.py
+# --harvest) that intersects a lon/lat box, as one mosaic (see
+# mosaic.py, which has to be importable, so put map_download in
+# PYTHONPATH).  Full resolution blocks are read through the mosaic's
+# block cache, so the halos of neighboring blocks, even across a quad
+# boundary, don't read the same blocks again.  The reduced levels are
+# averaged by GDAL from a VRT of the same rasters.
+
+# Usage:
+#     ./hillshade.py [--workers=N] [--tile-size=512] [--levels=N] [--level=N]
+#                    [--azimuth=315] [--altitude=45] [--z-factor=1]
+#                    [--products=hillshade,slope,aspect]
+#                    <output.tif|.png|directory|.mbtiles> <arcgrid_or_geotiff>
+#     ./hillshade.py [options] --catalog=<catalog.db>
+#                    <output.tif|.png|directory|.mbtiles> minLon,minLat,maxLon,maxLat
+
+import os
+import sys
+import math
+import time
+import os.path
+import tempfile
+import concurrent.futures
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+import mbtiles
+import pyramid
+import tilemanifest
+
+# The rasters in a catalog can be shaded as one if mosaic.py, from the
+# map scripts, can be imported (put map_download in PYTHONPATH)
+try:
+    import mosaic
+except ImportError:
+    mosaic = None
+
+PRODUCTS = ('hillshade', 'slope', 'aspect')
+
+# Nodata of the hillshade, and of slope and aspect
+SHADE_NODATA = 0
+NODATA = -9999.0
+
+# The largest value of each product, for scaling to 8 bits
+PRODUCT_MAX = dict(hillshade=255.0, slope=90.0, aspect=360.0)
+
+# Blocks waiting to be written, per worker
+QUEUE_DEPTH = 4
+
+# Meters per degree of longitude and latitude at a latitude, on WGS 84
+def meters_per_degree(lat):
+    phi = np.radians(lat)
+    mx = 111412.84 * np.cos(phi) - 93.5 * np.cos(3 * phi)
+    my = 111132.92 - 559.82 * np.cos(2 * phi) + 1.175 * np.cos(4 * phi)
+    return mx, my
+
+# Whether a dataset's coordinates are degrees
+# Without a projection, it's a guess from the pixel size
+def is_geographic(projection, geotransform):
+    if projection:
+        return not projection.startswith('PROJCS') and 'GEOGCS' in projection
+    return abs(geotransform[1]) < 0.01
+
+# The east-west and north-south size in meters of the pixels in rows
+# y0 to y0+rows of a level, as arrays that broadcast over a block
+def pixel_size(job, y0, rows):
+    gt = job['geotransform']
+    scale = 2**job['level']
+    ewres = abs(gt[1]) * scale
+    nsres = abs(gt[5]) * scale
+    if not job['geographic']:
+        return ewres, nsres
+    lat = gt[3] + (y0 + np.arange(rows) + 0.5) * scale * gt[5]
+    mx, my = meters_per_degree(lat)
+    return ((ewres * mx)[:, np.newaxis].astype(np.float32),
+            (nsres * my)[:, np.newaxis].astype(np.float32))
+
+# Read the pixels x0 to x0+cols and y0 to y0+rows of a level, and one
+# more all the way around, as float32 with NaN for nodata and for
+# anything outside the raster
+# Full resolution windows come from source, a mosaic.Mosaic, instead of
+# band, if there is one
+def read_window(band, width, height, level, x0, y0, cols, rows,
+                source=None):
+    scale = 2**level
+    levelWidth = int(math.ceil(width / float(scale)))
+    levelHeight = int(math.ceil(height / float(scale)))
+    wx0 = max(x0 - 1, 0)
+    wy0 = max(y0 - 1, 0)
+    wx1 = min(x0 + cols + 1, levelWidth)
+    wy1 = min(y0 + rows + 1, levelHeight)
+    srcX = wx0 * scale
+    srcY = wy0 * scale
+    srcCols = min(wx1 * scale, width) - srcX
+    srcRows = min(wy1 * scale, height) - srcY
+    nodata = band.GetNoDataValue()
+    if scale == 1 and source is not None:
+        data = source.read(srcX, srcY, srcCols, srcRows)
+        nodata = source.nodata
+    elif scale == 1:
+        data = band.ReadAsArray(srcX, srcY, srcCols, srcRows)
+    else:
+        data = band.ReadAsArray(srcX, srcY, srcCols, srcRows,
+                                wx1 - wx0, wy1 - wy0,
+                                resample_alg=gdal.GRIORA_Average)
+
+    window = np.full((rows + 2, cols + 2), np.nan, dtype=np.float32)
+    inner = window[wy0 - y0 + 1:wy1 - y0 + 1, wx0 - x0 + 1:wx1 - x0 + 1]
+    inner[:] = data
+    if nodata is not None:
+        inner[data == nodata] = np.nan
+    return window
+
+# The gradient of the middle of window with Horn's method, as
+#   x = how much higher the west side is than the east, per meter
+#   y = how much higher the south side is than the north, per meter
+# which is the direction downhill
+# Missing neighbors are treated as being the same height as the middle
+# Returns x, y, and where the middle has data
+def gradient(window, ewres, nsres):
+    rows = window.shape[0] - 2
+    cols = window.shape[1] - 2
+    center = window[1:-1, 1:-1]
+
+    def cell(dy, dx):
+        w = window[1 + dy:rows + 1 + dy, 1 + dx:cols + 1 + dx]
+        return np.where(np.isnan(w), center, w)
+
+    a, b, c = cell(-1, -1), cell(-1, 0), cell(-1, 1)
+    d, f = cell(0, -1), cell(0, 1)
+    g, h, i = cell(1, -1), cell(1, 0), cell(1, 1)
+    x = ((a + 2*d + g) - (c + 2*f + i)) / (8 * ewres)
+    y = ((g + 2*h + i) - (a + 2*b + c)) / (8 * nsres)
+    return x, y, ~np.isnan(center)
+
+# Brightness of a surface lit from azimuth and altitude (in degrees),
+# 1-255, and SHADE_NODATA where there isn't any data
+def hillshade(x, y, valid, azimuth=315.0, altitude=45.0, zFactor=1.0):
+    az = math.radians(azimuth)
+    alt = math.radians(altitude)
+    x = x * zFactor
+    y = y * zFactor
+    # The cosine of the angle between the surface normal, (x, y, 1), and
+    # the direction of the light
+    cang = ((x * (math.cos(alt) * math.sin(az)) +
+             y * (math.cos(alt) * math.cos(az)) + math.sin(alt)) /
+            np.sqrt(1 + x*x + y*y))
+    shade = np.clip(1 + 254 * cang, 1, 255)
+    shade[~valid] = SHADE_NODATA
+    return shade.astype(np.uint8)
+
+def slope(x, y, valid):
+    result = np.degrees(np.arctan(np.sqrt(x*x + y*y))).astype(np.float32)
+    result[~valid] = NODATA
+    return result
+
+def aspect(x, y, valid):
+    result = np.degrees(np.arctan2(x, y)).astype(np.float32) % 360
+    result[~valid | ((x == 0) & (y == 0))] = NODATA
+    return result
+
+# A product scaled to 8 bits, 0 for nodata
+def to_byte(product, values):
+    if values.dtype == np.uint8:
+        return values
+    scaled = np.clip(1 + values * (254 / PRODUCT_MAX[product]), 1, 255)
+    scaled[values == NODATA] = 0
+    return (scaled + 0.5).astype(np.uint8)
+
+# Each worker process opens the dataset (and mosaic) once
+workerDataset = None
+workerMosaic = None
+
+# recs are the catalog records of a mosaic's rasters, and fname its VRT
+def open_worker(fname, recs=None):
+    global workerDataset, workerMosaic
+    gdal.UseExceptions()
+    workerDataset = gdal.Open(fname)
+    if recs is not None:
+        workerMosaic = mosaic.Mosaic(recs)
+
+# Compute the products of one block of one level
+# Returns {product: array}
+def shade_block(job, level, bx, by):
+    band = workerDataset.GetRasterBand(1)
+    width = workerDataset.RasterXSize
+    height = workerDataset.RasterYSize
+    scale = 2**level
+    size = job['tile_size']
+    x0 = bx * size
+    y0 = by * size
+    cols = min(size, int(math.ceil(width / float(scale))) - x0)
+    rows = min(size, int(math.ceil(height / float(scale))) - y0)
+
+    window = read_window(band, width, height, level, x0, y0, cols, rows,
+                         workerMosaic)
+    ewres, nsres = pixel_size(dict(job, level=level), y0, rows)
+    x, y, valid = gradient(window, ewres, nsres)
+    results = dict()
+    for product in job['products']:
+        if product == 'hillshade':
+            results[product] = hillshade(x, y, valid, job['azimuth'],
+                                         job['altitude'], job['z_factor'])
+        elif product == 'slope':
+            results[product] = slope(x, y, valid)
+        else:
+            results[product] = aspect(x, y, valid)
+    return results
+
+# Worker process entry point
+# block is (level, bx, by)
+# Returns (level, bx, by, result), where the result is the products for
+# raster output, the PNG of the tile for .mbtiles output, or None when
+# the tile was written to a directory here
+def shade_worker(job, block):
+    level, bx, by = block
+    results = shade_block(job, level, bx, by)
+    if job['output'] == 'raster':
+        return level, bx, by, results
+    png = pyramid.encode_png(to_byte(job['products'][0],
+                                     results[job['products'][0]]))
+    if job['output'] == 'mbtiles':
+        return level, bx, by, png
+    fname = pyramid.tile_file_name(job['out_dir'], level, bx, by)
+    tmpName = fname + '.tmp'
+    with open(tmpName, 'wb') as outf:
+        outf.write(png)
+    os.replace(tmpName, fname)
+    return level, bx, by, None
+
+# Run fn(job, block) for every block on the pool, yielding the results
+# as they finish, with at most limit of them waiting at once
+def run_blocks(executor, fn, job, blocks, limit):
+    pending = set()
+    for block in blocks:
+        if len(pending) >= limit:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
+        pending.add(executor.submit(fn, job, block))
+    for fut in concurrent.futures.as_completed(pending):
+        yield fut.result()
+
+# The blocks of a level of a width x height raster
+def level_blocks(width, height, level, tileSize):
+    scale = 2**level
+    cols = int(math.ceil(math.ceil(width / float(scale)) / tileSize))
+    rows = int(math.ceil(math.ceil(height / float(scale)) / tileSize))
+    return [(level, bx, by) for by in range(rows) for bx in range(cols)]
+
+# The file a product goes to, when there's more than one
+def product_file_name(outName, product, products):
+    if len(products) == 1:
+        return outName
+    base, ext = os.path.splitext(outName)
+    return '{}_{}{}'.format(base, product, ext)
+
+# Write the products of level to GeoTIFFs or PNGs named after outName
+def write_rasters(executor, job, workers, outName, dataset, level):
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    scale = 2**level
+    outWidth = int(math.ceil(width / float(scale)))
+    outHeight = int(math.ceil(height / float(scale)))
+    size = job['tile_size']
+    isPng = outName.lower().endswith('.png')
+
+    gt = job['geotransform']
+    outGt = (gt[0], gt[1] * scale, gt[2] * scale,
+             gt[3], gt[4] * scale, gt[5] * scale)
+    outputs = dict()
+    for product in job['products']:
+        fname = product_file_name(outName, product, job['products'])
+        if isPng:
+            outputs[product] = (fname, np.zeros((outHeight, outWidth),
+                                                dtype=np.uint8))
+            continue
+        # Written to a temporary file, so a half finished one is never
+        # mistaken for a complete one
+        tmpName = fname + '.tmp.tif'
+        dtype = gdal.GDT_Byte if product == 'hillshade' else gdal.GDT_Float32
+        out = gdal.GetDriverByName('GTiff').Create(
+            tmpName, outWidth, outHeight, 1, dtype,
+            ['TILED=YES', 'BLOCKXSIZE={}'.format(size),
+             'BLOCKYSIZE={}'.format(size), 'COMPRESS=DEFLATE'])
+        out.SetGeoTransform(outGt)
+        out.SetProjection(job['projection'])
+        out.GetRasterBand(1).SetNoDataValue(
+            SHADE_NODATA if product == 'hillshade' else NODATA)
+        outputs[product] = (fname, out)
+
+    out = None
+
+    blocks = level_blocks(width, height, level, size)
+    for l, bx, by, results in run_blocks(executor, shade_worker, job, blocks,
+                                         workers * QUEUE_DEPTH):
+        for product, values in results.items():
+            if isPng:
+                rows, cols = values.shape
+                outputs[product][1][by*size:by*size + rows,
+                                    bx*size:bx*size + cols] = to_byte(product,
+                                                                      values)
+            else:
+                outputs[product][1].GetRasterBand(1).WriteArray(
+                    values, bx*size, by*size)
+
+    fnames = [outputs[product][0] for product in job['products']]
+    if isPng:
+        for fname, image in outputs.values():
+            pyramid.write_png(fname, image)
+    else:
+        # Closing the datasets finishes the files
+        outputs = None
+        for fname in fnames:
+            os.replace(fname + '.tmp.tif', fname)
+    return len(blocks)
+
+# Write a pyramid of tiles of the first product to a directory or an
+# .mbtiles file
+def write_tiles(executor, job, workers, outDir, dataset, levels):
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    size = job['tile_size']
+    if levels is None:
+        levels = pyramid.num_levels(width, height, size)
+
+    blocks = list()
+    for level in range(levels):
+        blocks.extend(level_blocks(width, height, level, size))
+        if job['output'] == 'tiles':
+            os.makedirs(pyramid.level_dir(outDir, level), exist_ok=True)
+
+    manifest = tilemanifest.new_manifest(size, job['geotransform'],
+                                         job['projection'], width, height,
+                                         job['source'])
+    if job['output'] == 'tiles':
+        for result in run_blocks(executor, shade_worker, job, blocks,
+                                 workers * QUEUE_DEPTH):
+            pass
+        tilemanifest.update(outDir, manifest)
+        return len(blocks)
+
+    for level in range(levels):
+        manifest['levels'][level] = tilemanifest.index_tiles(
+            [(bx, by) for l, bx, by in blocks if l == level])
+    maxZoom = tilemanifest.max_zoom(manifest)
+    dbc = mbtiles.connect(outDir)
+    with dbc:
+        dbc.execute('delete from map')
+    writer = mbtiles.TileWriter(dbc)
+    for level, bx, by, png in run_blocks(executor, shade_worker, job, blocks,
+                                         workers * QUEUE_DEPTH):
+        writer.add(maxZoom - level, bx, by, png)
+    writer.close(mbtiles.manifest_metadata(
+        manifest, '{} {}'.format(os.path.basename(job['source']),
+                                 job['products'][0])))
+    dbc.close()
+    return len(blocks)
+
+# Shade fname into outName
+# level is the level (resolution) of raster outputs, and levels is the
+# number of levels of tiles
+# With catalogFile, fname is 'minLon,minLat,maxLon,maxLat', and the
+# catalog's rasters in that box are shaded as one mosaic
+# Returns the number of blocks computed
+def render(outName, fname, workers=None, tileSize=pyramid.TILE_SIZE,
+           levels=None, level=0, azimuth=315.0, altitude=45.0, zFactor=1.0,
+           products=('hillshade',), catalogFile=None):
+    gdal.UseExceptions()
+    if catalogFile is None:
+        return render_dataset(outName, fname, os.path.abspath(fname), None,
+                              workers, tileSize, levels, level, azimuth,
+                              altitude, zFactor, products)
+
+    minLon, minLat, maxLon, maxLat = [float(v) for v in fname.split(',')]
+    source = mosaic.from_catalog(catalogFile, minLon, minLat, maxLon, maxLat)
+    fd, vrtName = tempfile.mkstemp(suffix='.vrt')
+    os.close(fd)
+    try:
+        source.write_vrt(vrtName)
+        return render_dataset(outName, vrtName,
+                              '{} {}'.format(os.path.abspath(catalogFile),
+                                             fname),
+                              [src.rec for src in source.sources], workers,
+                              tileSize, levels, level, azimuth, altitude,
+                              zFactor, products)
+    finally:
+        os.remove(vrtName)
+
+# Shade the dataset in fname into outName, for render
+# sourceName goes in the manifest, and recs are the rasters of a mosaic
+# to read full resolution blocks from
+def render_dataset(outName, fname, sourceName, recs, workers, tileSize,
+                   levels, level, azimuth, altitude, zFactor, products):
+    dataset = gdal.Open(fname)
+    geotransform = list(dataset.GetGeoTransform())
+    projection = dataset.GetProjection()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if outName.lower().endswith(('.tif', '.tiff', '.png')):
+        output = 'raster'
+    elif pyramid.is_mbtiles(outName):
+        output = 'mbtiles'
+    else:
+        output = 'tiles'
+    job = dict(output=output, out_dir=outName, products=list(products),
+               tile_size=tileSize, level=level, azimuth=azimuth,
+               altitude=altitude, z_factor=zFactor,
+               geotransform=geotransform, projection=projection,
+               geographic=is_geographic(projection, geotransform),
+               source=sourceName)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=open_worker,
+            initargs=(fname, recs)) as executor:
+        if output == 'raster':
+            return write_rasters(executor, job, workers, outName, dataset,
+                                 level)
+        return write_tiles(executor, job, workers, outName, dataset, levels)
+
+def main(args):
+    opts = dict()
+    rest = list()
+    names = {'--workers': ('workers', int),
+             '--tile-size': ('tileSize', int),
+             '--levels': ('levels', int),
+             '--level': ('level', int),
+             '--azimuth': ('azimuth', float),
+             '--altitude': ('altitude', float),
+             '--z-factor': ('zFactor', float),
+             '--products': ('products', lambda v: v.split(',')),
+             '--catalog': ('catalogFile', str)}
+    for arg in args:
+        name = arg.split('=')[0]
+        if name in names and '=' in arg:
+            key, conv = names[name]
+            opts[key] = conv(arg[arg.index('=')+1:])
+        else:
+            rest.append(arg)
+    products = opts.get('products', ['hillshade'])
+    isRaster = len(rest) == 2 and rest[0].lower().endswith(('.tif', '.tiff',
+                                                            '.png'))
+    if (len(rest) != 2 or not products
+            or any(p not in PRODUCTS for p in products)
+            or (len(products) > 1 and not isRaster)):
+        print('Syntax is:')
+        print('\t./hillshade.py [--workers=N] [--tile-size=512] [--levels=N] [--level=N]')
+        print('\t               [--azimuth=315] [--altitude=45] [--z-factor=1]')
+        print('\t               [--products=hillshade,slope,aspect]')
+        print('\t               <output.tif|.png|directory|.mbtiles> <arcgrid_or_geotiff>')
+        print('\t./hillshade.py [options] --catalog=<catalog.db>')
+        print('\t               <output.tif|.png|directory|.mbtiles> minLon,minLat,maxLon,maxLat')
+        print('Tiles (a directory or .mbtiles) are of a single product')
+        sys.exit(1)
+    if 'catalogFile' in opts:
+        if mosaic is None:
+            print('--catalog needs mosaic.py, put map_download in PYTHONPATH')
+            sys.exit(1)
+        if len(rest[1].split(',')) != 4:
+            print('The box is minLon,minLat,maxLon,maxLat')
+            sys.exit(1)
+    start = time.time()
+    try:
+        blocks = render(rest[0], rest[1], **opts)
+    except ValueError as err:
+        # A catalog box with no rasters, or ones that don't line up
+        if 'catalogFile' not in opts:
+            raise
+        print(err)
+        sys.exit(1)
+    print('Shaded {} blocks in {:.2f}s'.format(blocks, time.time() - start))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
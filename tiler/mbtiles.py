@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# mbtiles.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Tile sets in a single MBTiles (SQLite) file
+
+# A state's worth of NED tiles is hundreds of thousands of little PNG
+# files, which take forever to copy, list or back up.  An .mbtiles file
+# holds them all in one SQLite database, in the layout every MBTiles
+# reader understands:
+#   - images has each distinct tile once, keyed by the SHA-1 of its
+#     PNG, so all the flat and nodata tiles are only stored once
+#   - map has (zoom, column, row) -> tile id
+#   - tiles is a view joining them, which is what the spec asks for
+#   - metadata has the usual name/format/zoom entries, plus the tile
+#     set's manifest (see tilemanifest.py) so readers don't have to
+#     scan the map table
+# Rows are in the MBTiles (TMS) order, counting up from the bottom,
+# while tileXXXXxYYYY.png and the XYZ tile server count down from the
+# top.  The functions here take the XYZ numbers and flip them.
+
+# pyramid.py writes straight to a .mbtiles file, viewtile.py and
+# tileserver.py read them, and this converts a directory of tiles from
+# pngtiler or pyramid.py, reading and hashing the PNGs on a pool of
+# processes and writing them in batched transactions from one.
+
+# Usage:
+#     ./mbtiles.py [--workers=N] [--batch=N] <tile_directory> <output.mbtiles>
+
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import os.path
+import threading
+import concurrent.futures
+
+import tilemanifest
+
+# Tiles written per transaction
+BATCH_SIZE = 500
+
+# Tile files each worker process reads at a time
+CHUNK_SIZE = 256
+
+# Jobs waiting to be written, per worker
+QUEUE_DEPTH = 4
+
+# Open an MBTiles file for writing, creating the tables if needed
+def connect(fileName):
+    dbc = sqlite3.connect(fileName)
+    dbc.execute('pragma journal_mode=wal')
+    create_tables(dbc)
+    return dbc
+
+def create_tables(dbc):
+    with dbc:
+        dbc.execute('''\
+create table if not exists metadata (
+    name text primary key,
+    value text)''')
+        dbc.execute('''\
+create table if not exists images (
+    tile_id text primary key,
+    tile_data blob)''')
+        dbc.execute('''\
+create table if not exists map (
+    zoom_level integer,
+    tile_column integer,
+    tile_row integer,
+    tile_id text,
+    primary key (zoom_level, tile_column, tile_row))''')
+        dbc.execute('''\
+create view if not exists tiles as
+    select map.zoom_level as zoom_level,
+           map.tile_column as tile_column,
+           map.tile_row as tile_row,
+           images.tile_data as tile_data
+    from map join images on images.tile_id = map.tile_id''')
+
+# The MBTiles row of XYZ tile row y at zoom z, and the other way around
+def flip_y(z, y):
+    return (1 << z) - 1 - y
+
+# The id of a tile's contents
+def tile_id(data):
+    return hashlib.sha1(data).hexdigest()
+
+def set_metadata(dbc, values):
+    dbc.executemany('''\
+insert into metadata (name, value) values (?, ?)
+    on conflict (name) do update set value=excluded.value''',
+                    [(name, str(value)) for name, value in values.items()])
+
+def get_metadata(dbc):
+    return dict(dbc.execute('select name, value from metadata'))
+
+# The metadata for a tile set with this manifest
+def manifest_metadata(manifest, name):
+    maxZoom = tilemanifest.max_zoom(manifest)
+    values = dict(name=name, format='png', type='baselayer', version='1.1',
+                  minzoom=maxZoom - max(manifest['levels'] or [0]),
+                  maxzoom=maxZoom,
+                  manifest=json.dumps(tilemanifest.to_json(manifest)))
+    if manifest.get('description'):
+        values['description'] = manifest['description']
+    return values
+
+# Writes tiles in batches, one transaction per batch
+# A tile that's already stored (by its hash) is only added to the map
+class TileWriter(object):
+    def __init__(self, dbc, batchSize=BATCH_SIZE):
+        self.dbc = dbc
+        self.batchSize = batchSize
+        self.batch = list()
+        self.written = 0
+
+    # Add the XYZ tile (z, x, y)
+    # tid is tile_id(data), if it's already known
+    def add(self, z, x, y, data, tid=None):
+        self.batch.append((z, x, flip_y(z, y), tid or tile_id(data), data))
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        with self.dbc:
+            self.dbc.executemany('''\
+insert into images (tile_id, tile_data) values (?, ?)
+    on conflict (tile_id) do nothing''',
+                                 [(tid, data) for z, x, y, tid, data in self.batch])
+            self.dbc.executemany('''\
+insert into map (zoom_level, tile_column, tile_row, tile_id) values (?, ?, ?, ?)
+    on conflict (zoom_level, tile_column, tile_row) do update
+    set tile_id=excluded.tile_id where tile_id != excluded.tile_id''',
+                                 [(z, x, y, tid)
+                                  for z, x, y, tid, data in self.batch])
+        self.written += len(self.batch)
+        self.batch = list()
+
+    # Write what's left, drop images no tile uses any more, and leave a
+    # single file behind
+    def close(self, metadata=None):
+        self.flush()
+        with self.dbc:
+            if metadata:
+                set_metadata(self.dbc, metadata)
+            self.dbc.execute('''\
+delete from images where tile_id not in (select tile_id from map)''')
+        self.dbc.execute('pragma journal_mode=delete')
+
+# Read access to an .mbtiles file
+# Safe to share between threads, each one gets its own connection
+class MBTiles(object):
+    def __init__(self, fileName):
+        if not os.path.exists(fileName):
+            raise IOError('{} does not exist'.format(fileName))
+        self.fileName = fileName
+        self.local = threading.local()
+        self.metadata = get_metadata(self.connection())
+        self.manifest = None
+        if 'manifest' in self.metadata:
+            self.manifest = tilemanifest.from_json(
+                json.loads(self.metadata['manifest']))
+        if self.manifest is None:
+            self.manifest = self.scan()
+        self.maxZoom = int(self.metadata.get('maxzoom',
+                                             tilemanifest.max_zoom(self.manifest)))
+
+    def connection(self):
+        dbc = getattr(self.local, 'dbc', None)
+        if dbc is None:
+            dbc = sqlite3.connect('file:{}?mode=ro'.format(self.fileName),
+                                  uri=True)
+            self.local.dbc = dbc
+        return dbc
+
+    # The tile id and PNG of XYZ tile (z, x, y), or (None, None)
+    def tile(self, z, x, y):
+        row = self.connection().execute('''\
+select images.tile_id, images.tile_data from map
+    join images on images.tile_id = map.tile_id
+    where zoom_level=? and tile_column=? and tile_row=?''',
+                                        (z, x, flip_y(z, y))).fetchone()
+        if row is None:
+            return None, None
+        return row[0], row[1]
+
+    # Tiles by pyramid level instead of zoom
+    def level_tile(self, level, x, y):
+        return self.tile(self.maxZoom - level, x, y)
+
+    # Make a manifest from the map table, for files that don't have one
+    def scan(self):
+        zooms = [row[0] for row in self.connection().execute(
+            'select distinct zoom_level from map')]
+        maxZoom = int(self.metadata.get('maxzoom', max(zooms or [0])))
+        manifest = tilemanifest.new_manifest()
+        for z in zooms:
+            manifest['levels'][maxZoom - z] = tilemanifest.index_tiles(
+                [(x, flip_y(z, y)) for x, y in self.connection().execute(
+                    'select tile_column, tile_row from map where zoom_level=?',
+                    (z,))])
+        return manifest
+
+    def close(self):
+        dbc = getattr(self.local, 'dbc', None)
+        if dbc is not None:
+            dbc.close()
+            self.local.dbc = None
+
+# Worker process entry point
+# Reads and hashes a chunk of tile files, returns [(z, x, y, id, png), ...]
+def read_tiles(jobs):
+    tiles = list()
+    for z, x, y, fname in jobs:
+        with open(fname, 'rb') as inf:
+            data = inf.read()
+        tiles.append((z, x, y, tile_id(data), data))
+    return tiles
+
+# Run fn(job) for every job on the pool, yielding the results as they
+# finish, with at most limit of them waiting at once
+# The tiles of finished jobs stay in memory until the one writer gets to
+# them, so the readers can't be allowed to get too far ahead
+def run_jobs(executor, fn, jobs, limit):
+    pending = set()
+    for job in jobs:
+        if len(pending) >= limit:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
+        pending.add(executor.submit(fn, job))
+    for fut in concurrent.futures.as_completed(pending):
+        yield fut.result()
+
+# Copy every tile in a directory written by pngtiler or pyramid.py into
+# an .mbtiles file
+# Returns the number of tiles and the number of distinct images
+def convert(directory, fileName, workers=None, batchSize=BATCH_SIZE):
+    manifest = tilemanifest.load(directory)
+    maxZoom = tilemanifest.max_zoom(manifest)
+    jobs = list()
+    for level, index in manifest['levels'].items():
+        levelDir = os.path.join(directory, tilemanifest.level_name(level))
+        for y in range(index.minY, index.maxY + 1):
+            for x in range(index.minX, index.maxX + 1):
+                if index.has(x, y):
+                    jobs.append((maxZoom - level, x, y, os.path.join(
+                        levelDir, 'tile{:04d}x{:04d}.png'.format(x, y))))
+    chunks = [jobs[i:i + CHUNK_SIZE] for i in range(0, len(jobs), CHUNK_SIZE)]
+
+    dbc = connect(fileName)
+    # Anything already in the file is replaced, but images that are the
+    # same don't have to be written again
+    with dbc:
+        dbc.execute('delete from map')
+    writer = TileWriter(dbc, batchSize)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for tiles in run_jobs(executor, read_tiles, chunks,
+                              workers * QUEUE_DEPTH):
+            for z, x, y, tid, data in tiles:
+                writer.add(z, x, y, data, tid)
+    writer.close(manifest_metadata(manifest,
+                                   os.path.basename(os.path.abspath(directory))))
+    images = dbc.execute('select count(*) from images').fetchone()[0]
+    dbc.close()
+    return writer.written, images
+
+def main(args):
+    workers = None
+    batchSize = BATCH_SIZE
+    rest = list()
+    for arg in args:
+        if arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):])
+        elif arg.startswith('--batch='):
+            batchSize = int(arg[len('--batch='):])
+        else:
+            rest.append(arg)
+    if len(rest) != 2:
+        print('Syntax is:')
+        print('\t./mbtiles.py [--workers=N] [--batch=N] <tile_directory> <output.mbtiles>')
+        sys.exit(1)
+    tiles, images = convert(rest[0], rest[1], workers, batchSize)
+    print('Wrote {} tiles, {} distinct images'.format(tiles, images))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -27,7 +27,9 @@
   database so that the tile png images can be cross referenced with the
   original GIS data associated with the NED dataset.
 
-  Currently all GIS data associated with the NED dataset is lost.
+  For now, the extent of the tiles and the dataset's geotransform and
+  projection are written to manifest.json in the output directory, which
+  viewtile.py reads instead of scanning the directory.
 
  */
 
@@ -113,11 +115,59 @@ void write_png(char *fname, int width, int height, png_bytep *row_pointers) {
     fclose(fp);
 }
 
+/*
+  Write a JSON string, escaping quotes and backslashes (WKT is full of quotes)
+*/
+void write_json_string(FILE *fp, const char *str) {
+    fputc('"', fp);
+    for (const char *c = str; *c; ++c) {
+        if (*c == '"' || *c == '\\') {
+            fputc('\\', fp);
+        }
+        if ((unsigned char)*c >= ' ') {
+            fputc(*c, fp);
+        }
+    }
+    fputc('"', fp);
+}
+
+/*
+  Write manifest.json for viewtile.py (see tilemanifest.py)
+  Every tile from 0,0 to numX-1,numY-1 is written, so there's no
+  presence bitmap, and the lack of a modification time tells the
+  viewer to trust it.
+*/
+void write_manifest(char *dirName, char *fname, GDALDatasetH hDataset,
+                    int nXSize, int nYSize, int tileSize, int numX, int numY) {
+    char mfname[512];
+    snprintf(mfname, sizeof(mfname), "%s/manifest.json", dirName);
+    FILE *fp = fopen(mfname, "w");
+    if (!fp) {
+        printf("Could not write %s\n", mfname);
+        return;
+    }
+    double gt[6];
+    GDALGetGeoTransform(hDataset, gt);
+    fprintf(fp, "{\"version\": 1, \"tile_size\": %d, ", tileSize);
+    fprintf(fp, "\"geotransform\": [%.17g, %.17g, %.17g, %.17g, %.17g, %.17g], ",
+            gt[0], gt[1], gt[2], gt[3], gt[4], gt[5]);
+    fprintf(fp, "\"projection\": ");
+    write_json_string(fp, GDALGetProjectionRef(hDataset));
+    fprintf(fp, ", \"width\": %d, \"height\": %d, \"source\": ", nXSize, nYSize);
+    write_json_string(fp, fname);
+    fprintf(fp, ", \"levels\": [{\"level\": 0, \"dir\": \"\", "
+            "\"min_x\": 0, \"min_y\": 0, \"max_x\": %d, \"max_y\": %d, "
+            "\"present\": null, \"mtime_ns\": null}]}\n", numX-1, numY-1);
+    fclose(fp);
+}
+
 int main(int argc, char *argv[]) {
 
-    if (argc<2) {
+    if (argc<3) {
         printf("Not enough arguments given!\n");
-        printf("\t%s <output_directory> <arcgrid_file>\n", argv[0]);
+        printf("\t%s <output_directory> <arcgrid_file> [min_elevation max_elevation]\n", argv[0]);
+        printf("Use the same min and max for neighboring files to avoid seams,\n");
+        printf("see map_download/rasterstats.py --scale\n");
         return 1;
     }
 
@@ -145,7 +195,29 @@ int main(int argc, char *argv[]) {
     double minEle = GDALGetRasterMinimum( hBand, &bGotMin );
     double maxEle = GDALGetRasterMaximum( hBand, &bGotMax );
 
+    if (argc>=5) {
+        // A range given on the command line wins
+        minEle = atof(argv[3]);
+        maxEle = atof(argv[4]);
+    } else if (!bGotMin || !bGotMax) {
+        // The file doesn't know its range, so compute the exact one
+        double adfMinMax[2];
+        GDALComputeRasterMinMax( hBand, FALSE, adfMinMax );
+        minEle = adfMinMax[0];
+        maxEle = adfMinMax[1];
+    }
+
     printf( "Min=%.3f, Max=%.3f\n", minEle, maxEle );
+
+    // Nodata becomes 0, like everything below minEle
+    int bHasNoData;
+    double noData = GDALGetRasterNoDataValue( hBand, &bHasNoData );
+
+    // A flat range maps everything to 0
+    double scale = 0.0;
+    if (maxEle > minEle) {
+        scale = 1.0 / (maxEle - minEle);
+    }
     
     int   nXSize = GDALGetRasterBandXSize( hBand );
     int   nYSize = GDALGetRasterBandYSize( hBand );
@@ -200,9 +272,20 @@ int main(int argc, char *argv[]) {
 
             // Convert floats between minEle and maxEle into sample_ts
             // between 0 and SAMPLE_MAX
+            // Anything out of range is clamped, converting it directly
+            // would be undefined (and wraps around on x86)
             for (int i = 0; i<rSize*cSize; ++i) {
                 float rawVal = pafScanline[i];
-                rawVal = (rawVal-minEle)/(maxEle - minEle);
+                if (bHasNoData && rawVal == (float)noData) {
+                    imageData[i] = 0;
+                    continue;
+                }
+                rawVal = (rawVal-minEle)*scale;
+                if (!(rawVal > 0.0f)) {
+                    rawVal = 0.0f;
+                } else if (rawVal > 1.0f) {
+                    rawVal = 1.0f;
+                }
                 imageData[i] = (sample_t)(rawVal*SAMPLE_MAX);
             }
             // Write the file
@@ -216,6 +299,9 @@ int main(int argc, char *argv[]) {
     
     printf("Done writing data\n");
 
+    write_manifest(dirName, fname, hDataset, nXSize, nYSize, tileWidth,
+                   xblock, yblock);
+
     // Cleanup and exit
     free(row_pointers);
     free(imageData);
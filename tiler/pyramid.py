@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+# pyramid.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Split NED data into a pyramid of PNG heightmap tiles
+
+# This does what pngtiler does, and writes the same
+# <output_directory>/tileXXXXxYYYY.png files for the full resolution,
+# but it also writes overview levels, each half the resolution of the
+# one before, to <output_directory>/level1, level2, ... until the whole
+# dataset fits in one tile.  viewtile.py can zoom between them.
+
+# It's faster than pngtiler, too:
+#   - elevations are scaled to samples with NumPy instead of a loop
+#     over every pixel
+#   - each row of tiles is a separate job for a pool of processes, so
+#     a state's worth of NED keeps every core busy
+#   - overviews are read with GDAL's averaging decimation, which uses
+#     the dataset's own overviews when it has them
+#   - a hash of the source data behind every tile is kept in
+#     <output_directory>/pyramid.json, and tiles whose data (and
+#     scaling) didn't change aren't encoded and written again
+# A manifest.json (see tilemanifest.py) with the extent of every level
+# and the georeferencing is written at the end for viewtile.py.
+# If the output ends in .mbtiles, the tiles (and pyramid.json and the
+# manifest) go into that one file instead, see mbtiles.py.
+# The PNGs are written directly with zlib, so only GDAL and NumPy are
+# needed.
+
+# Usage:
+#     ./pyramid.py [--workers=N] [--tile-size=512] [--levels=N] [--bits=8|16]
+#                  [--min=elevation] [--max=elevation] [--force]
+#                  <output_directory_or.mbtiles> <arcgrid_or_geotiff>
+
+import os
+import sys
+import json
+import math
+import zlib
+import struct
+import hashlib
+import os.path
+import concurrent.futures
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+import mbtiles
+import tilemanifest
+
+# Just about any tile size should work, but 512x512 seems to
+# be a good trade off between image size and # of images
+TILE_SIZE = 512
+
+# Where pyramid.py keeps track of what it's already written
+STATE_FILE = 'pyramid.json'
+
+# The metadata entry of an .mbtiles file that has pyramid.json
+MBTILES_STATE = 'pyramid'
+
+# Whether the output is an .mbtiles file instead of a directory
+def is_mbtiles(outDir):
+    return outDir.lower().endswith('.mbtiles')
+
+# The file name of tile (x, y) at a level
+# Level 0 is in the output directory itself, like pngtiler's tiles
+def level_dir(outDir, level):
+    if level == 0:
+        return outDir
+    return os.path.join(outDir, 'level{}'.format(level))
+
+def tile_file_name(outDir, level, x, y):
+    return os.path.join(level_dir(outDir, level),
+                        'tile{:04d}x{:04d}.png'.format(x, y))
+
+# Number of levels needed for a width x height raster to fit in one tile
+def num_levels(width, height, tileSize=TILE_SIZE):
+    levels = 1
+    while max(width, height) > tileSize * 2**(levels-1):
+        levels += 1
+    return levels
+
+# Encode a grayscale PNG
+# data is a 2D array of uint8 or uint16
+def encode_png(data):
+    height, width = data.shape
+    bits = 8 * data.dtype.itemsize
+    if bits == 16:
+        # PNG samples are big endian
+        data = data.astype('>u2')
+    # Every row starts with filter type 0 (none)
+    raw = np.zeros((height, 1 + width * data.dtype.itemsize), dtype=np.uint8)
+    raw[:, 1:] = data.view(np.uint8).reshape(height, -1)
+
+    def chunk(kind, body):
+        return (struct.pack('>I', len(body)) + kind + body +
+                struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bits,
+                                       0, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+# Write a grayscale PNG file
+def write_png(fname, data):
+    tmpName = fname + '.tmp'
+    with open(tmpName, 'wb') as outf:
+        outf.write(encode_png(data))
+    os.replace(tmpName, fname)
+
+# Convert elevations between minEle and maxEle into samples between 0
+# and the largest value of dtype
+# Nodata (and anything else out of range) is clamped, and a flat range
+# maps everything to 0
+def normalize(data, minEle, maxEle, dtype=np.uint8, nodata=None):
+    sampleMax = np.iinfo(dtype).max
+    scale = 0.0
+    if maxEle > minEle:
+        scale = sampleMax / (maxEle - minEle)
+    scaled = (data.astype(np.float32) - minEle) * scale
+    np.clip(scaled, 0, sampleMax, out=scaled)
+    if nodata is not None:
+        scaled[data == nodata] = 0
+    return scaled.astype(dtype)
+
+# Elevation range of a band, exact if the dataset doesn't already know it
+def band_range(band):
+    minEle = band.GetMinimum()
+    maxEle = band.GetMaximum()
+    if minEle is None or maxEle is None:
+        minEle, maxEle = band.ComputeRasterMinMax(False)
+    return minEle, maxEle
+
+# Each worker process opens the dataset once
+workerDataset = None
+
+def open_worker(fname):
+    global workerDataset
+    gdal.UseExceptions()
+    workerDataset = gdal.Open(fname)
+
+# Worker process entry point
+# Writes one row of tiles at one level and returns
+# (level, row, {tile key: hash}, number of tiles written, tiles)
+# job is a dictionary with the level, row, and the settings from build()
+# When the output is an .mbtiles file, the tiles are returned as a list
+# of (x, PNG) for build() to write, instead of being written here
+def tile_row(job):
+    band = workerDataset.GetRasterBand(1)
+    width = workerDataset.RasterXSize
+    height = workerDataset.RasterYSize
+    level = job['level']
+    tileSize = job['tile_size']
+    scale = 2**level
+    srcSize = tileSize * scale
+    dtype = np.uint16 if job['bits'] == 16 else np.uint8
+    nodata = band.GetNoDataValue()
+
+    y = job['row'] * srcSize
+    rows = min(srcSize, height - y)
+    bufRows = int(math.ceil(rows / float(scale)))
+    bufCols = int(math.ceil(width / float(scale)))
+    if scale == 1:
+        data = band.ReadAsArray(0, y, width, rows)
+    else:
+        data = band.ReadAsArray(0, y, width, rows, bufCols, bufRows,
+                                resample_alg=gdal.GRIORA_Average)
+
+    hashes = dict()
+    written = 0
+    tiles = list()
+    for x in range(0, bufCols, tileSize):
+        tile = data[:, x:x + tileSize]
+        key = '{}/{}/{}'.format(level, x // tileSize, job['row'])
+        h = hashlib.sha1(tile.tobytes())
+        h.update(job['scaling'].encode())
+        hashes[key] = h.hexdigest()
+        if job['mbtiles']:
+            if not job['force'] and job['old_hashes'].get(key) == hashes[key]:
+                continue
+            tiles.append((x // tileSize, encode_png(
+                normalize(tile, job['min'], job['max'], dtype, nodata))))
+            written += 1
+            continue
+        fname = tile_file_name(job['out_dir'], level, x // tileSize, job['row'])
+        if (not job['force'] and job['old_hashes'].get(key) == hashes[key]
+                and os.path.exists(fname)):
+            continue
+        write_png(fname, normalize(tile, job['min'], job['max'], dtype,
+                                   nodata))
+        written += 1
+    return level, job['row'], hashes, written, tiles
+
+# Read one tile of a level straight from the band, at the level's
+# resolution, or None if (x, y) is outside the raster
+def read_tile(band, width, height, level, x, y, tileSize=TILE_SIZE):
+    scale = 2**level
+    srcSize = tileSize * scale
+    srcX = x * srcSize
+    srcY = y * srcSize
+    if x < 0 or y < 0 or srcX >= width or srcY >= height:
+        return None
+    cols = min(srcSize, width - srcX)
+    rows = min(srcSize, height - srcY)
+    if scale == 1:
+        return band.ReadAsArray(srcX, srcY, cols, rows)
+    return band.ReadAsArray(srcX, srcY, cols, rows,
+                            int(math.ceil(cols / float(scale))),
+                            int(math.ceil(rows / float(scale))),
+                            resample_alg=gdal.GRIORA_Average)
+
+# Render a single tile of a pyramid from an open dataset, for filling in
+# tiles as they're asked for instead of building the whole thing
+# state is the pyramid's read_state(), for the scaling
+# Returns the tile's file name, or None if it's outside the raster
+def render_tile(dataset, outDir, level, x, y, state):
+    band = dataset.GetRasterBand(1)
+    tile = read_tile(band, dataset.RasterXSize, dataset.RasterYSize, level,
+                     x, y, state['tile_size'])
+    if tile is None:
+        return None
+    dtype = np.uint16 if state['bits'] == 16 else np.uint8
+    fname = tile_file_name(outDir, level, x, y)
+    os.makedirs(level_dir(outDir, level), exist_ok=True)
+    write_png(fname, normalize(tile, state['min'], state['max'], dtype,
+                               band.GetNoDataValue()))
+    return fname
+
+# The saved state of the pyramid in outDir, or None if there isn't one
+# An .mbtiles file keeps it in its metadata
+def read_state(outDir):
+    if is_mbtiles(outDir):
+        if not os.path.exists(outDir):
+            return None
+        state = mbtiles.MBTiles(outDir).metadata.get(MBTILES_STATE)
+        return json.loads(state) if state else None
+    statePath = os.path.join(outDir, STATE_FILE)
+    if not os.path.exists(statePath):
+        return None
+    with open(statePath) as inf:
+        return json.load(inf)
+
+# Build the pyramid for fname in outDir
+# Returns the number of tiles written and the number skipped
+def build(outDir, fname, workers=None, tileSize=TILE_SIZE, levels=None,
+          bits=8, minEle=None, maxEle=None, force=False):
+    gdal.UseExceptions()
+    dataset = gdal.Open(fname)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    geotransform = list(dataset.GetGeoTransform())
+    projection = dataset.GetProjection()
+    if minEle is None or maxEle is None:
+        lo, hi = band_range(dataset.GetRasterBand(1))
+        if minEle is None:
+            minEle = lo
+        if maxEle is None:
+            maxEle = hi
+    dataset = None
+    print('Min={:.3f}, Max={:.3f}'.format(minEle, maxEle))
+    if levels is None:
+        levels = num_levels(width, height, tileSize)
+
+    # The zoom of level 0 in an .mbtiles file
+    tiles0 = int(math.ceil(max(width, height) / float(tileSize)))
+    maxZoom = max(levels - 1, (tiles0 - 1).bit_length())
+
+    useMBTiles = is_mbtiles(outDir)
+    oldHashes = dict()
+    state = None if force else read_state(outDir)
+    if state is not None:
+        if state.get('tile_size') == tileSize and state.get('bits') == bits:
+            oldHashes = state.get('hashes', dict())
+        # An .mbtiles file keeps tiles by zoom, not level, so if the
+        # levels moved to other zooms every tile has to be written again
+        if useMBTiles and state.get('max_zoom') != maxZoom:
+            oldHashes = dict()
+
+    jobs = list()
+    for level in range(levels):
+        if not useMBTiles and not os.path.exists(level_dir(outDir, level)):
+            os.makedirs(level_dir(outDir, level))
+        srcSize = tileSize * 2**level
+        for row in range(int(math.ceil(height / float(srcSize)))):
+            prefix = '{}/'.format(level)
+            suffix = '/{}'.format(row)
+            jobs.append(dict(level=level, row=row, tile_size=tileSize,
+                             bits=bits, min=minEle, max=maxEle,
+                             scaling='{!r} {!r} {}'.format(minEle, maxEle, bits),
+                             out_dir=outDir, force=force, mbtiles=useMBTiles,
+                             old_hashes=dict((k, v) for k, v in oldHashes.items()
+                                             if k.startswith(prefix)
+                                             and k.endswith(suffix))))
+    # The big levels first, so the small jobs fill in at the end
+    jobs.sort(key=lambda j: j['level'])
+
+    writer = None
+    if useMBTiles:
+        writer = mbtiles.TileWriter(mbtiles.connect(outDir))
+
+    hashes = dict()
+    written = 0
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=open_worker,
+            initargs=(fname,)) as executor:
+        # Rows going into an .mbtiles file carry their tiles, so only a
+        # few are let out at a time
+        for level, row, rowHashes, rowWritten, tiles in mbtiles.run_jobs(
+                executor, tile_row, jobs, workers * mbtiles.QUEUE_DEPTH):
+            hashes.update(rowHashes)
+            written += rowWritten
+            for x, png in tiles:
+                writer.add(maxZoom - level, x, row, png)
+
+    state = dict(source=os.path.abspath(fname), width=width, height=height,
+                 tile_size=tileSize, levels=levels, max_zoom=maxZoom,
+                 bits=bits, min=minEle, max=maxEle, hashes=hashes)
+    manifest = tilemanifest.new_manifest(tileSize, geotransform, projection,
+                                         width, height, os.path.abspath(fname))
+    if useMBTiles:
+        finish_mbtiles(writer, manifest, state, maxZoom)
+        return written, len(hashes) - written
+
+    statePath = os.path.join(outDir, STATE_FILE)
+    with open(statePath + '.tmp', 'w') as outf:
+        json.dump(state, outf)
+    os.replace(statePath + '.tmp', statePath)
+
+    # The manifest goes last, since anything written after it would
+    # make it look out of date
+    tilemanifest.update(outDir, manifest)
+    return written, len(hashes) - written
+
+# Finish writing a pyramid to an .mbtiles file
+# The manifest comes from the tiles in the state's hashes, and tiles
+# left over from an earlier, bigger pyramid are dropped
+def finish_mbtiles(writer, manifest, state, maxZoom):
+    keys = set(tuple(int(v) for v in key.split('/')) for key in state['hashes'])
+    for level in range(state['levels']):
+        manifest['levels'][level] = tilemanifest.index_tiles(
+            [(x, y) for l, x, y in keys if l == level])
+    writer.flush()
+    dbc = writer.dbc
+    with dbc:
+        stale = [(z, x, y) for z, x, y in dbc.execute(
+                     'select zoom_level, tile_column, tile_row from map')
+                 if (maxZoom - z, x, mbtiles.flip_y(z, y)) not in keys]
+        dbc.executemany('''\
+delete from map where zoom_level=? and tile_column=? and tile_row=?''', stale)
+    metadata = mbtiles.manifest_metadata(
+        manifest, os.path.basename(state['source']))
+    metadata[MBTILES_STATE] = json.dumps(state)
+    writer.close(metadata)
+    dbc.close()
+
+def main(args):
+    opts = dict()
+    rest = list()
+    names = {'--workers': ('workers', int),
+             '--tile-size': ('tileSize', int),
+             '--levels': ('levels', int),
+             '--bits': ('bits', int),
+             '--min': ('minEle', float),
+             '--max': ('maxEle', float)}
+    for arg in args:
+        name = arg.split('=')[0]
+        if name in names and '=' in arg:
+            key, conv = names[name]
+            opts[key] = conv(arg[arg.index('=')+1:])
+        elif arg == '--force':
+            opts['force'] = True
+        else:
+            rest.append(arg)
+    if len(rest) != 2 or opts.get('bits', 8) not in (8, 16):
+        print('Syntax is:')
+        print('\t./pyramid.py [--workers=N] [--tile-size=512] [--levels=N] [--bits=8|16]')
+        print('\t             [--min=elevation] [--max=elevation] [--force]')
+        print('\t             <output_directory_or.mbtiles> <arcgrid_or_geotiff>')
+        sys.exit(1)
+    written, skipped = build(rest[0], rest[1], **opts)
+    print('Wrote {} tiles, {} unchanged'.format(written, skipped))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,239 @@
+# tilemanifest.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# A small index of a directory of tiles
+
+# Finding the extent of a tile set used to mean globbing and matching
+# every file name, which takes a long time with hundreds of thousands
+# of tiles.  Instead, pngtiler and pyramid.py write manifest.json next
+# to their tiles, with:
+#   - the tile size, and the georeferencing of the source dataset
+#   - for each level (0 is the directory itself, then level1, ...):
+#     the range of tile x and y numbers, and which tiles in that range
+#     exist, as a zlib compressed, base64 encoded bitmap (or null if
+#     they all do)
+#   - each level directory's modification time, so a manifest that's
+#     out of date can be noticed with one stat() per level
+# When there's no manifest (or it's stale), one os.scandir pass over
+# each level builds it and it's saved for next time.
+# Anything that isn't known from the files themselves, like the
+# georeferencing, is kept from the old manifest.
+
+# Only the standard library is used, so viewtile.py doesn't need GDAL.
+
+import os
+import re
+import json
+import zlib
+import base64
+import os.path
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+TILE_RX = re.compile(r'^tile(\d{4})x(\d{4})\.png$')
+LEVEL_RX = re.compile(r'^level(\d+)$')
+
+# The directory a level's tiles are in, relative to the tile set
+def level_name(level):
+    if level == 0:
+        return ''
+    return 'level{}'.format(level)
+
+# Which tiles of one level exist
+class LevelIndex(object):
+    # bits is a bytearray with one bit per tile in the range, row by row,
+    # or None if every tile exists
+    def __init__(self, minX, minY, maxX, maxY, bits=None, mtime=None):
+        self.minX = minX
+        self.minY = minY
+        self.maxX = maxX
+        self.maxY = maxY
+        self.columns = maxX - minX + 1
+        self.rows = maxY - minY + 1
+        self.bits = bits
+        self.mtime = mtime
+
+    def has(self, x, y):
+        if not (self.minX <= x <= self.maxX and self.minY <= y <= self.maxY):
+            return False
+        if self.bits is None:
+            return True
+        i = (y - self.minY) * self.columns + (x - self.minX)
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def count(self):
+        if self.bits is None:
+            return self.columns * self.rows
+        return sum(bin(b).count('1') for b in self.bits)
+
+    def to_json(self, level):
+        present = None
+        if self.bits is not None and self.count() < self.columns * self.rows:
+            present = base64.b64encode(zlib.compress(bytes(self.bits))).decode()
+        return dict(level=level, dir=level_name(level), min_x=self.minX,
+                    min_y=self.minY, max_x=self.maxX, max_y=self.maxY,
+                    present=present, mtime_ns=self.mtime)
+
+    @staticmethod
+    def from_json(info):
+        bits = None
+        if info.get('present') is not None:
+            bits = bytearray(zlib.decompress(base64.b64decode(info['present'])))
+        return LevelIndex(info['min_x'], info['min_y'], info['max_x'],
+                          info['max_y'], bits, info.get('mtime_ns'))
+
+# Build the index of one level directory with a single os.scandir pass
+# Files that aren't tiles are ignored
+# Returns None if there are no tiles
+def scan_level(directory):
+    tiles = list()
+    mtime = os.stat(directory).st_mtime_ns
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            mtch = TILE_RX.match(entry.name)
+            if mtch is not None:
+                tiles.append((int(mtch.group(1)), int(mtch.group(2))))
+    index = index_tiles(tiles)
+    if index is not None:
+        index.mtime = mtime
+    return index
+
+# The index of a list of (x, y) tile numbers, or None if it's empty
+def index_tiles(tiles):
+    if not tiles:
+        return None
+    minX = min(t[0] for t in tiles)
+    minY = min(t[1] for t in tiles)
+    maxX = max(t[0] for t in tiles)
+    maxY = max(t[1] for t in tiles)
+    index = LevelIndex(minX, minY, maxX, maxY)
+    index.bits = bytearray((index.columns * index.rows + 7) // 8)
+    for x, y in tiles:
+        i = (y - minY) * index.columns + (x - minX)
+        index.bits[i >> 3] |= 1 << (i & 7)
+    return index
+
+# A tile set's manifest, which is a dictionary of everything in the file
+# with 'levels' mapping level numbers to LevelIndex
+def new_manifest(tileSize=None, geotransform=None, projection=None,
+                 width=None, height=None, source=None):
+    return dict(version=MANIFEST_VERSION, tile_size=tileSize,
+                geotransform=geotransform, projection=projection,
+                width=width, height=height, source=source, levels=dict())
+
+# Scan every level of the tile set in directory
+# Anything else that's known (georeferencing, etc.) can be passed in
+# through manifest
+def scan(directory, manifest=None):
+    if manifest is None:
+        manifest = new_manifest()
+    manifest['levels'] = dict()
+    index = scan_level(directory)
+    if index is not None:
+        manifest['levels'][0] = index
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            mtch = LEVEL_RX.match(entry.name)
+            if mtch is not None and entry.is_dir():
+                index = scan_level(entry.path)
+                if index is not None:
+                    manifest['levels'][int(mtch.group(1))] = index
+    return manifest
+
+# A manifest as something json can write, and back
+def to_json(manifest):
+    info = dict(manifest)
+    info['levels'] = [manifest['levels'][level].to_json(level)
+                      for level in sorted(manifest['levels'])]
+    return info
+
+def from_json(info):
+    if info.get('version') != MANIFEST_VERSION:
+        return None
+    manifest = dict(info)
+    manifest['levels'] = dict((level['level'], LevelIndex.from_json(level))
+                              for level in info['levels'])
+    return manifest
+
+# The XYZ zoom of level 0
+# The most zoomed out level is z=0, and at every zoom z the tiles have
+# to fit in the 2**z by 2**z tiles of the usual XYZ (and MBTiles) grid
+def max_zoom(manifest):
+    levels = manifest['levels']
+    zoom = max(levels or [0])
+    if 0 in levels:
+        zoom = max(zoom, max(levels[0].maxX, levels[0].maxY).bit_length())
+    return zoom
+
+# Write a manifest
+# The file is rewritten in place instead of renamed into place, because
+# creating a file changes the directory's modification time and would
+# make the manifest look stale right away.  A half written manifest
+# doesn't parse, and is treated like a missing one.
+def write(directory, manifest):
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as outf:
+        json.dump(to_json(manifest), outf)
+
+# Make sure the manifest file exists before the directory is scanned
+def touch(directory):
+    open(os.path.join(directory, MANIFEST_FILE), 'a').close()
+
+# Scan a tile set and write its manifest
+# manifest has anything else that's known, like the georeferencing
+def update(directory, manifest=None):
+    touch(directory)
+    manifest = scan(directory, manifest)
+    write(directory, manifest)
+    return manifest
+
+# Read the manifest in directory, or None if there isn't one
+def read(directory):
+    fname = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname) as inf:
+            info = json.load(inf)
+    except ValueError:
+        return None
+    return from_json(info)
+
+# Whether any level directory changed since the manifest was made
+# Manifests without modification times (from pngtiler) are trusted
+def is_stale(directory, manifest):
+    for level, index in manifest['levels'].items():
+        if index.mtime is None:
+            continue
+        path = os.path.join(directory, level_name(level))
+        try:
+            if os.stat(path).st_mtime_ns != index.mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+# Get the manifest of a tile set, scanning the directory and saving a
+# new manifest if there isn't an up to date one
+def load(directory):
+    manifest = read(directory)
+    if manifest is not None and not is_stale(directory, manifest):
+        return manifest
+    try:
+        return update(directory, manifest)
+    except OSError:
+        # Read only, so the scan will just have to be done every time
+        return scan(directory, manifest)
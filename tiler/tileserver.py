@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+# tileserver.py
+
+# Copyright (c) 2011, Jeremiah LaRocco jeremiah.larocco@gmail.com
+
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Serve the output of pngtiler or pyramid.py over HTTP
+
+# Tiles are at /{z}/{x}/{y}.png, like any other XYZ tile server.  z
+# counts up from the most zoomed out level of a pyramid, so the full
+# resolution tiles (the ones in the directory itself) have the largest
+# z, the smallest that has room for them in its 2**z by 2**z tiles.
+# pngtiler output only has that one level.
+# /manifest.json is the tile set's manifest (see tilemanifest.py).
+# The tiles can also be in an .mbtiles file (see mbtiles.py), which
+# uses the same zoom levels.
+
+# To keep up with lots of clients:
+#   - every connection gets a thread, and HTTP/1.1 keep-alive is used
+#   - each response has an ETag and Last-Modified from the tile file's
+#     size and modification time, and a client that already has the
+#     tile gets an empty 304 Not Modified
+#   - tiles that are asked for more than once are kept in memory, up to
+#     a limit in bytes, and the least recently used go first
+#   - other tiles are sent straight from the file with sendfile(),
+#     without being copied through Python
+# With --render, tiles that don't exist yet are made from the source
+# raster the first time they're asked for and saved for next time.  The
+# scaling and tile size come from pyramid.json, so they match the
+# tiles that were already built.  Only this needs GDAL and NumPy.
+
+# Usage:
+#     ./tileserver.py [--port=8000] [--bind=address] [--cache-mb=256]
+#                     [--render[=arcgrid_or_geotiff]] [--log]
+#                     <tile_directory_or.mbtiles>
+
+import os
+import re
+import sys
+import json
+import socket
+import os.path
+import threading
+import collections
+import email.utils
+import http.server
+
+import mbtiles
+import tilemanifest
+
+try:
+    # Only needed to render tiles, and needs GDAL
+    import pyramid
+except ImportError:
+    pyramid = None
+
+PORT = 8000
+
+# Bytes of tiles to keep in memory
+CACHE_BYTES = 256 * 1024 * 1024
+
+# A tile is cached after this many requests
+HOT_HITS = 2
+
+# Number of tiles whose requests are counted
+MAX_COUNTED = 65536
+
+# How long clients can use a tile without asking again
+MAX_AGE = 3600
+
+TILE_RX = re.compile(r'^/(\d+)/(\d+)/(\d+)\.png$')
+
+# A tile file's ETag and Last-Modified header values
+def validators(st):
+    etag = '"{:x}-{:x}"'.format(st.st_size, st.st_mtime_ns)
+    return etag, email.utils.formatdate(st.st_mtime, usegmt=True)
+
+# Whether a request's If-None-Match or If-Modified-Since headers say the
+# client already has this version of the tile
+# mtime is the tile's modification time in seconds
+def not_modified(headers, etag, mtime):
+    inm = headers.get('If-None-Match')
+    if inm is not None:
+        return inm.strip() == '*' or etag in [t.strip() for t in inm.split(',')]
+    ims = headers.get('If-Modified-Since')
+    if ims is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+# A least recently used cache of tile files, by size in bytes
+# Entries are (body, size, mtime_ns), and are only used while the file's
+# size and modification time still match
+class HotCache(object):
+    def __init__(self, maxBytes=CACHE_BYTES, hotHits=HOT_HITS):
+        self.maxBytes = maxBytes
+        self.hotHits = hotHits
+        self.curBytes = 0
+        self.tiles = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # The cached contents of fname if they're still current, otherwise
+    # None
+    # Also counts the request, and returns True as the second value once
+    # the tile is worth reading into memory
+    def get(self, fname, st):
+        with self.lock:
+            entry = self.tiles.get(fname, None)
+            if entry is not None:
+                if entry[1:] == (st.st_size, st.st_mtime_ns):
+                    self.tiles.move_to_end(fname)
+                    self.hits += 1
+                    return entry[0], False
+                del self.tiles[fname]
+                self.curBytes -= len(entry[0])
+            self.misses += 1
+            count = self.counts.pop(fname, 0) + 1
+            self.counts[fname] = count
+            while len(self.counts) > MAX_COUNTED:
+                self.counts.popitem(last=False)
+            return None, count >= self.hotHits and st.st_size <= self.maxBytes
+
+    def put(self, fname, body, st):
+        with self.lock:
+            old = self.tiles.pop(fname, None)
+            if old is not None:
+                self.curBytes -= len(old[0])
+            self.counts.pop(fname, None)
+            self.tiles[fname] = (body, st.st_size, st.st_mtime_ns)
+            self.curBytes += len(body)
+            while self.curBytes > self.maxBytes:
+                oldName, old = self.tiles.popitem(last=False)
+                self.curBytes -= len(old[0])
+
+# The tiles in a directory written by pngtiler or pyramid.py
+class TileSet(object):
+    # With render, missing tiles are made from source, or the raster the
+    # tiles were made from
+    def __init__(self, directory, render=False, source=None):
+        self.directory = directory
+        self.manifest = tilemanifest.load(directory)
+        self.maxZoom = tilemanifest.max_zoom(self.manifest)
+        self.renderer = None
+        if render:
+            self.renderer = Renderer(directory,
+                                     source or self.manifest.get('source'),
+                                     self.manifest.get('tile_size'))
+            self.maxZoom = max(self.maxZoom, self.renderer.maxLevel)
+
+    # The file name of tile (x, y) at zoom z, or None if there's no such
+    # level
+    def tile_file_name(self, z, x, y):
+        level = self.maxZoom - z
+        if level < 0:
+            return None
+        return os.path.join(self.directory, tilemanifest.level_name(level),
+                            'tile{:04d}x{:04d}.png'.format(x, y))
+
+    # Make a missing tile, returns its file name or None if it can't be
+    # made
+    def render(self, z, x, y):
+        if self.renderer is None or self.maxZoom - z < 0:
+            return None
+        return self.renderer.render(self.maxZoom - z, x, y)
+
+# Renders missing tiles of a pyramid from its source raster
+# GDAL datasets can't be shared between threads, so each thread opens
+# its own, and a tile that several clients ask for at once is only
+# rendered by the first
+class Renderer(object):
+    def __init__(self, directory, source=None, tileSize=None):
+        if pyramid is None:
+            raise ValueError('Rendering tiles needs GDAL and NumPy')
+        self.directory = directory
+        self.state = pyramid.read_state(directory) or dict()
+        self.source = source or self.state.get('source')
+        if not self.source:
+            raise ValueError('No source raster for {}'.format(directory))
+        pyramid.gdal.UseExceptions()
+        dataset = pyramid.gdal.Open(self.source)
+        tileSize = self.state.get('tile_size') or tileSize or pyramid.TILE_SIZE
+        if self.state.get('min') is None or self.state.get('max') is None:
+            self.state['min'], self.state['max'] = pyramid.band_range(
+                dataset.GetRasterBand(1))
+        self.state = dict(tile_size=tileSize, bits=self.state.get('bits', 8),
+                          min=self.state['min'], max=self.state['max'])
+        self.maxLevel = pyramid.num_levels(dataset.RasterXSize,
+                                           dataset.RasterYSize, tileSize) - 1
+        dataset = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.rendering = dict()
+
+    def dataset(self):
+        if getattr(self.local, 'dataset', None) is None:
+            self.local.dataset = pyramid.gdal.Open(self.source)
+        return self.local.dataset
+
+    def render(self, level, x, y):
+        key = (level, x, y)
+        with self.lock:
+            event = self.rendering.get(key, None)
+            first = event is None
+            if first:
+                event = self.rendering[key] = threading.Event()
+        if not first:
+            event.wait()
+            fname = pyramid.tile_file_name(self.directory, level, x, y)
+            return fname if os.path.exists(fname) else None
+        try:
+            return pyramid.render_tile(self.dataset(), self.directory, level,
+                                       x, y, self.state)
+        finally:
+            with self.lock:
+                del self.rendering[key]
+            event.set()
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'tileserver/1.0'
+
+    def do_GET(self):
+        self.send_tile(True)
+
+    def do_HEAD(self):
+        self.send_tile(False)
+
+    def send_tile(self, withBody):
+        tiles = self.server.tiles
+        if isinstance(tiles, mbtiles.MBTiles):
+            self.send_mbtile(tiles, withBody)
+            return
+        path = self.path.split('?', 1)[0]
+        mtch = None
+        if path == '/' + tilemanifest.MANIFEST_FILE:
+            fname = os.path.join(tiles.directory, tilemanifest.MANIFEST_FILE)
+        else:
+            mtch = TILE_RX.match(path)
+            if mtch is None:
+                self.send_error(404)
+                return
+            z, x, y = (int(v) for v in mtch.groups())
+            fname = tiles.tile_file_name(z, x, y)
+        if fname is None:
+            self.send_error(404)
+            return
+        try:
+            st = os.stat(fname)
+        except OSError:
+            st = None
+            if mtch is not None:
+                try:
+                    fname = tiles.render(z, x, y)
+                    if fname is not None:
+                        st = os.stat(fname)
+                except Exception as err:
+                    self.log_error('Could not render %s: %s', path, err)
+                    self.send_error(500)
+                    return
+            if st is None:
+                self.send_error(404)
+                return
+
+        body, hot = self.server.cache.get(fname, st)
+        inf = None
+        if body is None:
+            # The headers have to match what's actually sent, even if the
+            # file was replaced since the stat()
+            try:
+                inf = open(fname, 'rb')
+            except OSError:
+                self.send_error(404)
+                return
+            st = os.fstat(inf.fileno())
+        try:
+            etag, lastModified = validators(st)
+            if not_modified(self.headers, etag, st.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'max-age={}'.format(MAX_AGE))
+                self.end_headers()
+                return
+
+            if hot:
+                body = inf.read(st.st_size)
+                self.server.cache.put(fname, body, st)
+            self.send_response(200)
+            if fname.endswith('.json'):
+                self.send_header('Content-Type', 'application/json')
+            else:
+                self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(st.st_size))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', lastModified)
+            self.send_header('Cache-Control', 'max-age={}'.format(MAX_AGE))
+            self.end_headers()
+            if not withBody:
+                return
+            if body is not None:
+                self.wfile.write(body)
+            else:
+                self.wfile.flush()
+                self.connection.sendfile(inf, 0, st.st_size)
+        finally:
+            if inf is not None:
+                inf.close()
+
+    # Send a tile out of an .mbtiles file
+    # SQLite does the caching, and since tiles are stored by the hash of
+    # their contents, that's the ETag
+    def send_mbtile(self, tiles, withBody):
+        path = self.path.split('?', 1)[0]
+        mtime = os.stat(tiles.fileName).st_mtime
+        if path == '/' + tilemanifest.MANIFEST_FILE:
+            body = json.dumps(tilemanifest.to_json(tiles.manifest)).encode()
+            etag = '"{:x}"'.format(int(mtime * 1e9))
+            contentType = 'application/json'
+        else:
+            mtch = TILE_RX.match(path)
+            if mtch is None:
+                self.send_error(404)
+                return
+            tid, body = tiles.tile(*(int(v) for v in mtch.groups()))
+            if body is None:
+                self.send_error(404)
+                return
+            etag = '"{}"'.format(tid)
+            contentType = 'image/png'
+        if not_modified(self.headers, etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'max-age={}'.format(MAX_AGE))
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         email.utils.formatdate(mtime, usegmt=True))
+        self.send_header('Cache-Control', 'max-age={}'.format(MAX_AGE))
+        self.end_headers()
+        if withBody:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            super(TileHandler, self).log_message(format, *args)
+
+class TileServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, tiles, cacheBytes=CACHE_BYTES, log=False):
+        super(TileServer, self).__init__(address, TileHandler)
+        self.tiles = tiles
+        self.cache = HotCache(cacheBytes)
+        self.log = log
+
+    # Small responses shouldn't wait on Nagle's algorithm
+    def get_request(self):
+        conn, addr = super(TileServer, self).get_request()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, addr
+
+def main(args):
+    port = PORT
+    bind = ''
+    cacheBytes = CACHE_BYTES
+    render = False
+    source = None
+    log = False
+    rest = list()
+    for arg in args:
+        if arg.startswith('--port='):
+            port = int(arg[len('--port='):])
+        elif arg.startswith('--bind='):
+            bind = arg[len('--bind='):]
+        elif arg.startswith('--cache-mb='):
+            cacheBytes = int(float(arg[len('--cache-mb='):]) * 1024 * 1024)
+        elif arg == '--render':
+            render = True
+        elif arg.startswith('--render='):
+            render = True
+            source = arg[len('--render='):]
+        elif arg == '--log':
+            log = True
+        else:
+            rest.append(arg)
+    if len(rest) != 1:
+        print('Syntax is:')
+        print('\t./tileserver.py [--port=8000] [--bind=address] [--cache-mb=256]')
+        print('\t                [--render[=arcgrid_or_geotiff]] [--log]')
+        print('\t                <tile_directory_or.mbtiles>')
+        sys.exit(1)
+
+    if rest[0].lower().endswith('.mbtiles'):
+        if render:
+            print('Tiles can only be rendered into a directory')
+            sys.exit(1)
+        tiles = mbtiles.MBTiles(rest[0])
+    else:
+        tiles = TileSet(rest[0], render, source)
+    server = TileServer((bind, port), tiles, cacheBytes, log)
+    print('Serving {} (z 0-{}) on port {}'.format(rest[0], tiles.maxZoom,
+                                                  server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -21,146 +21,493 @@
 # Really poor quality right now, more like a proof of concept to demonstrate
 # that the tile splitting code is working.
 
-import re
+# The tiles fill the window, whatever its size.  Drag with the mouse or
+# use the arrow keys (Shift for a whole window) to scroll, and if the
+# tiles were made by pyramid.py, - and + (or Page Down and Page Up)
+# zoom out and in between its levels.
+
+# Decoded tiles are kept in an LRU cache, and after every move a pool of
+# threads decodes the tiles around the view, the ones in the direction
+# of the move first, so scrolling mostly paints images that are already
+# in memory.
+# The extent of the tiles comes from the manifest.json written by the
+# tilers (see tilemanifest.py), so starting up takes the same time no
+# matter how many tiles there are.
+# The tiles can also be in an .mbtiles file, see mbtiles.py.
+# With map_download in PYTHONPATH, the title also has the latitude and
+# longitude of UTM tiles (see utm.py).
+# --bench=N pans N frames around the tiles and prints how long they took.
+
 import os
 import sys
-import glob
+import time
+import random
 import os.path
+import threading
+import collections
+import concurrent.futures
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
 
-class TileViewer(QtGui.QDialog):
-    def __init__(self, directory, parent=None):
-        super(TileViewer, self).__init__(parent)
+import mbtiles
+import tilemanifest
+
+# The title shows the latitude and longitude of the view if utm.py,
+# from the map scripts, can be imported (put map_download in PYTHONPATH)
+try:
+    import utm
+except ImportError:
+    utm = None
+
+# Bytes of decoded tiles to keep around
+CACHE_BYTES = 256 * 1024 * 1024
+
+# Threads decoding tiles in the background
+PREFETCH_THREADS = 4
+
+# Tiles kept as QPixmaps, ready to paint
+PIXMAP_COUNT = 256
+
+# Used if the manifest doesn't say
+TILE_SIZE = 512
+
+# The file name of a tile
+def tile_file_name(directory, x, y):
+    return '{}/tile{:04d}x{:04d}.png'.format(directory, x, y)
+
+# Tiles in a directory, from pngtiler or pyramid.py
+# Each tile's key is its file name
+class DirectoryTiles(object):
+    def __init__(self, directory):
         self.directory = directory
-        self.get_image_counts()
+        self.manifest = tilemanifest.load(directory)
 
-        # Start at the top left corner
-        self.curX = self.minx
-        self.curY = self.miny
+    def key(self, level, x, y):
+        if level == 0:
+            return tile_file_name(self.directory, x, y)
+        return tile_file_name(os.path.join(self.directory,
+                                           tilemanifest.level_name(level)), x, y)
 
-        # Create 4 labels
-        self.lblUL = QtGui.QLabel('')
-        self.lblLL = QtGui.QLabel('')
-        self.lblUR = QtGui.QLabel('')
-        self.lblLR = QtGui.QLabel('')
-        self.lblUL.setAlignment(QtCore.Qt.AlignTop and QtCore.Qt.AlignLeft)
-        self.lblLL.setAlignment(QtCore.Qt.AlignTop and QtCore.Qt.AlignLeft)
-        self.lblUR.setAlignment(QtCore.Qt.AlignTop and QtCore.Qt.AlignLeft)
-        self.lblLR.setAlignment(QtCore.Qt.AlignTop and QtCore.Qt.AlignLeft)
+    def image(self, key):
+        return QtGui.QImage(key)
 
-        self.refreshImages()
+# Tiles in an .mbtiles file
+# Each tile's key is (level, x, y)
+class MBTilesTiles(object):
+    def __init__(self, fileName):
+        self.db = mbtiles.MBTiles(fileName)
+        self.manifest = self.db.manifest
 
-        # Add the labels to the layout
-        vtl = QtGui.QVBoxLayout()
-        htl = QtGui.QHBoxLayout()
-        htl.addWidget(self.lblUL)
-        htl.addWidget(self.lblUR)
-        vtl.addLayout(htl)
-        
-        htl = QtGui.QHBoxLayout()
-        htl.addWidget(self.lblLL)
-        htl.addWidget(self.lblLR)
-        vtl.addLayout(htl)
-        self.setLayout(vtl)
+    def key(self, level, x, y):
+        return (level, x, y)
+
+    def image(self, key):
+        image = QtGui.QImage()
+        tid, data = self.db.level_tile(*key)
+        if data is not None:
+            image.loadFromData(data)
+        return image
+
+# The tiles in a directory or an .mbtiles file
+def open_tiles(path):
+    if path.lower().endswith('.mbtiles'):
+        return MBTilesTiles(path)
+    return DirectoryTiles(path)
+
+# A least recently used cache of decoded tile images
+# QPixmaps can only be made on the GUI thread, but QImages can be
+# decoded anywhere, so those are what's cached
+# Tiles are looked up by key, and load(key) decodes one
+class TileCache(object):
+    def __init__(self, load, maxBytes=CACHE_BYTES, threads=PREFETCH_THREADS):
+        self.load = load
+        self.maxBytes = maxBytes
+        self.curBytes = 0
+        self.images = collections.OrderedDict()
+        self.loading = dict()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads)
+        self.hits = 0
+        self.misses = 0
+        # Called with the file name after each image is decoded,
+        # from whichever thread decoded it
+        self.onLoaded = None
+
+    def _load(self, key):
+        image = self.load(key)
+        with self.lock:
+            self.loading.pop(key, None)
+            if key not in self.images:
+                self.images[key] = image
+                self.curBytes += image.byteCount()
+            while self.curBytes > self.maxBytes and len(self.images) > 1:
+                oldName, old = self.images.popitem(last=False)
+                self.curBytes -= old.byteCount()
+        if self.onLoaded is not None:
+            self.onLoaded(key)
+        return image
+
+    # Get the image of key only if it's already decoded
+    def peek(self, key):
+        with self.lock:
+            image = self.images.get(key, None)
+            if image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+            return image
+
+    # Get the image of key, decoding it now if it's not cached
+    # If it's being prefetched, wait for that instead
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key, None)
+            if image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+            fut = self.loading.get(key, None)
+        if fut is not None:
+            return fut.result()
+        return self._load(key)
+
+    # Start decoding files in the background, in order
+    def prefetch(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.images or key in self.loading:
+                    continue
+                self.loading[key] = self.executor.submit(self._load, key)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+# Draws whatever part of a tile set fits in the widget, and pans by
+# pixels with the mouse or the arrow keys
+# Only the tiles that intersect the area being painted are drawn, and
+# when panning, QWidget.scroll() moves what's already on the screen so
+# only the newly exposed strip is painted.  The time per frame depends
+# on the window size, not on the number of tiles.
+class TileCanvas(QtGui.QWidget):
+    # Emitted from the decoding threads with the key of a tile
+    tileReady = QtCore.pyqtSignal(object)
+
+    # tiles is a DirectoryTiles or MBTilesTiles
+    def __init__(self, tiles, cache, parent=None):
+        super(TileCanvas, self).__init__(parent)
+        self.tiles = tiles
+        self.manifest = tiles.manifest
+        self.cache = cache
+        self.tileSize = self.manifest.get('tile_size') or TILE_SIZE
+        self.level = 0
+        # Decode tiles while painting instead of in the background
+        self.wait = False
+        self.maxPixmaps = PIXMAP_COUNT
+        # Tiles that weren't ready when they were painted
+        self.placeholders = 0
+        # Pixel position of the top left of the window in the level
+        self.offsetX = 0
+        self.offsetY = 0
+        # Which way the last pan went, to know what to prefetch
+        self.lastMove = (1, 1)
+        self.dragStart = None
+        # Called with no arguments after the view moves
+        self.onMove = None
+        # Tiles already converted to QPixmaps, which only happens on the
+        # GUI thread
+        self.pixmaps = collections.OrderedDict()
+
+        index = self.index()
+        if index is not None:
+            self.offsetX = index.minX * self.tileSize
+            self.offsetY = index.minY * self.tileSize
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+        self.setFocusPolicy(QtCore.Qt.StrongFocus)
+        self.tileReady.connect(self.tileLoaded)
+        self.cache.onLoaded = self.tileReady.emit
 
-    # Figure out the number of images in each dimension
-    def get_image_counts(self):
-        fns = glob.glob(self.directory + '/*.png')
-        locPat = re.compile('.*(\d{4})x(\d{4}).png')
-        self.minx = 999
-        self.miny = 999
-        self.maxx = 0
-        self.maxy = 0
-        for fn in fns:
-            mp = locPat.match(fn)
-            xd = int(mp.group(1))
-            yd = int(mp.group(2))
-            if xd<self.minx:
-                self.minx = xd
-            if yd<self.miny:
-                self.miny = yd
-            if xd>self.maxx:
-                self.maxx = xd
-            if yd>self.maxy:
-                self.maxy = yd
-
-    # Handle movement keypresses
+    # The LevelIndex of the current level, or None
+    def index(self):
+        return self.manifest['levels'].get(self.level, None)
+
+    def has_tile(self, x, y):
+        index = self.index()
+        return index is not None and index.has(x, y)
+
+    # The range of tiles intersecting a rectangle of the widget
+    def tile_range(self, left, top, width, height):
+        ts = self.tileSize
+        return ((self.offsetX + left) // ts,
+                (self.offsetY + top) // ts,
+                (self.offsetX + left + width - 1) // ts,
+                (self.offsetY + top + height - 1) // ts)
+
+    # A tile's pixmap if it's been decoded, otherwise None
+    # Never waits for the disk
+    def pixmap(self, key):
+        pmap = self.pixmaps.get(key, None)
+        if pmap is not None:
+            self.pixmaps.move_to_end(key)
+            return pmap
+        if self.wait:
+            image = self.cache.get(key)
+        else:
+            image = self.cache.peek(key)
+        if image is None:
+            return None
+        pmap = QtGui.QPixmap.fromImage(image)
+        self.pixmaps[key] = pmap
+        while len(self.pixmaps) > self.maxPixmaps:
+            self.pixmaps.popitem(last=False)
+        return pmap
+
+    def paintEvent(self, event):
+        rect = event.rect()
+        painter = QtGui.QPainter(self)
+        painter.fillRect(rect, QtCore.Qt.black)
+        ts = self.tileSize
+        x0, y0, x1, y1 = self.tile_range(rect.left(), rect.top(),
+                                         rect.width(), rect.height())
+        missing = list()
+        for y in range(y0, y1+1):
+            for x in range(x0, x1+1):
+                if not self.has_tile(x, y):
+                    continue
+                key = self.tiles.key(self.level, x, y)
+                pmap = self.pixmap(key)
+                if pmap is None:
+                    # It'll be painted when it's decoded
+                    self.placeholders += 1
+                    missing.append(key)
+                    continue
+                painter.drawPixmap(x*ts - self.offsetX, y*ts - self.offsetY,
+                                   pmap)
+        painter.end()
+        if missing:
+            self.cache.prefetch(missing)
+
+    # A tile was decoded, so paint it if it's on the screen
+    def tileLoaded(self, key):
+        if self.wait:
+            # It was decoded while it was being painted
+            return
+        ts = self.tileSize
+        x0, y0, x1, y1 = self.tile_range(0, 0, self.width(), self.height())
+        for y in range(y0, y1+1):
+            for x in range(x0, x1+1):
+                if self.tiles.key(self.level, x, y) == key:
+                    self.update(x*ts - self.offsetX, y*ts - self.offsetY,
+                                ts, ts)
+                    return
+
+    # Queue the tiles on the screen and one tile around it for decoding,
+    # the ones on the screen first and then the ones in the direction
+    # of the last pan
+    def prefetch(self):
+        dx, dy = self.lastMove
+        x0, y0, x1, y1 = self.tile_range(0, 0, self.width(), self.height())
+        cx = (x0 + x1) / 2.0
+        cy = (y0 + y1) / 2.0
+        visible = list()
+        ring = list()
+        for y in range(y0-1, y1+2):
+            for x in range(x0-1, x1+2):
+                if not self.has_tile(x, y):
+                    continue
+                if x0<=x<=x1 and y0<=y<=y1:
+                    visible.append((x, y))
+                else:
+                    ring.append((x, y))
+        ring.sort(key=lambda t: -(dx*(t[0] - cx) + dy*(t[1] - cy)))
+        self.cache.prefetch([self.tiles.key(self.level, x, y)
+                             for x, y in visible + ring])
+
+    # Keep the window over the tiles
+    def clamp(self, x, y):
+        index = self.index()
+        if index is None:
+            return x, y
+        ts = self.tileSize
+        x = min(x, (index.maxX + 1) * ts - self.width())
+        y = min(y, (index.maxY + 1) * ts - self.height())
+        return max(x, index.minX * ts), max(y, index.minY * ts)
+
+    # Move the view by dx, dy pixels
+    def pan(self, dx, dy):
+        x, y = self.clamp(self.offsetX + dx, self.offsetY + dy)
+        dx = x - self.offsetX
+        dy = y - self.offsetY
+        if dx == 0 and dy == 0:
+            return
+        self.offsetX = x
+        self.offsetY = y
+        self.lastMove = ((dx > 0) - (dx < 0), (dy > 0) - (dy < 0))
+        # Move what's already painted, only the exposed part is repainted
+        self.scroll(-dx, -dy)
+        self.prefetch()
+        if self.onMove is not None:
+            self.onMove()
+
+    # Switch to another level of a pyramid, keeping the same spot in
+    # the middle of the window
+    def setLevel(self, level):
+        if level not in self.manifest['levels']:
+            return
+        scale = 2.0**(self.level - level)
+        cx = (self.offsetX + self.width() / 2.0) * scale
+        cy = (self.offsetY + self.height() / 2.0) * scale
+        self.level = level
+        self.offsetX, self.offsetY = self.clamp(int(cx - self.width() / 2.0),
+                                                int(cy - self.height() / 2.0))
+        self.update()
+        self.prefetch()
+        if self.onMove is not None:
+            self.onMove()
+
+    def resizeEvent(self, event):
+        self.offsetX, self.offsetY = self.clamp(self.offsetX, self.offsetY)
+        self.prefetch()
+
+    def mousePressEvent(self, event):
+        if event.button() == QtCore.Qt.LeftButton:
+            self.dragStart = event.pos()
+
+    def mouseMoveEvent(self, event):
+        if self.dragStart is not None:
+            pos = event.pos()
+            self.pan(self.dragStart.x() - pos.x(), self.dragStart.y() - pos.y())
+            self.dragStart = pos
+
+    def mouseReleaseEvent(self, event):
+        self.dragStart = None
+
+    # Arrow keys move a tile at a time, or a whole window with Shift
     def keyPressEvent(self, event):
         tkey = event.key()
+        step = self.tileSize
+        if event.modifiers() & QtCore.Qt.ShiftModifier:
+            step = None
         if tkey  == QtCore.Qt.Key_Up:
-            self.moveUp()
+            self.pan(0, -(step or self.height()))
         elif tkey==QtCore.Qt.Key_Down:
-            self.moveDown()
+            self.pan(0, step or self.height())
         elif tkey==QtCore.Qt.Key_Left:
-            self.moveLeft()
+            self.pan(-(step or self.width()), 0)
         elif tkey==QtCore.Qt.Key_Right:
-            self.moveRight()
-
-    def refreshImages(self):
-        # Update title to say which image is at the top left
-        self.setWindowTitle('At ({}, {})'.format(self.curX, self.curY))
-
-
-        # Load the images
-        # Note that this could be coordinated with the movement functions
-        # so that only 2 images are loaded in most cases
-        tileFileName = '{}/tile{:04d}x{:04d}.png'.format(self.directory,
-                                                         self.curX,
-                                                         self.curY)
-        self.pmapUL = QtGui.QPixmap(tileFileName)
-
-        tileFileName = '{}/tile{:04d}x{:04d}.png'.format(self.directory,
-                                                         self.curX+1,
-                                                         self.curY)
-        self.pmapUR = QtGui.QPixmap(tileFileName)
-
-        tileFileName = '{}/tile{:04d}x{:04d}.png'.format(self.directory,
-                                                         self.curX,
-                                                         self.curY+1)
-        self.pmapLL = QtGui.QPixmap(tileFileName)
-
-        tileFileName = '{}/tile{:04d}x{:04d}.png'.format(self.directory,
-                                                         self.curX+1,
-                                                         self.curY+1)
-        self.pmapLR = QtGui.QPixmap(tileFileName)
-
-        # Update the labels
-        self.lblUL.setPixmap(self.pmapUL)
-        self.lblUR.setPixmap(self.pmapUR)
-        self.lblLL.setPixmap(self.pmapLL)
-        self.lblLR.setPixmap(self.pmapLR)
-
-    # Move
-    def moveUp(self):
-        if self.curY>self.miny:
-            self.curY-=1
-            self.refreshImages()
-    def moveDown(self):
-        if self.curY<(self.maxy-1):
-            self.curY+=1
-            self.refreshImages()
-
-    def moveLeft(self):
-        if self.curX>self.minx:
-            self.curX-=1
-            self.refreshImages()
-    def moveRight(self):
-        if self.curX<(self.maxx-1):
-            self.curX+=1
-            self.refreshImages()
-
-        
+            self.pan(step or self.width(), 0)
+        elif tkey in (QtCore.Qt.Key_Minus, QtCore.Qt.Key_PageDown):
+            self.setLevel(self.level+1)
+        elif tkey in (QtCore.Qt.Key_Plus, QtCore.Qt.Key_Equal,
+                      QtCore.Qt.Key_PageUp):
+            self.setLevel(self.level-1)
+        else:
+            super(TileCanvas, self).keyPressEvent(event)
+
+class TileViewer(QtGui.QDialog):
+    def __init__(self, directory, parent=None):
+        super(TileViewer, self).__init__(parent)
+        self.tiles = open_tiles(directory)
+        self.manifest = self.tiles.manifest
+        self.proj = None
+        if utm is not None:
+            self.proj = utm.UTM.from_wkt(self.manifest.get('projection'))
+        self.cache = TileCache(self.tiles.image)
+        self.canvas = TileCanvas(self.tiles, self.cache)
+        self.canvas.onMove = self.updateTitle
+
+        vtl = QtGui.QVBoxLayout()
+        vtl.setContentsMargins(0, 0, 0, 0)
+        vtl.addWidget(self.canvas)
+        self.setLayout(vtl)
+        self.resize(1024, 768)
+        self.updateTitle()
+
+    # Show where the middle of the window is, in tiles and, if the
+    # manifest has the georeferencing, in world coordinates, and
+    # latitude and longitude too for UTM
+    def updateTitle(self):
+        canvas = self.canvas
+        px = canvas.offsetX + canvas.width() / 2.0
+        py = canvas.offsetY + canvas.height() / 2.0
+        title = 'At ({:.1f}, {:.1f}), level {}'.format(px / canvas.tileSize,
+                                                      py / canvas.tileSize,
+                                                      canvas.level)
+        gt = self.manifest.get('geotransform')
+        if gt:
+            scale = 2**canvas.level
+            wx = gt[0] + px*scale*gt[1] + py*scale*gt[2]
+            wy = gt[3] + px*scale*gt[4] + py*scale*gt[5]
+            title += ' ({:.1f}, {:.1f})'.format(wx, wy)
+            if self.proj is not None:
+                lon, lat = self.proj.inverse(wx, wy)
+                title += ' {:.5f}, {:.5f}'.format(float(lat), float(lon))
+        self.setWindowTitle(title)
+
+    # Pan numMoves times, in runs in the same direction like someone
+    # dragging the mouse, and return the time each frame took including
+    # painting
+    # pause is the time between frames, for prefetching to catch up
+    def benchmark(self, numMoves, pause=0.02):
+        app = QtGui.QApplication.instance()
+        directions = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+        times = list()
+        dx, dy = random.choice(directions)
+        while len(times) < numMoves:
+            if random.random() < 0.05:
+                dx, dy = random.choice(directions)
+            speed = random.randint(8, 64)
+            start = time.perf_counter()
+            self.canvas.pan(dx * speed, dy * speed)
+            self.canvas.repaint()
+            app.processEvents()
+            times.append(time.perf_counter() - start)
+            time.sleep(pause)
+        return times
+
+# Print the per-frame times from TileViewer.benchmark in milliseconds
+def print_times(times, cache, placeholders=0):
+    times = sorted(t * 1000.0 for t in times)
+    def pct(p):
+        return times[min(len(times)-1, int(p / 100.0 * len(times)))]
+    print('{} frames: mean {:.2f} ms, median {:.2f} ms, 95% {:.2f} ms, max {:.2f} ms'.format(
+        len(times), sum(times) / len(times), pct(50), pct(95), times[-1]))
+    print('Cache: {} hits, {} misses, {} tiles painted before they were ready'.format(
+        cache.hits, cache.misses, placeholders))
+
 def main(args):
-    if len(args)!=1:
+    numMoves = None
+    cacheBytes = CACHE_BYTES
+    rest = list()
+    for arg in args:
+        if arg.startswith('--bench='):
+            numMoves = int(arg[len('--bench='):])
+        elif arg == '--no-cache':
+            # For comparison, decode every tile on every move
+            cacheBytes = 0
+        else:
+            rest.append(arg)
+    if len(rest)!=1:
         print('Command takes 1 argument!')
-        print("\t./viewtile.py <image_directory>")
+        print("\t./viewtile.py [--bench=N [--no-cache]] <image_directory_or.mbtiles>")
         sys.exit(1)
     app = QtGui.QApplication([])
-    tv = TileViewer(args[0])
+    tv = TileViewer(rest[0])
+    if cacheBytes == 0:
+        tv.cache.maxBytes = 0
+        tv.canvas.maxPixmaps = 0
+        tv.canvas.wait = True
+        tv.canvas.prefetch = lambda: None
     tv.show()
-    sys.exit(app.exec_())
+    if numMoves is not None:
+        times = tv.benchmark(numMoves)
+        print_times(times, tv.cache, tv.canvas.placeholders)
+        tv.cache.shutdown()
+        sys.exit(0)
+    rv = app.exec_()
+    tv.cache.shutdown()
+    sys.exit(rv)
 
 if __name__=='__main__':
     main(sys.argv[1:])